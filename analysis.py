@@ -0,0 +1,319 @@
+"""Estimates how strongly participants prefer each video, from the choices recorded on the video screens.
+
+Usage:
+    python analysis.py                                  # export from REDCap, write state/video_scores.csv
+    python analysis.py --input export.csv               # use a saved export instead (CSV or JSON)
+    python analysis.py --bootstrap 2000 --processes 8
+
+Every completed `screen{N}_arm_1` event is one comparison: the participant was shown `video_a` and
+`video_b` and picked `video_selection`. The comparisons are loaded into NumPy arrays of video indexes
+(the order of `content/videos.json`), and from those:
+* A win matrix `W`, where `W[i, j]` is how many times video i was picked over video j. Exposures
+  (how many times each pair was shown together) are `W + W.T`.
+* Bradley-Terry preference scores: P(i is picked over j) = 1 / (1 + exp(s_j - s_i)), fitted with the
+  minorization-maximization algorithm (Hunter, 2004). Scores are centered on 0.
+* Bootstrap confidence intervals for the scores. Participants are resampled (not single choices,
+  since one participant's choices aren't independent), and the replicates are split across processes.
+
+Needs NumPy. Reading from REDCap also needs the same `secrets.json` and access key CSV as the app.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+from array import array
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+import mindlib
+
+PATH_TO_THIS_FOLDER = Path(__file__).resolve().parent
+VIDEOS_FILE_PATH = Path(PATH_TO_THIS_FOLDER, "content", "videos.json")
+SCORES_FILE_PATH = Path(PATH_TO_THIS_FOLDER, "state", "video_scores.csv")
+
+# Pseudo-comparisons spread evenly over each video's pairs, so every score is finite (a video that was
+# never picked would otherwise score -infinity) even before every pair has been shown
+DEFAULT_PRIOR = 1.0
+
+MAX_ITERATIONS = 10_000
+TOLERANCE = 1e-10
+
+DEFAULT_BOOTSTRAP_REPLICATES = 1000
+DEFAULT_CONFIDENCE = 0.95
+
+
+class Choices(NamedTuple):
+    """One element per comparison: the indexes (into `video_ids`) of the picked and the other video,
+    and the index of the participant who made it.
+    """
+
+    video_ids: list[str]
+    winners: np.ndarray
+    losers: np.ndarray
+    participants: np.ndarray
+
+    @property
+    def participant_count(self) -> int:
+        return int(self.participants.max()) + 1 if len(self.participants) else 0
+
+
+################################
+############ LOADING ###########
+
+
+def load_choices(rows: Iterable[dict], video_ids: list[str]) -> Choices:
+    """Reads comparisons out of exported screen events in one pass.
+    Rows that aren't a completed screen, or that name a video missing from `video_ids`, are skipped.
+    """
+    video_indexes = {video_id: index for index, video_id in enumerate(video_ids)}
+    participant_indexes = {}
+    # Typed arrays grow without boxing every value, and convert to NumPy without copying element-wise
+    winners = array("i")
+    losers = array("i")
+    participants = array("i")
+    for row in rows:
+        if row.get("video_complete", "2") != "2":
+            continue
+        video_a = video_indexes.get(row.get("video_a", ""))
+        video_b = video_indexes.get(row.get("video_b", ""))
+        selected = video_indexes.get(row.get("video_selection", ""))
+        if video_a is None or video_b is None or video_a == video_b:
+            continue
+        if selected == video_a:
+            winners.append(video_a)
+            losers.append(video_b)
+        elif selected == video_b:
+            winners.append(video_b)
+            losers.append(video_a)
+        else:
+            continue
+        participants.append(
+            participant_indexes.setdefault(row["access_key"], len(participant_indexes))
+        )
+    return Choices(
+        video_ids,
+        np.frombuffer(winners, dtype=np.int32),
+        np.frombuffer(losers, dtype=np.int32),
+        np.frombuffer(participants, dtype=np.int32),
+    )
+
+
+def read_export_file(path: Path) -> list[dict]:
+    """Reads records saved from REDCap (flat JSON or CSV export)."""
+    if path.suffix.lower() == ".json":
+        return mindlib.json_to_dict(path)
+    with open(path, newline="") as infile:
+        return list(csv.DictReader(infile))
+
+
+def export_screen_events() -> Iterable[dict]:
+    """Streams every screen event's videos and selection straight from REDCap."""
+    import flask_site
+    import redcap_helpers
+
+    return redcap_helpers.iter_records(
+        flask_site.flask_app.config["C2C_DCV_API_TOKEN"],
+        flask_site.flask_app.config["REDCAP_API_URL"],
+        fields=["access_key", "video_a", "video_b", "video_selection", "video_complete"],
+        events=[f"screen{screen}_arm_1" for screen in range(1, flask_site.MAX_SCREENS + 1)],
+    )
+
+
+################################
+########### ANALYSIS ###########
+
+
+def win_matrix(
+    winners: np.ndarray, losers: np.ndarray, video_count: int, weights: np.ndarray | None = None
+) -> np.ndarray:
+    """Returns `W`: `W[i, j]` is the (weighted) number of times video i was picked over video j."""
+    return np.bincount(
+        winners * video_count + losers, weights=weights, minlength=video_count * video_count
+    ).reshape(video_count, video_count)
+
+
+def fit_bradley_terry(
+    wins: np.ndarray,
+    prior: float = DEFAULT_PRIOR,
+    max_iterations: int = MAX_ITERATIONS,
+    tolerance: float = TOLERANCE,
+) -> np.ndarray:
+    """Fits Bradley-Terry scores to a win matrix with the MM algorithm; every iteration is a few
+    matrix operations over all videos at once. Returns log-strengths centered on 0.
+    """
+    video_count = wins.shape[0]
+    wins = wins.astype(np.float64)
+    if prior > 0 and video_count > 1:
+        off_diagonal = 1 - np.eye(video_count)
+        wins = wins + off_diagonal * (prior / (2 * (video_count - 1)))
+    comparisons = wins + wins.T
+    total_wins = wins.sum(axis=1)
+    strengths = np.ones(video_count)
+    for _ in range(max_iterations):
+        denominators = (comparisons / (strengths[:, None] + strengths[None, :])).sum(axis=1)
+        new_strengths = np.divide(
+            total_wins, denominators, out=np.zeros(video_count), where=denominators > 0
+        )
+        # Strengths are only defined up to a constant factor; keep their geometric mean at 1
+        positive = new_strengths > 0
+        if positive.any():
+            new_strengths /= np.exp(np.mean(np.log(new_strengths[positive])))
+        converged = np.max(np.abs(new_strengths - strengths)) < tolerance
+        strengths = new_strengths
+        if converged:
+            break
+    return np.log(strengths)
+
+
+def _bootstrap_worker(
+    choices: Choices, replicates: int, prior: float, seed: np.random.SeedSequence
+) -> np.ndarray:
+    """Returns scores fitted to `replicates` resamples of the participants (one row per replicate)."""
+    rng = np.random.default_rng(seed)
+    video_count = len(choices.video_ids)
+    participant_count = choices.participant_count
+    results = np.empty((replicates, video_count))
+    for replicate in range(replicates):
+        # Drawing participants with replacement = giving each one a multinomial count of copies
+        counts = rng.multinomial(
+            participant_count, np.full(participant_count, 1 / participant_count)
+        )
+        weights = counts[choices.participants].astype(np.float64)
+        results[replicate] = fit_bradley_terry(
+            win_matrix(choices.winners, choices.losers, video_count, weights), prior
+        )
+    return results
+
+
+def bootstrap_scores(
+    choices: Choices,
+    replicates: int = DEFAULT_BOOTSTRAP_REPLICATES,
+    prior: float = DEFAULT_PRIOR,
+    processes: int | None = None,
+    seed: int | None = None,
+) -> np.ndarray:
+    """Returns the scores of `replicates` participant-resampled fits (one row per replicate),
+    spread over `processes` worker processes (default: one per CPU).
+    """
+    processes = processes or os.cpu_count() or 1
+    processes = max(1, min(processes, replicates))
+    chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(replicates), processes)]
+    seeds = np.random.SeedSequence(seed).spawn(processes)
+    if processes == 1:
+        return _bootstrap_worker(choices, replicates, prior, seeds[0])
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(_bootstrap_worker, choices, chunk_size, prior, chunk_seed)
+            for chunk_size, chunk_seed in zip(chunk_sizes, seeds)
+        ]
+        return np.vstack([future.result() for future in futures])
+
+
+def confidence_intervals(
+    replicate_scores: np.ndarray, confidence: float = DEFAULT_CONFIDENCE
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the (lower, upper) percentile bounds of each video's bootstrapped scores."""
+    alpha = (1 - confidence) / 2
+    return (
+        np.quantile(replicate_scores, alpha, axis=0),
+        np.quantile(replicate_scores, 1 - alpha, axis=0),
+    )
+
+
+def score_table(
+    choices: Choices,
+    bootstrap_replicates: int = DEFAULT_BOOTSTRAP_REPLICATES,
+    prior: float = DEFAULT_PRIOR,
+    processes: int | None = None,
+    confidence: float = DEFAULT_CONFIDENCE,
+    seed: int | None = None,
+) -> list[dict]:
+    """Returns one row per video, best first: exposures, wins, win rate, score and its interval."""
+    video_count = len(choices.video_ids)
+    wins = win_matrix(choices.winners, choices.losers, video_count)
+    exposures = (wins + wins.T).sum(axis=1)
+    total_wins = wins.sum(axis=1)
+    scores = fit_bradley_terry(wins, prior)
+    lower = upper = np.full(video_count, np.nan)
+    if bootstrap_replicates > 0 and choices.participant_count > 0:
+        lower, upper = confidence_intervals(
+            bootstrap_scores(choices, bootstrap_replicates, prior, processes, seed), confidence
+        )
+    table = []
+    for rank, index in enumerate(np.argsort(-scores), start=1):
+        table.append(
+            {
+                "rank": rank,
+                "video_id": choices.video_ids[index],
+                "exposures": int(exposures[index]),
+                "wins": int(total_wins[index]),
+                "win_rate": round(total_wins[index] / exposures[index], 4)
+                if exposures[index]
+                else "",
+                "score": round(float(scores[index]), 4),
+                "ci_lower": round(float(lower[index]), 4),
+                "ci_upper": round(float(upper[index]), 4),
+            }
+        )
+    return table
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--input", type=Path, help="saved REDCap export (CSV or JSON)")
+    parser.add_argument("--output", type=Path, default=SCORES_FILE_PATH)
+    parser.add_argument("--matrix-output", type=Path, help="also save the win matrix as CSV")
+    parser.add_argument("--bootstrap", type=int, default=DEFAULT_BOOTSTRAP_REPLICATES)
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE)
+    parser.add_argument("--prior", type=float, default=DEFAULT_PRIOR)
+    parser.add_argument("--processes", type=int, help="default: one per CPU")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    video_ids = list(mindlib.json_to_dict(VIDEOS_FILE_PATH).keys())
+    rows = read_export_file(args.input) if args.input else export_screen_events()
+    choices = load_choices(rows, video_ids)
+    print(
+        f"* Loaded {len(choices.winners)} choices by {choices.participant_count} participant(s) "
+        f"({time.perf_counter() - start_time:.1f}s)"
+    )
+    if len(choices.winners) == 0:
+        print("***** No completed screens to analyze")
+        return 1
+
+    table = score_table(
+        choices, args.bootstrap, args.prior, args.processes, args.confidence, args.seed
+    )
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=list(table[0].keys()))
+        writer.writeheader()
+        writer.writerows(table)
+    if args.matrix_output:
+        wins = win_matrix(choices.winners, choices.losers, len(video_ids))
+        with open(args.matrix_output, "w", newline="") as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(["winner \\ loser"] + video_ids)
+            for video_id, row in zip(video_ids, wins.astype(int).tolist()):
+                writer.writerow([video_id] + row)
+    for row in table:
+        print(
+            f"{row['rank']:3}. {row['video_id']:25} score {row['score']:+.3f} "
+            f"[{row['ci_lower']:+.3f}, {row['ci_upper']:+.3f}]  "
+            f"picked {row['wins']}/{row['exposures']}"
+        )
+    print(f"* Wrote {args.output} in {time.perf_counter() - start_time:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
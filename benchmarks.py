@@ -0,0 +1,354 @@
+"""Micro-benchmarks for the pure-Python code that runs on every participant request.
+
+Usage:
+    python benchmarks.py                # run and compare against the saved baseline
+    python benchmarks.py --save         # run and save the results as the new baseline
+    python benchmarks.py --only sanitize_key transform_logs
+
+Like the app itself, this needs `secrets.json` and the access key CSV to be present because
+`flask_site` and `main` are imported. No REDCap calls are made.
+Exits with status 1 if any benchmark is slower than its baseline by more than `--threshold`.
+"""
+
+import argparse
+import csv
+import json
+import random
+import string
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+import flask_site
+import main
+import mindlib
+import redcap_helpers
+import reminder_targets
+
+BASELINE_FILE_PATH = Path(flask_site.PATH_TO_THIS_FOLDER, "bench_baseline.json")
+
+# A result is a regression if it's this many times slower than the baseline
+DEFAULT_REGRESSION_THRESHOLD = 1.25
+
+ID_MAPPING_SIZES = [10_000, 100_000, 1_000_000]
+
+
+################################
+############ INPUTS ############
+
+
+def _random_key(length: int = flask_site.EXPECTED_HASHED_ID_LENGTH) -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=length))
+
+
+def _write_id_csv(path: Path, rows: int) -> None:
+    with open(path, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(["record_id", "access_key"])
+        for record_id in range(rows):
+            writer.writerow([record_id, _random_key()])
+
+
+def _vimeo_log(entries: int, scrubbing: bool = False) -> list[dict]:
+    """Builds a list of log events shaped like the ones `static/app.js` sends."""
+    log = []
+    for i in range(entries):
+        if scrubbing:
+            # Dragging the playback bar back and forth creates a seek event every few milliseconds
+            event_type = "SEEKED AHEAD TO" if i % 2 else "SEEKED BEHIND TO"
+        else:
+            event_type = random.choice(["PLAYED AT", "PAUSED AT", "VOLUME CHANGED TO"])
+        log.append(
+            {
+                "tm": f"2023-11-20 18:{(i // 60) % 60:02d}:{i % 60:02d}.{i % 1000:03d}",
+                "type": event_type,
+                "data": f"{i * 0.137:.3f}sec/{(i % 1000) / 10:.1f}%",
+            }
+        )
+    return log
+
+
+def _screen_events(completed_screens: int) -> list[dict]:
+    """Builds a REDCap export like the one parsed by `get_most_recent_screen()`."""
+    video_ids = list(flask_site.VIDEOS.keys())
+    result = []
+    for screen in range(1, flask_site.MAX_SCREENS + 1):
+        result.append(
+            {
+                "access_key": "abcdefghijkl",
+                "redcap_event_name": f"screen{screen}_arm_1",
+                "video_a": video_ids[(2 * screen - 2) % len(video_ids)],
+                "video_b": video_ids[(2 * screen - 1) % len(video_ids)],
+                "video_complete": "2" if screen <= completed_screens else "0",
+            }
+        )
+    return result
+
+
+################################
+########## BENCHMARKS ##########
+
+
+def _time(func, repeat: int = 5) -> float:
+    """Returns the best per-call time of `func` in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench_sanitize_key() -> dict[str, float]:
+    valid_key = _random_key()
+    return {
+        "sanitize_key[valid]": _time(lambda: flask_site.sanitize_key(valid_key)),
+        "sanitize_key[encoded]": _time(lambda: flask_site.sanitize_key(f"%20{valid_key}%20")),
+        "sanitize_key[suspicious]": _time(lambda: flask_site.sanitize_key("abc;def<ghi>")),
+        "sanitize_key[too_long]": _time(lambda: flask_site.sanitize_key("x" * 4096)),
+    }
+
+
+def bench_create_id_mappings() -> dict[str, float]:
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for rows in ID_MAPPING_SIZES:
+            id_file = Path(temp_dir, f"ids_{rows}.csv")
+            _write_id_csv(id_file, rows)
+            results[f"create_id_mappings[{rows}]"] = _time(
+                lambda: flask_site.create_id_mappings(id_file), repeat=3
+            )
+    return results
+
+
+def bench_transform_logs() -> dict[str, float]:
+    realistic = _vimeo_log(40)
+    pathological = _vimeo_log(20_000, scrubbing=True)
+    return {
+        "transform_logs[realistic]": _time(lambda: main.transform_logs(realistic)),
+        "transform_logs[pathological]": _time(lambda: main.transform_logs(pathological)),
+    }
+
+
+def bench_get_screen_number() -> dict[str, float]:
+    return {
+        "_get_screen_number[valid]": _time(
+            lambda: redcap_helpers._get_screen_number("screen7_arm_1")
+        ),
+        "_get_screen_number[invalid]": _time(
+            lambda: redcap_helpers._get_screen_number("outroscreen_arm_1")
+        ),
+    }
+
+
+def bench_parse_most_recent_screen() -> dict[str, float]:
+    fresh = _screen_events(0)
+    halfway = _screen_events(flask_site.MAX_SCREENS // 2)
+    return {
+        "parse_most_recent_screen[fresh]": _time(
+            lambda: redcap_helpers.parse_most_recent_screen(
+                fresh, flask_site.MAX_SCREENS, include_video_ids=True
+            )
+        ),
+        "parse_most_recent_screen[halfway]": _time(
+            lambda: redcap_helpers.parse_most_recent_screen(
+                halfway, flask_site.MAX_SCREENS, include_video_ids=True
+            )
+        ),
+    }
+
+
+def _progress_export(participants: int) -> list[dict]:
+    """Builds a project-wide export of `reminder_targets.PROGRESS_FIELDS`, with participants spread
+    across every funnel stage.
+    """
+    rows = []
+    for participant in range(participants):
+        access_key = f"{participant:012d}"
+        completed_screens = participant % (flask_site.MAX_SCREENS + 2)
+        rows.append(
+            {
+                "access_key": access_key,
+                "redcap_event_name": "start_arm_1",
+                "survey_tm_start": "2023-11-20 18:00:00",
+                "skipped": "1" if participant % 50 == 0 else "",
+            }
+        )
+        rows.append(
+            {
+                "access_key": access_key,
+                "redcap_event_name": flask_site.INTRO_REDCAP_EVENT,
+                "single_video_complete": "2" if completed_screens > 0 else "",
+            }
+        )
+        for screen in range(1, flask_site.MAX_SCREENS + 1):
+            rows.append(
+                {
+                    "access_key": access_key,
+                    "redcap_event_name": f"screen{screen}_arm_1",
+                    "video_complete": "2" if screen <= completed_screens else "",
+                }
+            )
+        rows.append(
+            {
+                "access_key": access_key,
+                "redcap_event_name": "outroscreen_arm_1",
+                "outro_complete": "2" if completed_screens > flask_site.MAX_SCREENS else "",
+            }
+        )
+    return rows
+
+
+def bench_funnel_stages() -> dict[str, float]:
+    export = _progress_export(10_000)
+    return {
+        "funnel_stages[10000]": _time(
+            lambda: reminder_targets.funnel_stages(export, flask_site.MAX_SCREENS), repeat=3
+        ),
+    }
+
+
+def bench_json_to_dict() -> dict[str, float]:
+    return {
+        "json_to_dict[videos.json]": _time(
+            lambda: mindlib.json_to_dict(flask_site.VIDEOS_FILE_PATH)
+        ),
+    }
+
+
+def bench_render_template() -> dict[str, float]:
+    video_ids = list(flask_site.VIDEOS.keys())
+    pages = {
+        "index": ("/", "index.html", {}),
+        "index_error": (
+            "/",
+            "index.html",
+            {"error_message": flask_site.BUBBLE_MESSAGES["bad_key"]},
+        ),
+        "intro": ("/intro", "intro.html", {"key": "abcdefghijkl"}),
+        "videos": (
+            "/videos",
+            "videos.html",
+            {
+                "screen": 1,
+                "max_screens": flask_site.MAX_SCREENS,
+                "vid_a_position": 1,
+                "vid_a_id": video_ids[0],
+                "vid_a_url": flask_site.VIDEOS[video_ids[0]],
+                "vid_b_position": 2,
+                "vid_b_id": video_ids[1],
+                "vid_b_url": flask_site.VIDEOS[video_ids[1]],
+                "next_vid_a_url": flask_site.VIDEOS[video_ids[2]],
+                "next_vid_b_url": flask_site.VIDEOS[video_ids[3]],
+                "preconnect_origins": flask_site.VIMEO_ORIGINS,
+            },
+        ),
+        "outro": (
+            "/outro",
+            "outro.html",
+            {
+                "max_screens": flask_site.MAX_SCREENS,
+                "questions": [f"Question {i}" for i in range(10)],
+                "agree_choices": [f"Choice {i}" for i in range(5)],
+                "final_question_choices": [f"Choice {i}" for i in range(5)],
+            },
+        ),
+        "thankyou": ("/thankyou", "thankyou.html", {}),
+        "404": ("/missing", "404.html", {}),
+    }
+    results = {}
+    for page_name, (path, template_name, context) in pages.items():
+        with flask_site.flask_app.test_request_context(path):
+            # Compiled templates are cached by Jinja, so render once before timing
+            flask_site.render_template(template_name, **context)
+            results[f"render_template[{page_name}]"] = _time(
+                lambda: flask_site.render_template(template_name, **context)
+            )
+    with flask_site.flask_app.test_request_context("/videos"):
+        video_page = (1, video_ids[0], video_ids[1], video_ids[2:4])
+        flask_site.render_videos_page(*video_page)
+        results["render_videos_page[cached]"] = _time(
+            lambda: flask_site.render_videos_page(*video_page)
+        )
+    return results
+
+
+BENCHMARKS = {
+    "sanitize_key": bench_sanitize_key,
+    "create_id_mappings": bench_create_id_mappings,
+    "transform_logs": bench_transform_logs,
+    "_get_screen_number": bench_get_screen_number,
+    "get_most_recent_screen": bench_parse_most_recent_screen,
+    "funnel_stages": bench_funnel_stages,
+    "json_to_dict": bench_json_to_dict,
+    "render_template": bench_render_template,
+}
+
+
+################################
+########### REPORTING ##########
+
+
+def _format_time(seconds: float) -> str:
+    if seconds < 1e-6:
+        return f"{seconds * 1e9:8.1f} ns"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:8.2f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:8.2f} ms"
+    return f"{seconds:8.3f} s "
+
+
+def compare_to_baseline(
+    results: dict[str, float], baseline: dict[str, float], threshold: float
+) -> list[str]:
+    """Prints each result next to its baseline. Returns the names of benchmarks that regressed."""
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            print(f"{name:45} {_format_time(seconds)}   (no baseline)")
+            continue
+        ratio = seconds / baseline[name]
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        print(f"{name:45} {_format_time(seconds)}   {ratio:5.2f}x baseline{flag}")
+    return regressions
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save these results as the new baseline"
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE_PATH)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS.keys(), default=BENCHMARKS.keys())
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = {}
+    for benchmark_name in args.only:
+        print(f"* Running {benchmark_name}....")
+        results.update(BENCHMARKS[benchmark_name]())
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = mindlib.json_to_dict(args.baseline)
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as outfile:
+            json.dump(baseline, outfile, indent=4, sort_keys=True)
+        print(f"* Saved {len(results)} result(s) to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"***** {len(regressions)} benchmark(s) regressed by more than {args.threshold}x")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,108 @@
+"""Downloads a poster frame and metadata for every video in `content/videos.json`.
+
+Usage:
+    python build_video_posters.py            # fetch posters that haven't been downloaded yet
+    python build_video_posters.py --force    # fetch every poster again
+
+Run this whenever `videos.json` changes, and commit/deploy the results.
+Posters are saved to `static/posters/<Vimeo video ID>.jpg`, and `static/posters/posters.json` maps each
+video ID in `videos.json` to its poster, duration and size. The video pages use these to show a
+lightweight placeholder ("facade") for each video and only load the Vimeo player when the participant
+clicks it; videos without a poster get a player straight away, like before.
+Uses Vimeo's public oEmbed API, so no Vimeo credentials are needed.
+"""
+
+import argparse
+import json
+import sys
+import urllib.parse
+from pathlib import Path
+
+import requests
+
+import mindlib
+
+PATH_TO_THIS_FOLDER = Path(__file__).resolve().parent
+VIDEOS_FILE_PATH = Path(PATH_TO_THIS_FOLDER, "content", "videos.json")
+POSTERS_FOLDER = Path(PATH_TO_THIS_FOLDER, "static", "posters")
+POSTERS_MANIFEST_PATH = Path(POSTERS_FOLDER, "posters.json")
+
+VIMEO_OEMBED_URL = "https://vimeo.com/api/oembed.json"
+
+# Width (in pixels) of the poster frames to request; about as wide as a video is shown on desktops
+POSTER_WIDTH = 960
+
+REQUEST_TIMEOUT_SECONDS = 30
+
+
+def vimeo_video_id(player_url: str) -> str:
+    """Returns the numeric video ID in a player URL like "https://player.vimeo.com/video/884589722?h=..."."""
+    return urllib.parse.urlparse(player_url).path.rstrip("/").split("/")[-1]
+
+
+def fetch_oembed(session: requests.Session, player_url: str) -> dict:
+    r = session.get(
+        VIMEO_OEMBED_URL,
+        params={"url": player_url, "width": POSTER_WIDTH},
+        timeout=REQUEST_TIMEOUT_SECONDS,
+    )
+    r.raise_for_status()
+    return r.json()
+
+
+def build_posters(force: bool = False) -> int:
+    """Downloads missing posters and rewrites the manifest. Returns the number of videos that failed."""
+    videos = mindlib.json_to_dict(VIDEOS_FILE_PATH)
+    POSTERS_FOLDER.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    if POSTERS_MANIFEST_PATH.exists() and not force:
+        manifest = mindlib.json_to_dict(POSTERS_MANIFEST_PATH)
+
+    failures = 0
+    session = requests.Session()
+    new_manifest = {}
+    for video_id, player_url in videos.items():
+        poster_file_name = f"{vimeo_video_id(player_url)}.jpg"
+        existing = manifest.get(video_id, {})
+        if (
+            existing.get("url") == player_url
+            and Path(POSTERS_FOLDER, existing.get("poster", "")).is_file()
+        ):
+            new_manifest[video_id] = existing
+            continue
+        try:
+            oembed = fetch_oembed(session, player_url)
+            r = session.get(oembed["thumbnail_url"], timeout=REQUEST_TIMEOUT_SECONDS)
+            r.raise_for_status()
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"* Couldn't get a poster for '{video_id}' ({player_url}): {repr(e)}")
+            failures += 1
+            continue
+        with open(Path(POSTERS_FOLDER, poster_file_name), "wb") as outfile:
+            outfile.write(r.content)
+        new_manifest[video_id] = {
+            "url": player_url,
+            "poster": poster_file_name,
+            "duration": oembed.get("duration", 0),
+            "width": oembed.get("thumbnail_width", 0),
+            "height": oembed.get("thumbnail_height", 0),
+        }
+        print(f"* Saved poster for '{video_id}' ({new_manifest[video_id]['duration']}s)")
+
+    with open(POSTERS_MANIFEST_PATH, "w") as outfile:
+        json.dump(new_manifest, outfile, indent=4)
+    print(f"* {len(new_manifest)} of {len(videos)} video(s) have posters in {POSTERS_FOLDER}")
+    return failures
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--force", action="store_true", help="download every poster again")
+    args = parser.parse_args()
+    return 1 if build_posters(force=args.force) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,410 @@
+"""Sends the reminder email (`content/reminder_email.html`) to many participants at once.
+
+Usage:
+    python bulk_mailer.py recipients.csv                  # send to every row that hasn't been sent yet
+    python bulk_mailer.py recipients.csv --dry-run        # render every message, send nothing
+    python bulk_mailer.py recipients.csv --smtp-host localhost --smtp-port 1025 --no-ssl
+
+`recipients.csv` needs an "email" and an "access_key" column (e.g. made by reminder_targets.py).
+SMTP settings come from `secrets.json` ("MAIL_SMTP_SERVER_ADDR", "MAIL_C2C_NOREPLY_ADDR",
+"MAIL_C2C_NOREPLY_DISPLAY_NAME", "MAIL_C2C_NOREPLY_PASS"); the command line options override them.
+
+Unlike `unused_emails.send_mail()`, which connects and logs in for every message and renders the
+template from scratch each time:
+* The template is compiled once, and its plain text version is derived once and reused
+* A small pool of logged-in SMTP connections is shared by a bounded number of sending threads
+* Each connection sends at most `--rate` messages per second, and is replaced after
+  `MAX_MESSAGES_PER_CONNECTION` messages (many servers cap how much one session may send)
+* Every attempt is appended to a send log (JSONL); running the same command again skips recipients
+  that were already sent to, so an interrupted or partly failed run can just be restarted
+
+To try it without sending real email, point it at any local SMTP server that accepts everything, e.g.
+`python -m aiosmtpd -n -l localhost:1025` (needs `pip install aiosmtpd`), with `--no-ssl`.
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import queue
+import re
+import smtplib
+import ssl
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.headerregistry import Address
+from email.message import EmailMessage
+from pathlib import Path
+
+import html2text
+from jinja2 import Template
+
+import mindlib
+import unused_emails
+
+PATH_TO_THIS_FOLDER = Path(__file__).resolve().parent
+SECRETS_FILE_PATH = Path(PATH_TO_THIS_FOLDER, "secrets.json")
+SEND_LOG_PATH = Path(PATH_TO_THIS_FOLDER, "state", "bulk_mailer_log.jsonl")
+
+# Connections (and sending threads); most providers allow only a handful of sessions per account
+DEFAULT_POOL_SIZE = 4
+
+# Messages per second, per connection
+DEFAULT_MESSAGES_PER_SECOND = 2.0
+
+MAX_MESSAGES_PER_CONNECTION = 100
+
+SMTP_TIMEOUT_SECONDS = 30
+
+# Attempts per message; only connection problems are retried, rejected recipients aren't
+MAX_ATTEMPTS = 3
+
+SENT = "sent"
+FAILED = "failed"
+
+# Errors after which the connection can't be trusted, but the message may go through on a new one
+TRANSIENT_SMTP_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError,
+    ConnectionError,
+    TimeoutError,
+    ssl.SSLError,
+)
+
+# Values that html2text passes through unchanged, so they can be substituted into the cached plain text.
+# No hyphens: lines may be wrapped after them.
+PLAIN_TEXT_SAFE_VALUE_REGEX = re.compile(r"[A-Za-z0-9@._+]*")
+
+
+################################
+########### MESSAGES ###########
+
+
+class MessageRenderer:
+    """Renders the reminder email for one recipient at a time, from a template compiled once.
+
+    The plain text version is made by converting the HTML with html2text, which is by far the slowest
+    step. Because html2text wraps lines, its output only depends on the lengths of the values in the
+    template, as long as the values contain no spaces or Markdown. So it's converted once per
+    combination of value lengths, with same-length placeholders in place of the values, and each
+    message only substitutes its own values into the cached text. Values that html2text might change
+    (anything outside `PLAIN_TEXT_SAFE_VALUE_REGEX`) get a full conversion instead.
+    """
+
+    # Placeholder for a value of length n: the first n characters, repeated as needed.
+    # No two share a letter, so one placeholder can't turn up inside another.
+    PLACEHOLDER_PATTERNS = {"user_email_addr": "QZ", "key": "JX"}
+
+    def __init__(
+        self,
+        template_path: Path = unused_emails.EMAIL_TEMPLATE_PATH,
+        subject: str = unused_emails.EMAIL_SUBJECT,
+    ):
+        self.subject = subject
+        with open(template_path) as infile:
+            self.template = Template(infile.read())
+        # (value lengths) -> (placeholders, plain text with placeholders), or None if it can't be reused
+        self._plaintext_cache: dict[tuple[int, ...], tuple[dict[str, str], str] | None] = {}
+        self._lock = threading.Lock()
+
+    def _to_plaintext(self, html_message: str) -> str:
+        # Same conversion as unused_emails.construct_message_contents()
+        parser = html2text.HTML2Text()
+        parser.ignore_emphasis = True
+        parser.ignore_links = True
+        return f"Subject: {self.subject}\n\n{parser.handle(html_message)}"
+
+    def _cached_plaintext(self, data: dict[str, str]) -> tuple[dict[str, str], str] | None:
+        lengths = tuple(len(value) for value in data.values())
+        with self._lock:
+            if lengths in self._plaintext_cache:
+                return self._plaintext_cache[lengths]
+        placeholders = {
+            name: (self.PLACEHOLDER_PATTERNS[name] * len(value))[: len(value)]
+            for name, value in data.items()
+        }
+        entry = (placeholders, self._to_plaintext(self.template.render(placeholders)))
+        # Only reuse the text if substituting into it gives exactly what a full conversion does
+        sample = {name: "x" * len(value) for name, value in data.items()}
+        if len(min(data.values(), key=len)) < 3 or self._substitute(
+            entry, sample
+        ) != self._to_plaintext(self.template.render(sample)):
+            entry = None
+        with self._lock:
+            self._plaintext_cache[lengths] = entry
+        return entry
+
+    @staticmethod
+    def _substitute(entry: tuple[dict[str, str], str], data: dict[str, str]) -> str:
+        placeholders, plaintext_message = entry
+        for name, placeholder in placeholders.items():
+            plaintext_message = plaintext_message.replace(placeholder, data[name])
+        return plaintext_message
+
+    def render(self, user_email_addr: str, key: str) -> tuple[str, str]:
+        """Returns (plain text, HTML), like `unused_emails.construct_message_contents()`."""
+        data = {"user_email_addr": user_email_addr, "key": key}
+        html_message = self.template.render(data)
+        entry = None
+        if all(PLAIN_TEXT_SAFE_VALUE_REGEX.fullmatch(value) for value in data.values()):
+            entry = self._cached_plaintext(data)
+        if entry is None:
+            return (self._to_plaintext(html_message), html_message)
+        return (self._substitute(entry, data), html_message)
+
+    def build_message(self, sender: Address, to_addr: str, key: str) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = sender
+        message["To"] = to_addr
+        message["Subject"] = self.subject
+        body_txt, body_html = self.render(to_addr, key)
+        message.set_content(body_txt)
+        message.add_alternative(body_html, subtype="html")
+        return message
+
+
+################################
+######### CONNECTIONS ##########
+
+
+class _PooledConnection:
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_sent_at = 0.0
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+
+class SMTPConnectionPool:
+    """Up to `size` logged-in SMTP connections, each used by one thread at a time."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int = unused_emails.PORT,
+        username: str = "",
+        password: str = "",
+        use_ssl: bool = True,
+        size: int = DEFAULT_POOL_SIZE,
+        messages_per_second: float = DEFAULT_MESSAGES_PER_SECOND,
+        max_messages_per_connection: int = MAX_MESSAGES_PER_CONNECTION,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.size = size
+        self.min_interval = 1 / messages_per_second if messages_per_second > 0 else 0
+        self.max_messages_per_connection = max_messages_per_connection
+        self.connections_opened = 0
+        self._idle: queue.LifoQueue[_PooledConnection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def _open(self) -> _PooledConnection:
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(
+                self.host,
+                self.port,
+                timeout=SMTP_TIMEOUT_SECONDS,
+                context=ssl.create_default_context(),
+            )
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT_SECONDS)
+        if self.username and self.password:
+            smtp.login(self.username, self.password)
+        with self._lock:
+            self.connections_opened += 1
+        return _PooledConnection(smtp)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lends out a connection. It's thrown away if the block raises, otherwise returned to the pool."""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+            try:
+                yield conn
+            except Exception:
+                conn.close()
+                raise
+            if conn.messages_sent >= self.max_messages_per_connection:
+                conn.close()
+            else:
+                self._idle.put(conn)
+
+    def send(self, message: EmailMessage) -> None:
+        """Sends a message, retrying on a new connection if the connection fails."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                with self.connection() as conn:
+                    wait_time = conn.last_sent_at + self.min_interval - time.monotonic()
+                    if wait_time > 0:
+                        time.sleep(wait_time)
+                    conn.last_sent_at = time.monotonic()
+                    conn.smtp.send_message(message)
+                    conn.messages_sent += 1
+                return
+            except TRANSIENT_SMTP_ERRORS:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                time.sleep(attempt)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+################################
+############ SENDING ###########
+
+
+def read_recipients(csv_path: Path) -> list[tuple[str, str]]:
+    """Returns (email, access key) pairs from a CSV with "email" and "access_key" columns."""
+    with open(csv_path, newline="") as infile:
+        return [
+            (row["email"].strip(), row["access_key"].strip())
+            for row in csv.DictReader(infile)
+            if row["email"].strip()
+        ]
+
+
+def already_sent(log_path: Path = SEND_LOG_PATH) -> set[str]:
+    """Returns the addresses that the send log says were sent to successfully."""
+    sent = set()
+    if not log_path.exists():
+        return sent
+    with open(log_path) as infile:
+        for line in infile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if entry.get("status") == SENT:
+                sent.add(entry["email"])
+    return sent
+
+
+def send_bulk(
+    recipients: list[tuple[str, str]],
+    pool: SMTPConnectionPool | None,
+    renderer: MessageRenderer,
+    sender: Address,
+    log_path: Path = SEND_LOG_PATH,
+) -> tuple[int, int]:
+    """Sends a message to every recipient that isn't in the send log as sent yet.
+    With no `pool`, messages are only rendered (a dry run) and nothing is logged.
+    Returns (sent, failed).
+    """
+    start_time = time.perf_counter()
+    skip = already_sent(log_path)
+    pending = [(email, key) for email, key in recipients if email not in skip]
+    print(f"* {len(recipients)} recipients, {len(recipients) - len(pending)} already sent to")
+    if pool is None:
+        for email, key in pending:
+            renderer.build_message(sender, email, key)
+        print(f"* Rendered {len(pending)} message(s) in {time.perf_counter() - start_time:.1f}s")
+        return (0, 0)
+
+    counts = {SENT: 0, FAILED: 0}
+    log_lock = threading.Lock()
+    # Keeps only a few messages per connection waiting, rather than rendering the whole list up front
+    in_flight = threading.BoundedSemaphore(2 * pool.size)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def send_one(log_file, email: str, key: str) -> None:
+        entry = {"email": email, "status": SENT}
+        try:
+            pool.send(renderer.build_message(sender, email, key))
+        except Exception as e:
+            entry = {"email": email, "status": FAILED, "error": repr(e)}
+        finally:
+            in_flight.release()
+        entry["tm"] = mindlib.timestamp_now()
+        with log_lock:
+            log_file.write(json.dumps(entry) + "\n")
+            log_file.flush()
+            counts[entry["status"]] += 1
+            done = counts[SENT] + counts[FAILED]
+            if entry["status"] == FAILED:
+                print(f"* Couldn't send to {email}: {entry['error']}")
+            if done % 100 == 0 or done == len(pending):
+                elapsed = time.perf_counter() - start_time
+                print(
+                    f"* {done}/{len(pending)} ({counts[FAILED]} failed, {elapsed:.1f}s, "
+                    f"{done / elapsed:.1f} messages/s)"
+                )
+
+    with open(log_path, "a") as log_file, ThreadPoolExecutor(max_workers=pool.size) as executor:
+        for email, key in pending:
+            in_flight.acquire()
+            executor.submit(send_one, log_file, email, key)
+    pool.close()
+    print(
+        f"* Done: {counts[SENT]} sent, {counts[FAILED]} failed, "
+        f"{pool.connections_opened} SMTP connection(s) opened; log is in {log_path}"
+    )
+    return (counts[SENT], counts[FAILED])
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("recipients", type=Path, help='CSV with "email" and "access_key" columns')
+    parser.add_argument("--smtp-host", help="default: MAIL_SMTP_SERVER_ADDR in secrets.json")
+    parser.add_argument("--smtp-port", type=int, default=unused_emails.PORT)
+    parser.add_argument("--no-ssl", action="store_true", help="plain SMTP (for a local server)")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=DEFAULT_MESSAGES_PER_SECOND,
+        help="messages per second, per connection (0 = unlimited)",
+    )
+    parser.add_argument("--log", type=Path, default=SEND_LOG_PATH, help="send log (JSONL)")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="render every message, send nothing"
+    )
+    args = parser.parse_args()
+
+    secrets = mindlib.json_to_dict(SECRETS_FILE_PATH) if SECRETS_FILE_PATH.exists() else {}
+    sender = unused_emails.construct_sender_address(
+        secrets.get("MAIL_C2C_NOREPLY_ADDR", "noreply@example.com"),
+        secrets.get("MAIL_C2C_NOREPLY_DISPLAY_NAME", ""),
+    )
+    pool = None
+    if not args.dry_run:
+        pool = SMTPConnectionPool(
+            args.smtp_host or secrets["MAIL_SMTP_SERVER_ADDR"],
+            args.smtp_port,
+            # A local server doesn't need (and usually doesn't support) logging in
+            username="" if args.no_ssl else secrets.get("MAIL_C2C_NOREPLY_ADDR", ""),
+            password="" if args.no_ssl else secrets.get("MAIL_C2C_NOREPLY_PASS", ""),
+            use_ssl=not args.no_ssl,
+            size=args.pool_size,
+            messages_per_second=args.rate,
+        )
+    _, failed = send_bulk(
+        read_recipients(args.recipients), pool, MessageRenderer(), sender, args.log
+    )
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
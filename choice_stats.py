@@ -0,0 +1,148 @@
+"""Live totals of the survey's video choices, for the monitoring dashboard (`/retention/dashboard`).
+
+Every video selection that's imported into REDCap is also counted here: per video, how many times it
+was shown and picked, and per screen, how many were completed and how long they took. Counts are
+added up in memory and flushed to the shared state database (`shared_state.py`) every
+`FLUSH_INTERVAL_SECONDS`, so the totals include every worker and survive restarts, without asking
+REDCap for anything.
+
+Screen durations are counted in `DURATION_BUCKET_SECONDS`-wide buckets, so medians can be worked out
+from totals that are simply added together across workers.
+"""
+
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import shared_state
+
+COUNTER_PREFIX = "choice_stats:"
+
+FLUSH_INTERVAL_SECONDS = 5
+
+DURATION_BUCKET_SECONDS = 5
+# Longer screens (e.g. a participant who left the tab open) are counted in the last bucket
+MAX_DURATION_SECONDS = 2 * 60 * 60
+
+# Format of the page's timestamps (see getUTCTimestampNow() in static/app.js)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def screen_duration_seconds(screen_time_start: str, screen_time_end: str) -> float | None:
+    """Returns the seconds between two of the page's timestamps, or None if they can't be parsed."""
+    try:
+        start = datetime.strptime(screen_time_start, TIMESTAMP_FORMAT)
+        end = datetime.strptime(screen_time_end, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+    seconds = (end - start).total_seconds()
+    return seconds if seconds >= 0 else None
+
+
+def median_from_buckets(buckets: dict[int, int]) -> float | None:
+    """Returns the median duration (the middle of its bucket) from bucket index -> count."""
+    total = sum(buckets.values())
+    if total == 0:
+        return None
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen * 2 >= total:
+            return (bucket + 0.5) * DURATION_BUCKET_SECONDS
+    return None
+
+
+class ChoiceStats:
+    def __init__(
+        self,
+        state: shared_state.SharedState,
+        flush_interval_seconds: float = FLUSH_INTERVAL_SECONDS,
+    ):
+        self.state = state
+        self.flush_interval_seconds = flush_interval_seconds
+        self._pending: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._flusher: threading.Thread | None = None
+
+    def record_screen(
+        self,
+        screen: int,
+        video_ids: tuple[str, str],
+        selected_video_id: str,
+        screen_time_start: str,
+        screen_time_end: str,
+    ) -> None:
+        """Counts one completed video screen."""
+        duration = screen_duration_seconds(screen_time_start, screen_time_end)
+        with self._lock:
+            for video_id in video_ids:
+                self._pending[f"exposures:{video_id}"] += 1
+            self._pending[f"wins:{selected_video_id}"] += 1
+            self._pending[f"screens:{screen}"] += 1
+            if duration is not None:
+                bucket = int(min(duration, MAX_DURATION_SECONDS) // DURATION_BUCKET_SECONDS)
+                self._pending[f"duration:{screen}:{bucket}"] += 1
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically, name="choice-stats-flush", daemon=True
+                )
+                self._flusher.start()
+
+    def flush(self) -> None:
+        """Adds the counts recorded since the last flush to the shared totals."""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return
+        try:
+            self.state.incr_many({COUNTER_PREFIX + name: count for name, count in pending.items()})
+        except Exception as e:
+            # Keep them for the next flush
+            with self._lock:
+                self._pending.update(pending)
+            print(f"***** Couldn't save choice stats: {repr(e)}")
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.flush_interval_seconds)
+            self.flush()
+
+    def totals(self) -> dict[str, int]:
+        """Returns the shared totals of every worker (as of their last flush)."""
+        return {
+            name[len(COUNTER_PREFIX) :]: value
+            for name, value in self.state.counters(COUNTER_PREFIX).items()
+        }
+
+
+def summarize(totals: dict[str, int], video_ids: list[str], max_screens: int) -> dict[str, dict]:
+    """Turns the totals into the dashboard's rows: one per video and one per screen, keyed by name."""
+    durations = {screen: {} for screen in range(1, max_screens + 1)}
+    for name, count in totals.items():
+        if name.startswith("duration:"):
+            _, screen, bucket = name.split(":")
+            if int(screen) in durations:
+                durations[int(screen)][int(bucket)] = count
+    rows = {}
+    for video_id in video_ids:
+        exposures = totals.get(f"exposures:{video_id}", 0)
+        wins = totals.get(f"wins:{video_id}", 0)
+        rows[f"video:{video_id}"] = {
+            "video_id": video_id,
+            "exposures": exposures,
+            "wins": wins,
+            "win_rate": round(wins / exposures, 3) if exposures else None,
+        }
+    for screen in range(1, max_screens + 1):
+        rows[f"screen:{screen}"] = {
+            "screen": screen,
+            "completed": totals.get(f"screens:{screen}", 0),
+            "median_seconds": median_from_buckets(durations[screen]),
+        }
+    return rows
+
+
+def changed_rows(previous: dict[str, dict], current: dict[str, dict]) -> dict[str, dict]:
+    """Returns the rows of `current` that are new or different from `previous`."""
+    return {name: row for name, row in current.items() if previous.get(name) != row}
@@ -0,0 +1,195 @@
+"""ASGI middleware that compresses text responses (HTML pages, JSON, CSS, JS) with Brotli or gzip.
+
+Brotli is used when the `brotli` package is installed and the browser accepts it; otherwise gzip.
+Responses that already have a Content-Encoding (e.g. pages from `render_cache` that were gzipped when
+they were cached) are passed through untouched, so nothing is compressed twice.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only these media types are compressed; images and videos are already compressed
+COMPRESSIBLE_CONTENT_TYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/csv",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+}
+
+# Responses smaller than this (in bytes) aren't worth the CPU time; most fit in a single packet anyway
+MINIMUM_SIZE = 500
+
+# Mid-range levels: most of the size reduction of the highest levels at a fraction of the CPU cost
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def choose_encoding(
+    accept_encoding: str, available: tuple[str, ...] = ("br", "gzip")
+) -> str | None:
+    """Returns "br", "gzip", or None (don't compress) for an Accept-Encoding request header.
+    Only encodings in `available` are considered, e.g. ("gzip",) for a body that's already gzipped.
+    """
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0
+        if coding and quality > 0:
+            accepted.add(coding)
+    if brotli is not None and "br" in available and "br" in accepted:
+        return "br"
+    if "gzip" in available and "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+            self._zlib = None
+        else:
+            self._brotli = None
+            # wbits = 16 + MAX_WBITS: gzip container instead of raw zlib
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, finish: bool) -> bytes:
+        """Compresses `data`. Unless `finish`, the output is flushed so the browser can use it right away."""
+        if self._brotli is not None:
+            output = self._brotli.process(data)
+            return output + (self._brotli.finish() if finish else self._brotli.flush())
+        output = self._zlib.compress(data)
+        return output + self._zlib.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app,
+        minimum_size: int = MINIMUM_SIZE,
+        gzip_level: int = GZIP_LEVEL,
+        brotli_quality: int = BROTLI_QUALITY,
+        content_types: set[str] = COMPRESSIBLE_CONTENT_TYPES,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.content_types = content_types
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = choose_encoding(accept_encoding)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        await self.app(scope, receive, _CompressingSender(self, encoding, send).send)
+
+
+class _CompressingSender:
+    """Wraps a response's `send`. The start message is held back until enough of the body has arrived
+    to decide whether to compress it.
+    """
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start_message = None
+        self.buffer = b""
+        # None until decided, then True (compressing) or False (passing through)
+        self.compressing = None
+        self.compressor = None
+
+    def _is_compressible(self) -> bool:
+        if self.start_message["status"] in (204, 206, 304):
+            return False
+        headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in self.start_message["headers"]
+        }
+        if "content-encoding" in headers or "no-transform" in headers.get("cache-control", ""):
+            return False
+        media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        return media_type in self.middleware.content_types
+
+    async def send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.compressing is False:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressing:
+            await self._send(
+                {
+                    "type": "http.response.body",
+                    "body": self.compressor.compress(body, finish=not more_body),
+                    "more_body": more_body,
+                }
+            )
+            return
+
+        # Still deciding
+        if not self._is_compressible():
+            self.compressing = False
+            await self._send(self.start_message)
+            await self._send(message)
+            return
+        self.buffer += body
+        if more_body and len(self.buffer) < self.middleware.minimum_size:
+            return
+        if not more_body and len(self.buffer) < self.middleware.minimum_size:
+            self.compressing = False
+            await self._send(self.start_message)
+            await self._send({"type": "http.response.body", "body": self.buffer})
+            return
+
+        self.compressing = True
+        self.compressor = _Compressor(
+            self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality
+        )
+        compressed = self.compressor.compress(self.buffer, finish=not more_body)
+        self.buffer = b""
+        headers = [
+            (name, value)
+            for name, value in self.start_message["headers"]
+            if name.lower() not in (b"content-length", b"vary")
+        ]
+        vary = [
+            value.decode("latin-1")
+            for name, value in self.start_message["headers"]
+            if name.lower() == b"vary"
+        ]
+        headers.append((b"content-encoding", self.encoding.encode()))
+        if "accept-encoding" not in ", ".join(vary).lower():
+            vary.append("Accept-Encoding")
+        headers.append((b"vary", ", ".join(vary).encode("latin-1")))
+        if not more_body:
+            headers.append((b"content-length", str(len(compressed)).encode()))
+        await self._send(self.start_message | {"headers": headers})
+        await self._send(
+            {"type": "http.response.body", "body": compressed, "more_body": more_body}
+        )
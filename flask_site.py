@@ -1,15 +1,28 @@
 import csv
+import functools
+import hashlib
+import hmac
 import json
 import random
+import re
+import threading
+import time
 import urllib.parse
 from pathlib import Path
 
-from flask import Flask, redirect, render_template, request, url_for
+from flask import Flask, make_response, redirect, render_template, request, url_for
 
 # import emails
+import compression
 import logs
 import mindlib
+import rate_limit
 import redcap_helpers
+import redcap_replica
+import render_cache
+import session_tokens
+import shared_state
+import upload_ledger
 
 FLASK_APP_URL_PATH = "/retention/survey"
 
@@ -35,6 +48,7 @@ BUBBLE_MESSAGES = {
     "unknown": "Unknown error.",
     "incomplete_outro": "Please answer every question to proceed.",
     "no_start": "Please begin the survey by providing your access key.",
+    "too_many_attempts": "Too many invalid access keys were entered. Please wait a while and try again.",
 }
 
 # Total amount of screens in the survey
@@ -60,6 +74,67 @@ ID_FILE = Path(PATH_TO_THIS_FOLDER, "content", "c2cv3-ids-access-keys.csv")
 # Used to sanitize ID input
 SUSPICIOUS_CHARS = [";", ":", "&", '"', "'", "`", ">", "<", "{", "}", "|", ".", "%"]
 
+# A valid access key is exactly EXPECTED_HASHED_ID_LENGTH characters, none of which are whitespace or
+# SUSPICIOUS_CHARS. Compiled once so sanitize_key() only has to make a single pass over the key.
+ACCESS_KEY_REGEX = re.compile(
+    rf"[^\s{re.escape(''.join(SUSPICIOUS_CHARS))}]{{{EXPECTED_HASHED_ID_LENGTH}}}"
+)
+
+# Longest raw string worth URL-decoding: every character percent-encoded ("%XX") plus some padding
+MAX_RAW_KEY_LENGTH = 3 * EXPECTED_HASHED_ID_LENGTH + 16
+
+# Seconds that a worker holds the claim on creating a new participant's REDCap record, so concurrent
+# requests for the same key (double-clicks, multiple tabs, other workers) don't create it twice
+NEW_RECORD_CLAIM_SECONDS = 10 * 60
+
+# Shared by every worker process; see shared_state.py
+SHARED_STATE = shared_state.SharedState()
+
+# Which participants' screens (and intro video) already have data in REDCap; see upload_ledger.py
+UPLOAD_LEDGER = upload_ledger.UploadLedger()
+
+INTRO_REDCAP_EVENT = "introscreen_arm_1"
+
+# Signed cookie carrying a participant's assigned videos and last completed screen (see session_tokens.py)
+# Lets videos() skip REDCap; REDCap is used whenever the cookie is missing, stale or tampered with
+PROGRESS_COOKIE_NAME = "c2c_progress"
+# While it's valid, the cookie takes precedence over REDCap. Its age counts from when REDCap was last
+# asked (advancing it after an upload keeps that time), so a record that's reset or reprovisioned in
+# REDCap is noticed within this long; about one sitting of the survey.
+PROGRESS_TOKEN_MAX_AGE_SECONDS = 60 * 60
+
+STATIC_FOLDER_PATH = Path(PATH_TO_THIS_FOLDER, "static")
+
+# Poster frames and durations of the videos, made by build_video_posters.py. Videos with a poster are
+# shown as a lightweight placeholder until clicked, instead of loading a Vimeo player right away.
+VIDEO_POSTERS_FILE_PATH = Path(STATIC_FOLDER_PATH, "posters", "posters.json")
+
+# Rendered videos.html pages, keyed by (screen, video A ID, video B ID, next screen's video IDs).
+# Only pairs that were actually assigned ever get rendered, so this rarely evicts anything.
+# Emptied whenever a template, videos.json or a static file (whose version is in the page's URLs, see
+# static_file_versions()) changes.
+VIDEOS_PAGE_CACHE = render_cache.RenderCache(
+    max_entries=2048,
+    watched_paths=[
+        Path(PATH_TO_THIS_FOLDER, "templates"),
+        VIDEOS_FILE_PATH,
+        STATIC_FOLDER_PATH,
+    ],
+)
+
+# Origins the Vimeo players load from. Video pages ask the browser to connect to these early, and
+# app.js prefetches the next screen's players once the participant has picked a video.
+VIMEO_ORIGINS = [
+    "https://player.vimeo.com",
+    "https://vimeo.com",  # oEmbed lookups made by the player API
+    "https://i.vimeocdn.com",
+    "https://f.vimeocdn.com",
+]
+
+# Static files that the service worker (templates/sw.js) downloads when it's installed
+# Source maps are only needed by developer tools, and posters are cached the first time they're shown
+SERVICE_WORKER_PRECACHE_EXCLUDED = ["*.map", "posters/*"]
+
 flask_app = Flask(__name__)
 # flask_app.config["APPLICATION_ROOT"] = URL_PREFIX
 flask_app.config.from_file("secrets.json", load=json.load)  # JSON keys must be in ALL CAPS
@@ -70,50 +145,77 @@ flask_app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
 ############ HELPERS ###########
 
 
-def create_id_mapping(id_file: Path = ID_FILE, reversed: bool = False) -> dict[str:str]:
-    """Returns a dict that maps access keys (hashed C2C IDs) to their corresponding original C2C IDs.
-    If `reversed` == True, original C2C IDs will be mapped to their access keys.
-    IDs and access keys are stored in a local CSV file (`id_file`).
+def create_id_mappings(id_file: Path = ID_FILE) -> tuple[dict[str:str], dict[str:str]]:
+    """Returns a 2-tuple of dicts, both built in a single pass over `id_file`:
+    (access keys (hashed C2C IDs) -> their original C2C IDs, original C2C IDs -> their access keys)
+    IDs and access keys are stored in a local CSV file (`id_file`) with columns "record_id" and
+    "access_key".
     """
-    mapping = dict()
+    access_keys_to_c2c_ids = dict()
+    c2c_ids_to_access_keys = dict()
 
     with open(id_file) as infile:
         reader = csv.DictReader(infile)
+        if reader.fieldnames is None or not {"record_id", "access_key"} <= set(reader.fieldnames):
+            print(
+                f"***** Configure the IDs CSV '{id_file}' to contain columns 'record_id' and 'access_key'."
+            )
+            raise KeyError("access_key")
         for row in reader:
-            # print(row["record_id"], row["access_key"])
-            try:
-                if reversed:
-                    mapping[row["record_id"]] = row["access_key"]
-                else:
-                    mapping[row["access_key"]] = row["record_id"]
-            except KeyError as k:
-                print(
-                    f"***** Configure the IDs CSV '{id_file}' to contain columns 'record_id' and 'access_key'."
-                )
-                raise k
-    # print(mapping)
-    return mapping
+            access_keys_to_c2c_ids[row["access_key"]] = row["record_id"]
+            c2c_ids_to_access_keys[row["record_id"]] = row["access_key"]
+    return (access_keys_to_c2c_ids, c2c_ids_to_access_keys)
+
+
+# (access keys -> C2C IDs, C2C IDs -> access keys)
+# Built by load_id_mappings(): in the background after the server starts (see main.py) or on first use
+_id_mappings: tuple[dict[str:str], dict[str:str]] | None = None
+_id_mappings_lock = threading.Lock()
 
 
-ACCESS_KEYS_TO_C2C_IDS = create_id_mapping()
-C2C_IDS_TO_ACCESS_KEYS = create_id_mapping(reversed=True)
-print(f"* Loaded {len(ACCESS_KEYS_TO_C2C_IDS)} access keys from {ID_FILE}")
-print(f"* Loaded {len(C2C_IDS_TO_ACCESS_KEYS)} C2C IDs from {ID_FILE}")
-if len(C2C_IDS_TO_ACCESS_KEYS) == 0:
-    raise Exception("***** Mapping of C2C IDs to access keys has 0 entries.")
-if len(ACCESS_KEYS_TO_C2C_IDS) == 0:
-    raise Exception("***** Mapping of access keys to C2C IDs has 0 entries.")
+def load_id_mappings(id_file: Path = ID_FILE) -> None:
+    """Loads the access key <-> C2C ID mappings from `id_file` if they haven't been loaded yet."""
+    global _id_mappings
+    with _id_mappings_lock:
+        if _id_mappings is not None:
+            return
+        access_keys_to_c2c_ids, c2c_ids_to_access_keys = create_id_mappings(id_file)
+        print(f"* Loaded {len(access_keys_to_c2c_ids)} access keys from {id_file}")
+        print(f"* Loaded {len(c2c_ids_to_access_keys)} C2C IDs from {id_file}")
+        if len(c2c_ids_to_access_keys) == 0:
+            raise Exception("***** Mapping of C2C IDs to access keys has 0 entries.")
+        if len(access_keys_to_c2c_ids) == 0:
+            raise Exception("***** Mapping of access keys to C2C IDs has 0 entries.")
+        _id_mappings = (access_keys_to_c2c_ids, c2c_ids_to_access_keys)
+
+
+def access_keys_to_c2c_ids() -> dict[str:str]:
+    """Returns the mapping of access keys (hashed C2C IDs) to their original C2C IDs, loading it if needed."""
+    if _id_mappings is None:
+        load_id_mappings()
+    return _id_mappings[0]
+
+
+def c2c_ids_to_access_keys() -> dict[str:str]:
+    """Returns the mapping of original C2C IDs to their access keys, loading it if needed."""
+    if _id_mappings is None:
+        load_id_mappings()
+    return _id_mappings[1]
 
 
 def sanitize_key(key_from_html_string: str) -> str:
     """URL-decodes and sanitizes user-provided 'access keys' (intended to be hashed C2C IDs).
-    Returns an empty string if a string fails sanitization.
+    Returns the normalized key (decoded and stripped), or an empty string if a string fails sanitization.
     """
-    result = urllib.parse.unquote_plus(key_from_html_string).strip()
     # Hashed IDs MUST be of a pre-specified length - anything else is suspicious.
-    if len(result) == EXPECTED_HASHED_ID_LENGTH and not any(
-        [s in result for s in SUSPICIOUS_CHARS]
-    ):
+    # Reject oversized input before spending any time decoding it.
+    if len(key_from_html_string) > MAX_RAW_KEY_LENGTH:
+        return ""
+    result = key_from_html_string
+    if "%" in result or "+" in result:
+        result = urllib.parse.unquote_plus(result)
+    result = result.strip()
+    if ACCESS_KEY_REGEX.fullmatch(result):
         return result
     return ""
 
@@ -142,10 +244,10 @@ def sanitize_key(key_from_html_string: str) -> str:
 #         ):
 #             # User's email matches one found in the report
 #             c2c_id = record["record_id"]
-#             if c2c_id not in C2C_IDS_TO_ACCESS_KEYS:
+#             if c2c_id not in c2c_ids_to_access_keys():
 #                 print(f"[{user_submitted_email_address}] C2C ID {c2c_id} is not active")
 #                 return
-#             access_key_to_send = C2C_IDS_TO_ACCESS_KEYS[c2c_id]
+#             access_key_to_send = c2c_ids_to_access_keys()[c2c_id]
 #             if len(access_key_to_send) == 0:
 #                 print(
 #                     f"[{user_submitted_email_address}] C2C ID {c2c_id} is active, but doesn't have an access key for this experiment"
@@ -169,176 +271,532 @@ def get_user_agent() -> str:
     return request.headers.get("User-Agent")
 
 
-################################
-########### ENDPOINTS ##########
+def progress_token_secret() -> bytes:
+    """Key used to sign progress tokens. Set "SESSION_SECRET" in secrets.json to choose one; otherwise it's
+    derived from the REDCap API token so that every worker (and every restart) uses the same key.
+    """
+    if flask_app.config.get("SESSION_SECRET"):
+        return flask_app.config["SESSION_SECRET"].encode()
+    return hmac.new(
+        flask_app.config["C2C_DCV_API_TOKEN"].encode(), b"c2c-progress-token", hashlib.sha256
+    ).digest()
 
 
-@flask_app.route("/", methods=["GET"])
-def index():
-    if "error_code" in request.args and len(request.args["error_code"]) > 0:
-        error_code = request.args["error_code"]
-        if error_code not in BUBBLE_MESSAGES:
-            error_code = "unknown"
-        return render_template("index.html", error_message=BUBBLE_MESSAGES[error_code])
+def parse_progress_token(hashed_id: str, token: str) -> session_tokens.SurveyProgress | None:
+    """Returns the survey progress stored in `token` if it's valid and belongs to `hashed_id`."""
+    progress = session_tokens.read_progress_token(
+        progress_token_secret(), token, list(VIDEOS.keys()), PROGRESS_TOKEN_MAX_AGE_SECONDS
+    )
+    if progress is None or progress.access_key != hashed_id:
+        return None
+    if len(progress.video_ids) != MAX_VIDEOS:
+        return None
+    return progress
+
+
+def new_progress_token(
+    hashed_id: str,
+    survey_videos: list[str],
+    last_completed_screen: int,
+    issued_at: int | None = None,
+) -> str:
+    """Returns a progress token. `issued_at` is when this progress was last read from REDCap (now, if
+    not given); pass the old token's when only advancing it.
+    """
+    return session_tokens.issue_progress_token(
+        progress_token_secret(),
+        session_tokens.SurveyProgress(
+            hashed_id,
+            survey_videos,
+            last_completed_screen,
+            int(time.time()) if issued_at is None else issued_at,
+        ),
+        list(VIDEOS.keys()),
+    )
 
-    if "msg" in request.args and len(request.args["msg"]) > 0:
-        message_code = request.args["msg"]
-        if message_code not in BUBBLE_MESSAGES:
-            return render_template("index.html", error_message=BUBBLE_MESSAGES["unknown"])
-        return render_template("index.html", info_message=BUBBLE_MESSAGES[message_code])
 
-    # if "sent_email" in request.args and len(request.args["sent_email"]) > 0:
-    #     return render_template("email_sent.html")
+def progress_cookie_options() -> dict:
+    """Keyword arguments for `set_cookie()` (works with both Flask and FastAPI responses)."""
+    return {
+        "max_age": PROGRESS_TOKEN_MAX_AGE_SECONDS,
+        # Shared by the Flask pages and the FastAPI upload endpoints
+        "path": FLASK_APP_URL_PATH.rsplit("/", 1)[0],
+        "secure": flask_app.config.get("SESSION_COOKIE_SECURE", False),
+        "httponly": True,
+        "samesite": "Lax",
+    }
+
+
+def set_progress_cookie(
+    response, hashed_id: str, survey_videos: list[str], last_completed_screen: int
+):
+    """Attaches a fresh progress token to `response` if all of the participant's videos are known."""
+    if len(survey_videos) == MAX_VIDEOS and all(video_id in VIDEOS for video_id in survey_videos):
+        response.set_cookie(
+            PROGRESS_COOKIE_NAME,
+            new_progress_token(hashed_id, survey_videos, last_completed_screen),
+            **progress_cookie_options(),
+        )
+    return response
 
-    if "key" in request.args and len(request.args["key"]) > 0:
-        hashed_id = sanitize_key(request.args["key"])
-        if len(hashed_id) < 1:
-            print("This key failed sanitization:", request.args["key"])
-            return render_template("index.html", error_message=BUBBLE_MESSAGES["bad_key"])
 
-        if hashed_id not in ACCESS_KEYS_TO_C2C_IDS:
-            logs.write_log(
-                "access key not found",
-                hashed_id,
-                "index",
-            )
-            return render_template("index.html", error_message=BUBBLE_MESSAGES["bad_key"])
+def get_survey_progress_from_redcap(hashed_id: str) -> tuple[int, list[str]]:
+    """Returns a 2-tuple from a single REDCap export:
+    (the last screen the participant completed, all of their video IDs in screen order)
+    Videos that are missing from REDCap or from videos.json are returned as empty strings.
+    """
+    screen_events = redcap_helpers.export_video_ids(
+        flask_app.config["C2C_DCV_API_TOKEN"],
+        flask_app.config["REDCAP_API_URL"],
+        hashed_id,
+        MAX_SCREENS,
+    )
+    most_recent_completed_screen = redcap_helpers.parse_most_recent_screen(
+        screen_events, MAX_SCREENS
+    )
+    videos_by_screen = {}
+    for screen_form in screen_events:
+        screen = redcap_helpers._get_screen_number(screen_form.get("redcap_event_name", ""))
+        videos_by_screen[screen] = [screen_form.get("video_a", ""), screen_form.get("video_b", "")]
+    survey_videos = []
+    for screen in range(1, MAX_SCREENS + 1):
+        for video_id in videos_by_screen.get(screen, ["", ""]):
+            survey_videos.append(video_id if video_id in VIDEOS else "")
+    return (most_recent_completed_screen, survey_videos)
+
+
+def cached_page_response(page: render_cache.RenderedPage):
+    """Makes a response from a cached page, sending the gzipped copy if the browser accepts gzip."""
+    if compression.choose_encoding(request.headers.get("Accept-Encoding", ""), ("gzip",)):
+        response = make_response(page.gzipped_body)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = make_response(page.body)
+    response.headers["Content-Type"] = "text/html; charset=utf-8"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def load_video_posters() -> dict[str, dict]:
+    """Returns {video ID: {"poster": file name in static/posters, "duration": seconds, ...}} for every
+    video with an up-to-date poster, or an empty dict if build_video_posters.py hasn't been run.
+    """
+    if not VIDEO_POSTERS_FILE_PATH.is_file():
+        return {}
+    posters = mindlib.json_to_dict(VIDEO_POSTERS_FILE_PATH)
+    # Ignore posters made for a video's old URL
+    return {
+        video_id: poster
+        for video_id, poster in posters.items()
+        if video_id in VIDEOS and poster.get("url") == VIDEOS[video_id]
+    }
+
+
+def render_videos_page(
+    screen: int, vid_a_id: str, vid_b_id: str, next_screens_ids: list[str] | None = None
+) -> render_cache.RenderedPage:
+    """Returns videos.html for this screen and pair of videos, rendering it only if it isn't cached.
+    `next_screens_ids`, if given, are the next screen's videos, which the page hints to the browser.
+    """
+    if next_screens_ids is None or len(next_screens_ids) != 2 or not all(next_screens_ids):
+        next_screens_ids = []
+
+    def render() -> str:
+        # Only runs on a cache miss, so the posters file is read rarely
+        posters = load_video_posters()
+        context = {
+            "screen": screen,
+            "max_screens": MAX_SCREENS,
+            "preconnect_origins": VIMEO_ORIGINS,
+        }
+        for label, position, video_id in [
+            ("vid_a", (screen * 2) - 1, vid_a_id),
+            ("vid_b", screen * 2, vid_b_id),
+        ]:
+            context[f"{label}_position"] = position
+            context[f"{label}_id"] = video_id
+            context[f"{label}_url"] = VIDEOS[video_id]
+            context[f"{label}_poster"] = posters.get(video_id, {}).get("poster", "")
+            context[f"{label}_duration"] = posters.get(video_id, {}).get("duration", 0)
+        for label, video_id in zip(["next_vid_a", "next_vid_b"], next_screens_ids):
+            context[f"{label}_url"] = VIDEOS[video_id]
+            context[f"{label}_poster"] = posters.get(video_id, {}).get("poster", "")
+        return render_template("videos.html", **context)
+
+    # The page's links depend on where the app is mounted
+    cache_key = (request.script_root, screen, vid_a_id, vid_b_id, *next_screens_ids)
+    return VIDEOS_PAGE_CACHE.get_or_render(cache_key, render)
+
+
+def add_vimeo_link_headers(response):
+    """Lets the browser open connections to Vimeo while it's still parsing the page."""
+    for origin in VIMEO_ORIGINS:
+        response.headers.add("Link", f"<{origin}>; rel=preconnect")
+    return response
+
+
+# {file path: ((modification time, size), short hash of its contents)}, for static_file_versions()
+_static_file_hashes: dict[Path, tuple[tuple[int, int], str]] = {}
+_static_file_versions: dict[str, str] = {}
+_static_file_versions_checked_at = float("-inf")
+_static_file_versions_lock = threading.Lock()
+
+
+def static_file_versions() -> dict[str, str]:
+    """Returns {file name relative to static/: short hash of its contents} for every static file.
+    Static URLs include the hash (see add_static_file_version), so browsers and the service worker can
+    cache them indefinitely and still get new versions as soon as a file changes.
+    Like render_cache, files are checked for changes at most once a second, and only the ones whose
+    modification time or size changed are hashed again.
+    """
+    global _static_file_hashes, _static_file_versions, _static_file_versions_checked_at
+    with _static_file_versions_lock:
+        now = time.monotonic()
+        if now - _static_file_versions_checked_at < render_cache.MTIME_CHECK_INTERVAL_SECONDS:
+            return _static_file_versions
+        _static_file_versions_checked_at = now
+        hashes = {}
+        for path in sorted(STATIC_FOLDER_PATH.rglob("*")):
+            try:
+                if not path.is_file():
+                    continue
+                stat = path.stat()
+                signature = (stat.st_mtime_ns, stat.st_size)
+                cached = _static_file_hashes.get(path)
+                if cached is None or cached[0] != signature:
+                    cached = (signature, hashlib.sha256(path.read_bytes()).hexdigest()[:12])
+            except FileNotFoundError:
+                # Deleted while looking
+                continue
+            hashes[path] = cached
+        _static_file_hashes = hashes
+        _static_file_versions = {
+            path.relative_to(STATIC_FOLDER_PATH).as_posix(): version
+            for path, (_, version) in hashes.items()
+        }
+        return _static_file_versions
+
+
+@flask_app.url_defaults
+def add_static_file_version(endpoint: str, values: dict) -> None:
+    if endpoint == "static" and "v" not in values:
+        version = static_file_versions().get(values.get("filename", ""))
+        if version is not None:
+            values["v"] = version
+
+
+@functools.cache
+def load_outro_content() -> tuple[list[str], list[str], list[str]]:
+    """Returns the outro questionnaire's text as a 3-tuple of lists of lines:
+    (questions, choices for questions 1-9, choices for the final question)
+    Files are only read the first time this is called.
+    """
+    questions_path = Path(PATH_TO_THIS_FOLDER, "content", "q_questions.txt")
+    agree_choices_path = Path(PATH_TO_THIS_FOLDER, "content", "q_agree_choices.txt")
+    final_question_choices_path = Path(
+        PATH_TO_THIS_FOLDER, "content", "q_final_question_choices.txt"
+    )
+
+    with open(questions_path, "r") as questions_infile:
+        questions = [line.strip() for line in questions_infile.readlines()]
 
-        already_finished_survey = redcap_helpers.user_completed_survey(
+    with open(agree_choices_path, "r") as agree_choices_infile:
+        agree_choices = [line.strip() for line in agree_choices_infile.readlines()]
+
+    with open(final_question_choices_path, "r") as final_choices_infile:
+        final_question_choices = [line.strip() for line in final_choices_infile.readlines()]
+
+    return (questions, agree_choices, final_question_choices)
+
+
+def start_redcap_replica() -> None:
+    """Brings the local REDCap replica up to date, keeps it synced in the background,
+    and lets redcap_helpers read participant state from it."""
+    replica = redcap_replica.REDCapReplica(
+        flask_app.config["C2C_DCV_API_TOKEN"],
+        flask_app.config["REDCAP_API_URL"],
+        max_staleness_seconds=flask_app.config.get("REDCAP_REPLICA_MAX_STALENESS_SECONDS", 60),
+    )
+    row_count = replica.sync()
+    logs.write_log(f"REDCap replica has {row_count} new row(s)", src="warm_up")
+    replica.start_background_sync(claim=SHARED_STATE.claim)
+    redcap_helpers.use_replica(replica)
+
+
+def assign_survey_videos() -> list[str]:
+    """Picks a new participant's videos: MAX_VIDEOS distinct videos in random order, 2 per screen."""
+    # Shuffle all video keys, and save the first survey from the shuffled list
+    video_ids = list(VIDEOS.keys())
+    random.shuffle(video_ids)
+    return video_ids[0:MAX_VIDEOS]
+
+
+def new_participant_records(
+    hashed_id: str, survey_videos: list[str], start_time: str = "", user_agent: str = ""
+) -> list[dict]:
+    """Returns the REDCap rows that create a participant's record: their start event, plus one event
+    per screen with its pair of videos.
+    `start_time` and `user_agent` are left out when records are pre-provisioned (see provision_records.py);
+    start_survey() fills them in on the participant's first visit.
+    """
+    start_record = {
+        HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
+        "c2c_id": access_keys_to_c2c_ids()[hashed_id],
+    }
+    if start_time:
+        start_record["survey_tm_start"] = start_time
+    if user_agent:
+        start_record["user_agent"] = user_agent
+    records = [start_record]
+    survey_videos_index = 0
+    for screen in range(MAX_SCREENS):
+        screen_record = {
+            HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
+            "redcap_event_name": f"screen{screen + 1}_arm_1",
+            "video_a": survey_videos[survey_videos_index],
+            "video_b": survey_videos[survey_videos_index + 1],
+        }
+        records.append(screen_record)
+        survey_videos_index += 2
+    return records
+
+
+def too_many_bad_keys(valid_key: bool) -> bool:
+    """Makes guessing access keys impractical (see `rate_limit.check_bad_key_budget()`).
+    Returns True if this request should be refused. Call it on every page that looks up a key.
+    """
+    try:
+        wait_time = rate_limit.check_bad_key_budget(SHARED_STATE, request.remote_addr, valid_key)
+    except Exception as e:
+        # Like the middleware, don't turn participants away because the limiter is having problems
+        print(f"***** Rate limiter unavailable: {repr(e)}")
+        return False
+    return wait_time > 0
+
+
+def start_survey(raw_key: str, skip: bool = False):
+    """Works out where the participant with this access key should go next (creating their REDCap
+    record if they're new) and sends them straight there with a single redirect.
+    Their video assignments and progress go along in the progress cookie, so the next page doesn't have
+    to look them up in REDCap again.
+    Used by both index() (links containing "?key=") and check() (the access key form).
+    """
+    hashed_id = sanitize_key(raw_key)
+    if len(hashed_id) < 1:
+        print("This key failed sanitization:", raw_key)
+        return render_template("index.html", error_message=BUBBLE_MESSAGES["bad_key"])
+
+    valid_key = hashed_id in access_keys_to_c2c_ids()
+    if too_many_bad_keys(valid_key):
+        return (
+            render_template("index.html", error_message=BUBBLE_MESSAGES["too_many_attempts"]),
+            429,
+        )
+    if not valid_key:
+        logs.write_log(
+            "access key not found",
+            hashed_id,
+            "index",
+        )
+        return render_template("index.html", error_message=BUBBLE_MESSAGES["bad_key"])
+
+    survey_status = redcap_helpers.get_survey_status(
+        flask_app.config["C2C_DCV_API_TOKEN"],
+        flask_app.config["REDCAP_API_URL"],
+        hashed_id,
+    )
+    already_finished_survey = survey_status.completed
+
+    if skip and not already_finished_survey:
+        # First time user has skipped the survey:
+        skip_time = mindlib.timestamp_now()
+        skipped_record = [
+            {
+                HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
+                "c2c_id": access_keys_to_c2c_ids()[hashed_id],
+                "user_agent": get_user_agent(),
+                "survey_tm_end": skip_time,
+                "skipped": "1",
+                "basic_information_complete": "2",
+            }
+        ]
+        redcap_helpers.import_record(
             flask_app.config["C2C_DCV_API_TOKEN"],
             flask_app.config["REDCAP_API_URL"],
-            hashed_id,
+            skipped_record,
         )
+        logs.write_log("elected to skip the survey; imported REDCap data", hashed_id, "index")
+        return redirect(url_for("thankyou"), code=303)
 
-        if "skip" in request.args and request.args["skip"] == "1" and not already_finished_survey:
-            # First time user has skipped the survey:
-            skip_time = mindlib.timestamp_now()
-            skipped_record = [
-                {
-                    HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
-                    "c2c_id": ACCESS_KEYS_TO_C2C_IDS[hashed_id],
-                    "user_agent": get_user_agent(),
-                    "survey_tm_end": skip_time,
-                    "skipped": "1",
-                    "basic_information_complete": "2",
-                }
-            ]
+    if already_finished_survey:
+        logs.write_log("already finished survey", hashed_id, "index")
+        return redirect(url_for("thankyou"), code=303)
+
+    # One export gives both the participant's videos (if any were assigned) and their progress
+    most_recent_completed_screen_from_redcap, survey_videos = get_survey_progress_from_redcap(
+        hashed_id
+    )
+
+    already_started_survey = any(survey_videos)
+    logs.write_log(
+        f"already started survey? {already_started_survey} (have {sum(1 for v in survey_videos if v) // 2} existing video instruments)",
+        hashed_id,
+        "index",
+    )
+    if already_started_survey:
+        # The user has generated a set of videos already - they may have finished the survey already
+        # Got video data but the user hasn't finished the survey yet - don't assign any more videos
+        logs.write_log(
+            f"Experiment record (C2C ID {access_keys_to_c2c_ids()[hashed_id]}) already created with videos {survey_videos} and completed screen {most_recent_completed_screen_from_redcap}",
+            hashed_id,
+            "index",
+        )
+        if most_recent_completed_screen_from_redcap == MAX_SCREENS:
+            # If they completed the final screen, serve the completion message
+            return redirect(url_for("outro", key=hashed_id), code=303)
+        if not survey_status.survey_tm_start:
+            # Record was pre-provisioned by provision_records.py: this is the participant's first visit
+            logs.write_log("first visit to a pre-provisioned record", hashed_id, "index")
             redcap_helpers.import_record(
                 flask_app.config["C2C_DCV_API_TOKEN"],
                 flask_app.config["REDCAP_API_URL"],
-                skipped_record,
+                [
+                    {
+                        HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
+                        "survey_tm_start": mindlib.timestamp_now(),
+                        "user_agent": get_user_agent(),
+                    }
+                ],
             )
-            logs.write_log("elected to skip the survey; imported REDCap data", hashed_id, "index")
-            return redirect(url_for("thankyou"), code=301)
-
-        if already_finished_survey:
-            logs.write_log("already finished survey", hashed_id, "index")
-            return redirect(url_for("thankyou"), code=301)
-
-        existing_dcv_video_data = redcap_helpers.export_dcv_video_data(
-            flask_app.config["C2C_DCV_API_TOKEN"],
-            flask_app.config["REDCAP_API_URL"],
-            hashed_id,
-            MAX_SCREENS,
+        progress = (survey_videos, most_recent_completed_screen_from_redcap)
+        # Lets the upload endpoints skip asking REDCap whether a screen was already submitted
+        screen_events = [f"screen{screen}_arm_1" for screen in range(1, MAX_SCREENS + 1)]
+        completed_screens = most_recent_completed_screen_from_redcap
+        UPLOAD_LEDGER.mark(hashed_id, screen_events[:completed_screens], upload_ledger.RECORDED)
+        UPLOAD_LEDGER.mark(hashed_id, screen_events[completed_screens:], upload_ledger.EMPTY)
+    elif not SHARED_STATE.claim(f"new_record:{hashed_id}", NEW_RECORD_CLAIM_SECONDS):
+        # Another request (possibly in another worker) is already creating this participant's record
+        logs.write_log("record is already being created by another request", hashed_id, "index")
+        progress = ([], 0)
+    else:
+        # New survey participant
+        survey_videos = assign_survey_videos()
+
+        # Add the record to the experiment's REDCap project and start the experiment
+        new_record = new_participant_records(
+            hashed_id, survey_videos, mindlib.timestamp_now(), get_user_agent()
         )
 
-        # print(survey_record)
-
-        already_started_survey = len(existing_dcv_video_data) > 0
         logs.write_log(
-            f"already started survey? {already_started_survey} (have {len(existing_dcv_video_data)} existing video instruments)",
+            f"Creating NEW record (C2C ID {access_keys_to_c2c_ids()[hashed_id]}) with videos {survey_videos}",
             hashed_id,
             "index",
         )
-        if already_started_survey:
-            # The user has generated a set of videos already - they may have finished the survey already
-            # Got video data but the user hasn't finished the survey yet - don't assign any more videos
-            # print(existing_dcv_video_data)
-            survey_videos = []  # will be 2 x MAX_SCREENS number of videos
-            for r in existing_dcv_video_data:
-                existing_vid_a_id = r["video_a"]
-                existing_vid_b_id = r["video_b"]
-                if (
-                    len(existing_vid_a_id) > 0
-                    and existing_vid_a_id != UNDEFINED_VID_ID_PLACEHOLDER
-                    and len(existing_vid_b_id) > 0
-                    and existing_vid_b_id != UNDEFINED_VID_ID_PLACEHOLDER
-                    and len(survey_videos) < (MAX_VIDEOS)
-                ):
-                    survey_videos.append(r["video_a"])
-                    survey_videos.append(r["video_b"])
-            most_recent_completed_screen_from_redcap = redcap_helpers.get_most_recent_screen(
+        try:
+            redcap_helpers.import_record(
                 flask_app.config["C2C_DCV_API_TOKEN"],
                 flask_app.config["REDCAP_API_URL"],
-                hashed_id,
-                max_screens=MAX_SCREENS,
-            )
-            logs.write_log(
-                f"Experiment record (C2C ID {ACCESS_KEYS_TO_C2C_IDS[hashed_id]}) already created with videos {survey_videos} and completed screen {most_recent_completed_screen_from_redcap}",
-                hashed_id,
-                "index",
+                new_record,
             )
-            if most_recent_completed_screen_from_redcap == MAX_SCREENS:
-                # If they completed the final screen, serve the completion message
-                return redirect(url_for("outro", key=hashed_id), code=301)
-        else:
-            # New survey participant
-            # Shuffle all video keys, and save the first survey from the shuffled list
-            video_ids = list(VIDEOS.keys())
-            random.shuffle(video_ids)
-            survey_videos = video_ids[0:MAX_VIDEOS]
+        except Exception as e:
+            # Let the participant's next attempt create the record
+            SHARED_STATE.release(f"new_record:{hashed_id}")
+            raise e
+        progress = (survey_videos, 0)
+        # Nothing has been uploaded for a brand new participant
+        UPLOAD_LEDGER.mark(
+            hashed_id,
+            [INTRO_REDCAP_EVENT]
+            + [f"screen{screen}_arm_1" for screen in range(1, MAX_SCREENS + 1)],
+            upload_ledger.EMPTY,
+        )
 
-            start_time = mindlib.timestamp_now()
+        # return redirect(url_for("intro", key=hashed_id), code=303)
 
-            # Add the record to the experiment's REDCap project and start the experiment
-            new_record = [
-                {
-                    HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
-                    "c2c_id": ACCESS_KEYS_TO_C2C_IDS[hashed_id],
-                    "survey_tm_start": start_time,
-                    "user_agent": get_user_agent(),
-                },
-            ]
-            survey_videos_index = 0
-            for screen in range(MAX_SCREENS):
-                screen_record = {
-                    HASHED_ID_EXPERIMENT_REDCAP_VAR: hashed_id,
-                    "redcap_event_name": f"screen{screen + 1}_arm_1",
-                    "video_a": survey_videos[survey_videos_index],
-                    "video_b": survey_videos[survey_videos_index + 1],
-                }
-                new_record.append(screen_record)
-                survey_videos_index += 2
+    # return redirect(
+    #     url_for("videos", key=hashed_id, screen=most_recent_completed_screen_from_redcap + 1),
+    #     code=303,
+    # )
+    return set_progress_cookie(
+        redirect(url_for("intro", key=hashed_id), code=303), hashed_id, *progress
+    )
 
-            logs.write_log(
-                f"Creating NEW record (C2C ID {ACCESS_KEYS_TO_C2C_IDS[hashed_id]}) with videos {survey_videos}",
-                hashed_id,
-                "index",
+
+# Set by warm_up() once this worker is ready to serve participants without any cold starts
+WARMED_UP = threading.Event()
+
+# Seconds to wait between attempts to reach REDCap during warm_up()
+WARM_UP_RETRY_SECONDS = [1, 2, 5, 10, 30, 60]
+
+
+def warm_up() -> None:
+    """Prepares this worker for traffic and sets `WARMED_UP` when done:
+    loads the access key index and content, compiles every template, and opens pooled REDCap connections.
+    Retries REDCap until it's reachable.
+    """
+    start_time = time.perf_counter()
+    load_id_mappings()
+    load_outro_content()
+    static_file_versions()
+    for template_name in flask_app.jinja_env.list_templates():
+        # Compiled templates are cached in the Jinja environment
+        flask_app.jinja_env.get_template(template_name)
+
+    attempt = 0
+    while True:
+        try:
+            redcap_helpers.warm_up_connections(
+                flask_app.config["C2C_DCV_API_TOKEN"], flask_app.config["REDCAP_API_URL"]
             )
-            redcap_helpers.import_record(
-                flask_app.config["C2C_DCV_API_TOKEN"],
-                flask_app.config["REDCAP_API_URL"],
-                new_record,
+            break
+        except Exception as e:
+            wait_time = WARM_UP_RETRY_SECONDS[min(attempt, len(WARM_UP_RETRY_SECONDS) - 1)]
+            logs.write_log(
+                f"couldn't reach REDCap ({repr(e)}); retrying in {wait_time}s", src="warm_up"
             )
+            time.sleep(wait_time)
+            attempt += 1
+
+    if flask_app.config.get("REDCAP_REPLICA_ENABLED", False):
+        start_redcap_replica()
 
-            # return redirect(url_for("intro", key=hashed_id), code=301)
+    WARMED_UP.set()
+    logs.write_log(f"ready after {time.perf_counter() - start_time:0.2f}s", src="warm_up")
 
-        # return redirect(
-        #     url_for("videos", key=hashed_id, screen=most_recent_completed_screen_from_redcap + 1),
-        #     code=301,
-        # )
-        return redirect(url_for("intro", key=hashed_id), code=301)
+
+################################
+########### ENDPOINTS ##########
+
+
+@flask_app.route("/", methods=["GET"])
+def index():
+    if "error_code" in request.args and len(request.args["error_code"]) > 0:
+        error_code = request.args["error_code"]
+        if error_code not in BUBBLE_MESSAGES:
+            error_code = "unknown"
+        return render_template("index.html", error_message=BUBBLE_MESSAGES[error_code])
+
+    if "msg" in request.args and len(request.args["msg"]) > 0:
+        message_code = request.args["msg"]
+        if message_code not in BUBBLE_MESSAGES:
+            return render_template("index.html", error_message=BUBBLE_MESSAGES["unknown"])
+        return render_template("index.html", info_message=BUBBLE_MESSAGES[message_code])
+
+    # if "sent_email" in request.args and len(request.args["sent_email"]) > 0:
+    #     return render_template("email_sent.html")
+
+    if "key" in request.args and len(request.args["key"]) > 0:
+        return start_survey(request.args["key"], skip=request.args.get("skip", "") == "1")
     return render_template("index.html")
 
 
 @flask_app.route("/check", methods=["GET", "POST"])
 def check():
-    """Originally used to check if a user input their access key or their C2C email address.
-    No longer needed because functionality related to the email address has been removed from the requirements.
+    """Receives the access key form on "/". Originally also accepted C2C email addresses, which was
+    removed from the requirements.
     """
     # "GET" request is needed so users can be redirected properly instead of seeing a "request not allowed" error
     # Endpoint that receives data from a user that manually input their access key (hashed ID) to an HTML form on "/"
-    # Redirect to "/" with that key to check
     if "key" in request.form and len(request.form["key"]) > 0:
         user_provided_key = request.form["key"].strip()
         # if mindlib.is_valid_email_address(user_provided_key):
@@ -349,14 +807,14 @@ def check():
         #         flask_app.config["MAIL_C2C_NOREPLY_DISPLAY_NAME"],
         #         flask_app.config["MAIL_C2C_NOREPLY_PASS"],
         #     )
-        #     return redirect(url_for("index", sent_email="1"), code=301)
+        #     return redirect(url_for("index", sent_email="1"), code=303)
 
         # Not a valid email, so try interpreting this as a literal access key
-        # Don't have to do any intensive sanitizing or checking here; index() will do that
-        return redirect(url_for("index", key=user_provided_key), code=301)
+        # Resolved here rather than by redirecting to index(), which would cost the participant a round-trip
+        return start_survey(user_provided_key)
 
     # Don't allow users to visit this endpoint directly
-    return redirect(url_for("index"), code=301)
+    return redirect(url_for("index"), code=303)
 
 
 @flask_app.route("/intro", methods=["GET"])
@@ -364,10 +822,17 @@ def intro():
     # User visits this endpoint if they are a new survey participant
     if "key" in request.args and len(request.args["key"]) > 0:
         hashed_id = sanitize_key(request.args["key"])
+        valid_key = hashed_id in access_keys_to_c2c_ids()
+        if too_many_bad_keys(valid_key):
+            return redirect(url_for("index", error_code="too_many_attempts"), code=303)
+        if not valid_key:
+            logs.write_log("access key not found.", hashed_id, "intro")
+            return redirect(url_for("index", error_code="bad_key"), code=303)
+
         logs.write_log("accessed, uploading initial intro data....", hashed_id, "intro")
         initial_intro_data = {
             "access_key": hashed_id,
-            "redcap_event_name": "introscreen_arm_1",
+            "redcap_event_name": INTRO_REDCAP_EVENT,
             "page_served": mindlib.timestamp_now(),
         }
         redcap_helpers.import_record(
@@ -376,7 +841,7 @@ def intro():
             [initial_intro_data],
         )
         return render_template("intro.html", key=hashed_id)
-    return redirect(url_for("index", error_code="bad_key"), code=301)
+    return redirect(url_for("index", error_code="bad_key"), code=303)
 
 
 @flask_app.route("/videos", methods=["GET"])
@@ -385,23 +850,33 @@ def videos():
         hashed_id = sanitize_key(request.args["key"])
         if len(hashed_id) < 1:
             print(f"This key failed sanitization: {request.args['key']}")
-            return redirect(url_for("index", error_code="bad_key"), code=301)
+            return redirect(url_for("index", error_code="bad_key"), code=303)
 
-        if hashed_id not in ACCESS_KEYS_TO_C2C_IDS:
+        valid_key = hashed_id in access_keys_to_c2c_ids()
+        if too_many_bad_keys(valid_key):
+            return redirect(url_for("index", error_code="too_many_attempts"), code=303)
+        if not valid_key:
             logs.write_log("access key not found.", hashed_id, "videos")
             return redirect(url_for("index", error_code="bad_key"))
 
-        (
-            most_recent_completed_screen_number,
-            this_screens_ids,
-        ) = redcap_helpers.get_most_recent_screen(
-            flask_app.config["C2C_DCV_API_TOKEN"],
-            flask_app.config["REDCAP_API_URL"],
-            hashed_id,
-            max_screens=MAX_SCREENS,
-            include_video_ids=True,
-        )
-        if most_recent_completed_screen_number < MAX_SCREENS and this_screens_ids != []:
+        progress = parse_progress_token(hashed_id, request.cookies.get(PROGRESS_COOKIE_NAME, ""))
+        if progress is not None:
+            most_recent_completed_screen_number = progress.last_completed_screen
+            survey_videos = progress.video_ids
+        else:
+            (
+                most_recent_completed_screen_number,
+                survey_videos,
+            ) = get_survey_progress_from_redcap(hashed_id)
+        # Empty if the participant has finished every screen
+        this_screens_ids = survey_videos[
+            2 * most_recent_completed_screen_number : 2 * most_recent_completed_screen_number + 2
+        ]
+        if (
+            most_recent_completed_screen_number < MAX_SCREENS
+            and len(this_screens_ids) == 2
+            and all(this_screens_ids)
+        ):
             this_screen = most_recent_completed_screen_number + 1
 
             # Get the correct video positions for the current screen:
@@ -415,22 +890,22 @@ def videos():
                 hashed_id,
                 "videos",
             )
-            vid_a_url = VIDEOS[this_screens_ids[0]]
-            vid_b_url = VIDEOS[this_screens_ids[1]]
-            return render_template(
-                "videos.html",
-                screen=this_screen,
-                max_screens=MAX_SCREENS,
-                vid_a_position=vid_a_pos,
-                vid_a_id=this_screens_ids[0],
-                vid_a_url=vid_a_url,
-                vid_b_position=vid_b_pos,
-                vid_b_id=this_screens_ids[1],
-                vid_b_url=vid_b_url,
+            next_screens_ids = survey_videos[2 * this_screen : 2 * this_screen + 2]
+            response = cached_page_response(
+                render_videos_page(
+                    this_screen, this_screens_ids[0], this_screens_ids[1], next_screens_ids
+                )
             )
+            add_vimeo_link_headers(response)
+            if progress is None:
+                # Save the participant's progress so the next screen doesn't need REDCap
+                set_progress_cookie(
+                    response, hashed_id, survey_videos, most_recent_completed_screen_number
+                )
+            return response
         # Failsafe to redirect to the outro questionnaire
-        return redirect(url_for("outro", key=hashed_id), code=301)
-    return redirect(url_for("index", error_code="missing_key"), code=301)
+        return redirect(url_for("outro", key=hashed_id), code=303)
+    return redirect(url_for("index", error_code="missing_key"), code=303)
 
 
 @flask_app.route("/outro", methods=["GET", "POST"])
@@ -439,6 +914,12 @@ def outro():
 
     if "key" in request.args and len(request.args["key"]) > 0:
         hashed_id = sanitize_key(request.args["key"])
+        valid_key = hashed_id in access_keys_to_c2c_ids()
+        if too_many_bad_keys(valid_key):
+            return redirect(url_for("index", error_code="too_many_attempts"), code=303)
+        if not valid_key:
+            logs.write_log("access key not found.", hashed_id, "outro")
+            return redirect(url_for("index", error_code="bad_key"), code=303)
 
         if not redcap_helpers.user_completed_survey(
             flask_app.config["C2C_DCV_API_TOKEN"], flask_app.config["REDCAP_API_URL"], hashed_id
@@ -484,26 +965,11 @@ def outro():
                 )
                 logs.write_log("survey complete", hashed_id, "outro")
 
-                return redirect(url_for("thankyou"), code=301)
+                return redirect(url_for("thankyou"), code=303)
             else:
                 # GET request = visiting this page in the web browser
                 logs.write_log("rendering questionnaire", hashed_id, "outro")
-                questions_path = Path(PATH_TO_THIS_FOLDER, "content", "q_questions.txt")
-                agree_choices_path = Path(PATH_TO_THIS_FOLDER, "content", "q_agree_choices.txt")
-                final_question_choices_path = Path(
-                    PATH_TO_THIS_FOLDER, "content", "q_final_question_choices.txt"
-                )
-
-                with open(questions_path, "r") as questions_infile:
-                    questions = [line.strip() for line in questions_infile.readlines()]
-
-                with open(agree_choices_path, "r") as agree_choices_infile:
-                    agree_choices = [line.strip() for line in agree_choices_infile.readlines()]
-
-                with open(final_question_choices_path, "r") as final_choices_infile:
-                    final_question_choices = [
-                        line.strip() for line in final_choices_infile.readlines()
-                    ]
+                questions, agree_choices, final_question_choices = load_outro_content()
 
                 return render_template(
                     "outro.html",
@@ -514,9 +980,9 @@ def outro():
                 )
         else:
             logs.write_log("Already completed outro questionnaire", hashed_id, "outro")
-            return redirect(url_for("thankyou"), code=301)
+            return redirect(url_for("thankyou"), code=303)
 
-    return redirect(url_for("index", msg="missing_key"), code=301)
+    return redirect(url_for("index", msg="missing_key"), code=303)
 
 
 @flask_app.route("/thankyou", methods=["GET"])
@@ -525,6 +991,35 @@ def thankyou():
     return render_template("thankyou.html")
 
 
+@flask_app.route("/sw.js", methods=["GET"])
+def service_worker():
+    """Service worker for the survey pages (see templates/sw.js). Served from here rather than static/
+    so that its scope covers every survey page."""
+    static_url_prefix = url_for("static", filename="")
+    precache_urls = [
+        url_for("static", filename=file_name)
+        for file_name in static_file_versions()
+        if not any(Path(file_name).match(pattern) for pattern in SERVICE_WORKER_PRECACHE_EXCLUDED)
+    ]
+    static_version = hashlib.sha256(
+        json.dumps(static_file_versions(), sort_keys=True).encode()
+    ).hexdigest()[:12]
+    response = make_response(
+        render_template(
+            "sw.js",
+            static_version=static_version,
+            static_url_prefix=static_url_prefix,
+            precache_urls=precache_urls,
+            queued_upload_paths=[
+                f"{request.script_root.rsplit('/', 1)[0]}/video_selected",
+                f"{request.script_root.rsplit('/', 1)[0]}/intro_vid_info",
+            ],
+        )
+    )
+    response.headers["Content-Type"] = "text/javascript; charset=utf-8"
+    return response
+
+
 @flask_app.errorhandler(404)
 def page_not_found(err):
     return render_template("404.html"), 404
@@ -537,6 +1032,14 @@ def after_request(response):
     # And extra opinions from https://stackoverflow.com/a/34067710
     # Extra options for "Cache-Control" (might be unnecessary): "no-cache, must-revalidate, public"
     response.headers["Cache-Control"] = "no-store, max-age=0"
+    if (
+        request.endpoint == "static"
+        and response.status_code == 200
+        and request.args.get("v", "")
+        == static_file_versions().get(request.view_args.get("filename", ""))
+    ):
+        # Versioned static URLs change whenever the file does, so they can be cached for good
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
     # response.headers["Expires"] = 0
     # response.headers["Pragma"] = "no-cache"
     return response
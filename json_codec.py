@@ -0,0 +1,121 @@
+"""JSON encoding/decoding for REDCap API traffic.
+
+Uses orjson when it's installed (it parses straight from bytes and is several times faster than the
+standard library), and falls back to the `json` module otherwise.
+`iter_json_array()` parses a JSON array incrementally, so large exports can be processed one record at a
+time without holding the whole response body (and its decoded copy) in memory.
+"""
+
+import codecs
+import json
+from collections.abc import Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_decoder = json.JSONDecoder()
+
+WHITESPACE = " \t\n\r"
+# Characters that can continue a number (e.g. "1" -> "1.5", "1e" -> "1e5")
+NUMBER_CHARACTERS = "0123456789.eE+-"
+
+
+def loads(data: bytes | str):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    """Returns compact JSON (no spaces after separators), which is also what orjson produces."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+    """Yields the elements of a JSON array one at a time as `chunks` of UTF-8 bytes arrive.
+    If the document turns out not to be an array (e.g. REDCap's `{"error": "..."}`), it's parsed in full
+    and yielded as a single value instead.
+    Raises `json.JSONDecodeError` if the document is malformed or ends early.
+    """
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunk_iterator = iter(chunks)
+    buffer = ""
+    position = 0
+    finished_input = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, finished_input
+        if finished_input:
+            return False
+        try:
+            chunk = next(chunk_iterator)
+        except StopIteration:
+            finished_input = True
+            buffer = buffer[position:] + utf8_decoder.decode(b"", final=True)
+            position = 0
+            return True
+        # Drop what's already been parsed so the buffer stays about one record long
+        buffer = buffer[position:] + utf8_decoder.decode(chunk)
+        position = 0
+        return True
+
+    def skip_whitespace() -> bool:
+        """Moves `position` to the next significant character. Returns False at the end of input."""
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                return True
+            if not read_more():
+                return False
+
+    if not skip_whitespace():
+        raise json.JSONDecodeError("Expecting value", buffer, position)
+    if buffer[position] != "[":
+        # Not an array: read and parse the whole thing
+        while read_more():
+            pass
+        yield json.loads(buffer[position:])
+        return
+    position += 1
+
+    expecting_element = True
+    after_comma = False
+    while True:
+        if not skip_whitespace():
+            raise json.JSONDecodeError("Unterminated array", buffer, position)
+        if buffer[position] == "]" and not after_comma:
+            return
+        if not expecting_element:
+            if buffer[position] != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position)
+            position += 1
+            expecting_element = True
+            after_comma = True
+            continue
+        while True:
+            try:
+                element, end = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # Probably cut off at the end of the buffer; try again with more data
+                if read_more():
+                    continue
+                raise e
+            # A number that runs to the end of the buffer might continue in the next chunk, even
+            # if what's been decoded so far stops short of it (e.g. "1." or "1e")
+            if not finished_input and not isinstance(element, (dict, list, str)):
+                number_end = end
+                while number_end < len(buffer) and buffer[number_end] in NUMBER_CHARACTERS:
+                    number_end += 1
+                if number_end == len(buffer) and read_more():
+                    continue
+            break
+        yield element
+        position = end
+        expecting_element = False
+        after_comma = False
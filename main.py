@@ -1,23 +1,39 @@
+import asyncio
+import hashlib
+import hmac
+import threading
 from sys import getsizeof
 from typing import List
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.wsgi import WSGIMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from pydantic import BaseModel
 
+import choice_stats
+import compression
 import flask_site
+import json_codec
 import logs
-import mindlib
+import profiling
+import rate_limit
 import redcap_helpers
+import traffic_capture
 
 ################################
 ############ CONFIG ############
 
 URL_PREFIX = "retention"
 
-VIDEOS = mindlib.json_to_dict("./content/videos.json")
+VIDEOS = flask_site.VIDEOS
 
 
 def transform_logs(log_list: list[dict], max_string_size: int = 65535) -> str:
@@ -48,8 +64,43 @@ def transform_logs(log_list: list[dict], max_string_size: int = 65535) -> str:
 ################################
 
 app = FastAPI(openapi_url=None)
+# Compresses pages and JSON that aren't already compressed (see compression.py)
+app.add_middleware(compression.CompressionMiddleware)
+# Runs before compression: refused requests never reach the app (see rate_limit.py)
+app.add_middleware(
+    rate_limit.RateLimitMiddleware,
+    upload_paths=[f"/{URL_PREFIX}/video_selected", f"/{URL_PREFIX}/intro_vid_info"],
+    exempt_path_prefixes=[
+        f"/{URL_PREFIX}/healthz",
+        f"/{URL_PREFIX}/readyz",
+        f"{flask_site.FLASK_APP_URL_PATH}/static/",
+        f"{flask_site.FLASK_APP_URL_PATH}/sw.js",
+    ],
+    state=flask_site.SHARED_STATE,
+    sanitize_key=flask_site.sanitize_key,
+    enabled=flask_site.flask_app.config.get("RATE_LIMITS_ENABLED", True),
+)
+# Added last so it runs first and records every request, refused or not (see traffic_capture.py)
+TRAFFIC_CAPTURE = traffic_capture.CaptureWriter()
+app.add_middleware(
+    traffic_capture.TrafficCaptureMiddleware,
+    writer=TRAFFIC_CAPTURE,
+    key_secret=lambda: hmac.new(
+        flask_site.progress_token_secret(), b"c2c-traffic-capture", hashlib.sha256
+    ).digest(),
+    exempt_path_prefixes=[
+        f"/{URL_PREFIX}/healthz",
+        f"/{URL_PREFIX}/readyz",
+        f"/{URL_PREFIX}/dashboard",
+        f"/{URL_PREFIX}/debug/",
+    ],
+    sanitize_key=flask_site.sanitize_key,
+    is_valid_key=lambda key: key in flask_site.access_keys_to_c2c_ids(),
+    enabled=flask_site.flask_app.config.get("TRAFFIC_CAPTURE_ENABLED", False),
+)
 app.mount(f"/{URL_PREFIX}/survey", WSGIMiddleware(flask_site.flask_app))
-secrets = mindlib.json_to_dict("secrets.json")
+# Loaded once by flask_site (JSON keys in ALL CAPS)
+secrets = flask_site.flask_app.config
 
 
 class VideoPageIn(BaseModel):
@@ -69,10 +120,17 @@ class VideoPageIn(BaseModel):
     vidB_watch_count: int
     vidB_logs: List[dict]
 
+    # The two videos on the screen; only used when the progress cookie doesn't say (see record_choice)
+    vidA_id: str = ""
+    vidB_id: str = ""
+
     selected_vid_id: str
     selected_vid_position: int
     screen_time_end: str
 
+    # Made by the page once per submission, so retries of the same submission can be recognized
+    idempotency_key: str = ""
+
 
 class IntroPageIn(BaseModel):
     """Data about a video page after the participant selected a video."""
@@ -86,6 +144,20 @@ class IntroPageIn(BaseModel):
 
     vid_id: str
 
+    idempotency_key: str = ""
+
+
+# Seconds that an upload holds the claim on importing its event, so simultaneous copies of the same
+# submission (double-clicks, service worker replays) aren't imported twice
+UPLOAD_CLAIM_SECONDS = 60
+
+
+# Live totals of the video choices, shown on the dashboard (see choice_stats.py)
+CHOICE_STATS = choice_stats.ChoiceStats(flask_site.SHARED_STATE)
+
+# Seconds between dashboard updates
+DASHBOARD_UPDATE_INTERVAL_SECONDS = 2
+
 
 def debug_print_video_data_in(key: str, v: VideoPageIn) -> None:
     print(f"User '{key}' ({v.user_agent}) finished a survey page - got {getsizeof(v)} bytes")
@@ -103,9 +175,128 @@ def debug_print_video_data_in(key: str, v: VideoPageIn) -> None:
     print(f"\t\tLogs: {v.vidB_logs}")
 
 
+def advance_progress_cookie(
+    request: Request, response: Response, key: str, completed_screen: int
+) -> None:
+    """Marks `completed_screen` as completed in the participant's progress cookie (see flask_site.videos)."""
+    progress = flask_site.parse_progress_token(
+        key, request.cookies.get(flask_site.PROGRESS_COOKIE_NAME, "")
+    )
+    if progress is not None and progress.last_completed_screen < completed_screen:
+        response.set_cookie(
+            flask_site.PROGRESS_COOKIE_NAME,
+            # Keeps the time REDCap was last asked, so the cookie still expires on schedule
+            flask_site.new_progress_token(
+                key, progress.video_ids, completed_screen, progress.issued_at
+            ),
+            **flask_site.progress_cookie_options(),
+        )
+
+
+def payload_hash(page_data: BaseModel) -> str:
+    return hashlib.sha256(json_codec.dumps(page_data.dict()).encode()).hexdigest()[:16]
+
+
+def record_choice(request: Request, key: str, video_page_data: VideoPageIn) -> None:
+    """Adds a newly imported video selection to the dashboard's totals.
+    The screen's videos are taken from the signed progress cookie if there is one; otherwise from the
+    upload, as long as they're real videos and one of them was selected.
+    """
+    screen = video_page_data.screen
+    progress = flask_site.parse_progress_token(
+        key, request.cookies.get(flask_site.PROGRESS_COOKIE_NAME, "")
+    )
+    if progress is not None and 1 <= screen <= flask_site.MAX_SCREENS:
+        video_ids = tuple(progress.video_ids[2 * screen - 2 : 2 * screen])
+    else:
+        video_ids = (video_page_data.vidA_id, video_page_data.vidB_id)
+    if video_page_data.selected_vid_id not in video_ids or not all(
+        video_id in VIDEOS for video_id in video_ids
+    ):
+        return
+    CHOICE_STATS.record_screen(
+        screen,
+        video_ids,
+        video_page_data.selected_vid_id,
+        video_page_data.screen_time_start,
+        video_page_data.screen_time_end,
+    )
+
+
+def already_recorded(
+    key: str, redcap_event: str, instrument_complete_field_name: str, page_data: BaseModel
+) -> bool:
+    """True if data for this participant's event is already in REDCap, e.g. because they used the
+    Back button or the service worker sent the same upload again.
+    Answered by the upload ledger (see upload_ledger.py); REDCap is only asked if the ledger doesn't know.
+    """
+    entry = flask_site.UPLOAD_LEDGER.lookup(key, redcap_event)
+    if entry is None:
+        if not redcap_helpers.check_event_for_prefilled_data(
+            secrets["C2C_DCV_API_TOKEN"],
+            secrets["REDCAP_API_URL"],
+            key,
+            redcap_event,
+            instrument_complete_field_name,
+        ):
+            return False
+        flask_site.UPLOAD_LEDGER.record(key, redcap_event, result="found in REDCap")
+        return True
+    if not entry.recorded:
+        return False
+    if page_data.idempotency_key and page_data.idempotency_key == entry.idempotency_key:
+        if entry.payload_hash == payload_hash(page_data):
+            logs.write_log(f'Got a repeat of the upload for "{redcap_event}"', key, "api")
+        else:
+            logs.write_log(
+                f'Got different data with the same idempotency key for "{redcap_event}"',
+                key,
+                "api",
+            )
+    return True
+
+
+def import_upload(key: str, redcap_event: str, record: dict, page_data: BaseModel) -> bool:
+    """Imports one page's uploaded data into REDCap and notes it in the upload ledger.
+    Returns False without importing if another copy of the same upload is already being imported, or
+    has been imported since `already_recorded()` was checked.
+    """
+    claim_name = f"upload:{key}:{redcap_event}"
+    if not flask_site.SHARED_STATE.claim(claim_name, UPLOAD_CLAIM_SECONDS):
+        logs.write_log(f'Upload for "{redcap_event}" is already in progress', key, "api")
+        return False
+    try:
+        # Another copy may have finished importing between already_recorded() and the claim
+        entry = flask_site.UPLOAD_LEDGER.lookup(key, redcap_event)
+        if entry is not None and entry.recorded:
+            logs.write_log(f'Upload for "{redcap_event}" was just imported', key, "api")
+            return False
+        import_result = redcap_helpers.import_record(
+            secrets["C2C_DCV_API_TOKEN"], secrets["REDCAP_API_URL"], [record]
+        )
+        flask_site.UPLOAD_LEDGER.record(
+            key,
+            redcap_event,
+            page_data.idempotency_key,
+            payload_hash(page_data),
+            str(import_result),
+        )
+    finally:
+        flask_site.SHARED_STATE.release(claim_name)
+    logs.write_log(f"Uploaded {import_result} record(s) to REDCap", key, "api")
+    return True
+
+
 @app.post(f"/{URL_PREFIX}/video_selected")
-async def get_video_choice(video_page_data: VideoPageIn, key: str | None = None) -> None:
+async def get_video_choice(
+    video_page_data: VideoPageIn, request: Request, response: Response, key: str | None = None
+) -> None:
     if key:
+        key = flask_site.sanitize_key(key)
+        if not key or key not in flask_site.access_keys_to_c2c_ids():
+            logs.write_log("Rejected video data for an invalid access key", key, "api")
+            return
+
         if len(video_page_data.selected_vid_id) > 1 and (
             video_page_data.selected_vid_id[0] == video_page_data.selected_vid_id[-1] == '"'
             or video_page_data.selected_vid_id[0] == video_page_data.selected_vid_id[-1] == "'"
@@ -119,18 +310,13 @@ async def get_video_choice(video_page_data: VideoPageIn, key: str | None = None)
         # If a user clicks the "Back" button in their browser, they could re-watch a screen
         # Don't count the data from this duplicate screen if there's already data for this screen in REDCap
         # The Flask middleware should automatically serve the correct screen
-        if redcap_helpers.check_event_for_prefilled_data(
-            secrets["C2C_DCV_API_TOKEN"],
-            secrets["REDCAP_API_URL"],
-            key,
-            this_redcap_event,
-            "video_complete",
-        ):
+        if already_recorded(key, this_redcap_event, "video_complete", video_page_data):
             logs.write_log(
                 f'Already had data for screen {video_page_data.screen}; REDCap event "{this_redcap_event}"',
                 key,
                 "api",
             )
+            advance_progress_cookie(request, response, key, video_page_data.screen)
             return
 
         # debug_print_video_data_in(key, video_page_data)
@@ -156,10 +342,9 @@ async def get_video_choice(video_page_data: VideoPageIn, key: str | None = None)
         # json_sent_to_redcap = dumps(redcap_video_page_record)
         # print(json_sent_to_redcap)
 
-        import_result = redcap_helpers.import_record(
-            secrets["C2C_DCV_API_TOKEN"], secrets["REDCAP_API_URL"], [redcap_video_page_record]
-        )
-        logs.write_log(f"Uploaded {import_result} record(s) to REDCap", key, "api")
+        if import_upload(key, this_redcap_event, redcap_video_page_record, video_page_data):
+            record_choice(request, key, video_page_data)
+            advance_progress_cookie(request, response, key, video_page_data.screen)
     else:
         print("No access key detected")
 
@@ -167,16 +352,15 @@ async def get_video_choice(video_page_data: VideoPageIn, key: str | None = None)
 @app.post(f"/{URL_PREFIX}/intro_vid_info")
 async def get_intro_info(video_page_data: IntroPageIn, key: str | None = None) -> None:
     if key:
+        key = flask_site.sanitize_key(key)
+        if not key or key not in flask_site.access_keys_to_c2c_ids():
+            logs.write_log("Rejected intro video data for an invalid access key", key, "api")
+            return
+
         logs.write_log("Uploading data for intro video....", key, "api")
 
-        intro_redcap_event = "introscreen_arm_1"
-        if redcap_helpers.check_event_for_prefilled_data(
-            secrets["C2C_DCV_API_TOKEN"],
-            secrets["REDCAP_API_URL"],
-            key,
-            intro_redcap_event,
-            "single_video_complete",
-        ):
+        intro_redcap_event = flask_site.INTRO_REDCAP_EVENT
+        if already_recorded(key, intro_redcap_event, "single_video_complete", video_page_data):
             logs.write_log(
                 f'Already had data for intro video event "{intro_redcap_event}"', key, "api"
             )
@@ -193,14 +377,149 @@ async def get_intro_info(video_page_data: IntroPageIn, key: str | None = None) -
             "single_video_complete": "2",
         }
 
-        import_result = redcap_helpers.import_record(
-            secrets["C2C_DCV_API_TOKEN"], secrets["REDCAP_API_URL"], [redcap_intro_page_record]
-        )
-        logs.write_log(f"Uploaded {import_result} record(s) to REDCap", key, "api")
+        import_upload(key, intro_redcap_event, redcap_intro_page_record, video_page_data)
     else:
         print("No access key detected")
 
 
+@app.on_event("startup")
+async def start_warm_up() -> None:
+    # Warm up after uvicorn starts so the server can bind its socket right away
+    # Requests that arrive before the access key index is built will wait for it (see flask_site.access_keys_to_c2c_ids)
+    threading.Thread(target=flask_site.warm_up, name="warm-up", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def flush_on_shutdown() -> None:
+    CHOICE_STATS.flush()
+    TRAFFIC_CAPTURE.close()
+
+
+def is_admin(request: Request) -> bool:
+    """True if the request has the "ADMIN_TOKEN" from secrets.json, as a `token` query parameter or an
+    `Authorization: Bearer` header. Always False if no admin token is configured.
+    """
+    admin_token = secrets.get("ADMIN_TOKEN", "")
+    if not admin_token:
+        return False
+    token = request.query_params.get("token", "")
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer ") :].strip()
+    return hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+@app.get(f"/{URL_PREFIX}/dashboard")
+async def dashboard(request: Request):
+    """Live view of the choice totals, updated by the event stream below."""
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    page = flask_site.flask_app.jinja_env.get_template("dashboard.html").render(
+        stream_url=f"/{URL_PREFIX}/dashboard/events",
+        token=request.query_params.get("token", ""),
+        max_screens=flask_site.MAX_SCREENS,
+    )
+    return HTMLResponse(page, headers={"Cache-Control": "no-store"})
+
+
+async def dashboard_events(request: Request):
+    """Server-sent events: the full set of rows first ("snapshot"), then only rows that changed ("delta")."""
+    video_ids = list(VIDEOS.keys())
+    previous = None
+    while not await request.is_disconnected():
+        totals = await run_in_threadpool(CHOICE_STATS.totals)
+        rows = choice_stats.summarize(totals, video_ids, flask_site.MAX_SCREENS)
+        if previous is None:
+            yield f"event: snapshot\ndata: {json_codec.dumps(rows)}\n\n"
+        elif delta := choice_stats.changed_rows(previous, rows):
+            yield f"event: delta\ndata: {json_codec.dumps(delta)}\n\n"
+        else:
+            # Keeps proxies from closing an idle connection
+            yield ": keep-alive\n\n"
+        previous = rows
+        await asyncio.sleep(DASHBOARD_UPDATE_INTERVAL_SECONDS)
+
+
+@app.get(f"/{URL_PREFIX}/dashboard/events")
+async def dashboard_event_stream(request: Request):
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return StreamingResponse(
+        dashboard_events(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get(f"/{URL_PREFIX}/debug/profile")
+async def debug_profile(
+    request: Request, seconds: float = 10, hz: float = profiling.DEFAULT_HZ, idle: bool = False
+):
+    """Samples every thread of this worker for `seconds` and returns collapsed stacks for a flamegraph."""
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    if not 0 < seconds <= profiling.MAX_PROFILE_SECONDS or not 0 < hz <= profiling.MAX_HZ:
+        return PlainTextResponse(
+            f"seconds must be 0-{profiling.MAX_PROFILE_SECONDS} and hz 0-{profiling.MAX_HZ}\n",
+            status_code=400,
+        )
+    # Samples from a thread of its own, so the event loop keeps running (and shows up in the samples)
+    stacks = await run_in_threadpool(profiling.profile, seconds, hz, idle)
+    if stacks is None:
+        return PlainTextResponse("A profile is already running in this worker\n", status_code=409)
+    return PlainTextResponse(stacks, headers={"Cache-Control": "no-store"})
+
+
+@app.post(f"/{URL_PREFIX}/debug/memory/start")
+async def debug_memory_start(request: Request, frames: int = 1):
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return {"started": profiling.start_tracing(max(1, min(frames, 50)))}
+
+
+@app.post(f"/{URL_PREFIX}/debug/memory/stop")
+async def debug_memory_stop(request: Request):
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    profiling.stop_tracing()
+    return {"stopped": True}
+
+
+@app.get(f"/{URL_PREFIX}/debug/memory")
+async def debug_memory(
+    request: Request, limit: int = 25, group_by: str = "lineno", compare: bool = False
+):
+    """The biggest allocators since tracing started (or, with `compare`, since the last snapshot)."""
+    if not is_admin(request):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    if not profiling.tracemalloc.is_tracing():
+        return PlainTextResponse(
+            f"Not tracing; start with POST /{URL_PREFIX}/debug/memory/start\n", status_code=409
+        )
+    if group_by not in ("lineno", "filename", "traceback"):
+        return PlainTextResponse(
+            "group_by must be lineno, filename or traceback\n", status_code=400
+        )
+    report = await run_in_threadpool(profiling.top_allocations, limit, group_by, compare)
+    return PlainTextResponse(report, headers={"Cache-Control": "no-store"})
+
+
+@app.get(f"/{URL_PREFIX}/healthz")
+async def liveness():
+    """Returns 200 as long as this worker is able to respond at all."""
+    return {"alive": True}
+
+
+@app.get(f"/{URL_PREFIX}/readyz")
+async def readiness():
+    """Returns 200 once this worker has warmed up (see flask_site.warm_up); 503 until then.
+    Point the load balancer's health check here so it doesn't route participants to a cold instance.
+    """
+    if flask_site.WARMED_UP.is_set():
+        return {"ready": True}
+    return JSONResponse({"ready": False}, status_code=503)
+
+
 @app.get("/")
 @app.get(f"/{URL_PREFIX}")
 @app.get(f"/{URL_PREFIX}/video_selected")
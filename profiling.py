@@ -0,0 +1,140 @@
+"""On-demand diagnostics for a running worker: a sampling profiler and tracemalloc snapshots, served by
+the admin-only `/retention/debug/...` endpoints in main.py.
+
+The profiler looks at every thread's stack (`sys._current_frames()`) `hz` times a second from a thread
+of its own, so it sees the event loop and the threads running Flask and other blocking code alike,
+without slowing either of them down much. It returns the samples as collapsed stacks, one
+"thread;outermost function;...;innermost function count" line per distinct stack, which flamegraph
+tools (flamegraph.pl, speedscope, inferno) read as-is. Threads that are only waiting for work are left
+out unless asked for.
+
+Memory snapshots only see allocations made while tracemalloc is tracing: start it with the endpoint, or
+start the server with `PYTHONTRACEMALLOC=1` to include everything loaded at startup (e.g. the access key
+dicts).
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+MAX_PROFILE_SECONDS = 60
+DEFAULT_HZ = 100
+MAX_HZ = 1000
+
+# Innermost frames of threads that are waiting for something to do: (file name, function)
+IDLE_FRAMES = {
+    ("selectors.py", "select"),  # the event loop, between events
+    ("threading.py", "wait"),  # idle thread pool workers, daemon threads waiting on an Event
+    ("queue.py", "get"),
+    ("socketserver.py", "serve_forever"),
+    # Background loops whose waiting (SimpleQueue.get(), time.sleep()) happens in C, below their own frame
+    ("traffic_capture.py", "_write_entries"),
+    ("choice_stats.py", "_flush_periodically"),
+}
+
+# Only one profile at a time per worker
+_profile_lock = threading.Lock()
+
+# The last snapshot taken, so the next one can be compared to it
+_last_snapshot: tracemalloc.Snapshot | None = None
+
+
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(
+    seconds: float, hz: float = DEFAULT_HZ, include_idle: bool = False
+) -> tuple[Counter, int]:
+    """Samples every other thread's stack for `seconds`. Returns (collapsed stack -> samples, samples taken)."""
+    interval = 1 / hz
+    this_thread = threading.get_ident()
+    labels = {}
+    stacks = Counter()
+    samples = 0
+    end_time = time.perf_counter() + seconds
+    next_sample = time.perf_counter()
+    while next_sample < end_time:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == this_thread:
+                continue
+            code = frame.f_code
+            if (
+                not include_idle
+                and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+            ):
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                if code not in labels:
+                    labels[code] = frame_label(code)
+                names.append(labels[code])
+                frame = frame.f_back
+            names.append(thread_names.get(thread_id, f"thread {thread_id}"))
+            stacks[";".join(reversed(names))] += 1
+        samples += 1
+        next_sample += interval
+        time.sleep(max(0, next_sample - time.perf_counter()))
+    return (stacks, samples)
+
+
+def profile(seconds: float, hz: float = DEFAULT_HZ, include_idle: bool = False) -> str | None:
+    """Returns `seconds` of samples as collapsed stacks, or None if a profile is already running."""
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        stacks, samples = sample_stacks(
+            min(seconds, MAX_PROFILE_SECONDS), min(hz, MAX_HZ), include_idle
+        )
+    finally:
+        _profile_lock.release()
+    lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+    print(f"* Profiled {samples} samples of every thread ({len(lines)} distinct stacks)")
+    return "\n".join(lines) + "\n"
+
+
+def start_tracing(frames: int = 1) -> bool:
+    """Starts tracing memory allocations. Returns False if it was already tracing."""
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_tracing() -> None:
+    global _last_snapshot
+    tracemalloc.stop()
+    _last_snapshot = None
+
+
+def top_allocations(limit: int = 25, group_by: str = "lineno", compare: bool = False) -> str:
+    """Returns a text report of the `limit` biggest allocators, grouped by "lineno", "filename" or
+    "traceback". With `compare`, reports what changed since the previous snapshot instead.
+    Tracing has to be started first.
+    """
+    global _last_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"Traced memory: {current / 1024 / 1024:.1f} MiB now, {peak / 1024 / 1024:.1f} MiB peak "
+        f"(tracemalloc itself: {tracemalloc.get_tracemalloc_memory() / 1024 / 1024:.1f} MiB)"
+    ]
+    if compare and _last_snapshot is not None:
+        lines.append(f"Biggest changes since the previous snapshot, by {group_by}:")
+        stats = snapshot.compare_to(_last_snapshot, group_by)[:limit]
+    else:
+        lines.append(f"Biggest allocators, by {group_by}:")
+        stats = snapshot.statistics(group_by)[:limit]
+    for stat in stats:
+        lines.append(str(stat))
+        if group_by == "traceback":
+            lines += [f"    {line}" for line in stat.traceback.format()]
+    _last_snapshot = snapshot
+    return "\n".join(lines) + "\n"
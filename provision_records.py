@@ -0,0 +1,190 @@
+"""Creates REDCap records (with video assignments) ahead of time for participants who haven't started.
+
+Usage:
+    python provision_records.py --dry-run          # count who would be provisioned, import nothing
+    python provision_records.py                    # provision everyone who hasn't started yet
+    python provision_records.py --limit 1000 --chunk-size 100 --workers 4
+
+A new participant's first visit normally creates their start record and one record per screen (with
+its pair of videos) before they're redirected, which makes it the slowest request in the survey.
+After this has run, the first visit finds the videos already assigned, and `flask_site.start_survey()`
+only has to stamp `survey_tm_start` and `user_agent`.
+
+Needs the same `secrets.json` and access key CSV as the app.
+Participants who already have a record in REDCap (started, skipped or provisioned) are left alone.
+Each imported chunk is appended to `PROVISION_LOG_PATH`, so an interrupted run can simply be started
+again: logged access keys are skipped without waiting for REDCap to show them.
+Run it on the same host (and `state/` folder) as the app, so it takes the same per-participant claim
+as `start_survey()` and never creates a record at the same time as a participant's first visit.
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import flask_site
+import mindlib
+import redcap_helpers
+
+PROVISION_LOG_PATH = Path(flask_site.PATH_TO_THIS_FOLDER, "state", "provision_log.jsonl")
+
+# Participants per import call; each of them is 1 + MAX_SCREENS rows
+DEFAULT_CHUNK_SIZE = 50
+
+# Concurrent import calls; REDCap locks records while importing, so keep this small
+DEFAULT_WORKERS = 4
+
+
+def existing_access_keys(token: str, url: str) -> set[str]:
+    """Returns the access keys that have a record in REDCap, from a single bulk export."""
+    events = ["start_arm_1"] + [
+        f"screen{screen}_arm_1" for screen in range(1, flask_site.MAX_SCREENS + 1)
+    ]
+    return {
+        row[flask_site.HASHED_ID_EXPERIMENT_REDCAP_VAR]
+        for row in redcap_helpers.iter_records(
+            token,
+            url,
+            fields=[flask_site.HASHED_ID_EXPERIMENT_REDCAP_VAR, "video_a", "skipped"],
+            events=events,
+        )
+    }
+
+
+def logged_access_keys(log_path: Path = PROVISION_LOG_PATH) -> set[str]:
+    """Returns the access keys provisioned by earlier runs, according to the log."""
+    access_keys = set()
+    if not log_path.exists():
+        return access_keys
+    with open(log_path) as infile:
+        for line in infile:
+            try:
+                access_keys.update(json.loads(line)["access_keys"])
+            except (ValueError, KeyError):
+                # A line cut short by an interrupted run
+                continue
+    return access_keys
+
+
+def provision_chunk(token: str, url: str, access_keys: list[str]) -> dict:
+    """Assigns videos to these participants and imports their records in one call.
+    Returns the log entry for the chunk.
+    """
+    claimed = []
+    for access_key in access_keys:
+        if flask_site.SHARED_STATE.claim(
+            f"new_record:{access_key}", flask_site.NEW_RECORD_CLAIM_SECONDS
+        ):
+            claimed.append(access_key)
+    assignments = {access_key: flask_site.assign_survey_videos() for access_key in claimed}
+    records = []
+    for access_key, survey_videos in assignments.items():
+        records.extend(flask_site.new_participant_records(access_key, survey_videos))
+    try:
+        count = redcap_helpers.import_record(token, url, records) if records else 0
+    except Exception as e:
+        # Let a later run (or the participant's first visit) create the records
+        for access_key in claimed:
+            flask_site.SHARED_STATE.release(f"new_record:{access_key}")
+        raise e
+    return {
+        "tm": mindlib.timestamp_now(),
+        "access_keys": claimed,
+        # Claimed by a participant's first visit while this was running
+        "skipped": [access_key for access_key in access_keys if access_key not in assignments],
+        "count": count,
+    }
+
+
+def provision(
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = DEFAULT_WORKERS,
+    limit: int = 0,
+    dry_run: bool = False,
+    log_path: Path = PROVISION_LOG_PATH,
+) -> int:
+    """Provisions every participant in the access key CSV who has no record yet.
+    Returns the number of chunks that failed.
+    """
+    token = flask_site.flask_app.config["C2C_DCV_API_TOKEN"]
+    url = flask_site.flask_app.config["REDCAP_API_URL"]
+    start_time = time.perf_counter()
+
+    all_access_keys = list(flask_site.access_keys_to_c2c_ids().keys())
+    done = existing_access_keys(token, url) | logged_access_keys(log_path)
+    pending = [access_key for access_key in all_access_keys if access_key not in done]
+    if limit > 0:
+        pending = pending[:limit]
+    print(
+        f"* {len(all_access_keys)} access keys, {len(done)} already have records, "
+        f"{len(pending)} to provision ({time.perf_counter() - start_time:.1f}s)"
+    )
+    if dry_run or not pending:
+        return 0
+
+    chunks = [pending[i : i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    provisioned = 0
+    failures = 0
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, "a") as log_file, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(provision_chunk, token, url, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                failures += 1
+                print(
+                    f"* Couldn't provision {len(chunk)} participant(s) ({chunk[0]}...): {repr(e)}"
+                )
+                continue
+            # Written as soon as REDCap accepts the chunk, so a rerun never provisions it twice
+            log_file.write(json.dumps(entry) + "\n")
+            log_file.flush()
+            provisioned += len(entry["access_keys"])
+            if entry["count"] != len(entry["access_keys"]):
+                print(
+                    f"* REDCap reported {entry['count']} record(s) for a chunk of {len(entry['access_keys'])}"
+                )
+            print(
+                f"* {provisioned}/{len(pending)} provisioned "
+                f"({time.perf_counter() - start_time:.1f}s, {failures} failed chunk(s))"
+            )
+    print(f"* Done: provisioned {provisioned} participant(s); log is in {log_path}")
+    return failures
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"participants per REDCap import (default {DEFAULT_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"concurrent REDCap imports (default {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=0, help="provision at most this many participants"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count who would be provisioned"
+    )
+    args = parser.parse_args()
+    failures = provision(
+        chunk_size=args.chunk_size, workers=args.workers, limit=args.limit, dry_run=args.dry_run
+    )
+    return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
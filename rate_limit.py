@@ -0,0 +1,179 @@
+"""ASGI middleware that limits how fast each client (IP address) and each access key can make requests.
+
+Every request takes a token from token buckets kept in the shared state database (`shared_state.py`),
+so the limits hold across every worker process: one bucket for the client's IP address, and one for
+the access key in the `key` query parameter (if it looks like an access key). Page loads and uploads
+have separate budgets, so a participant who's been refreshing pages can still submit their choices.
+A request that finds a bucket empty gets a small `429 Too Many Requests` with a `Retry-After` header,
+without reaching Flask or REDCap. The service worker retries uploads that get a 429.
+
+Once a bucket has been found empty, this worker refuses that bucket's requests straight away until it
+has refilled, without touching the database. Health checks and static files aren't limited.
+
+Failed guesses at access keys are limited separately, by `flask_site.too_many_bad_keys()`.
+"""
+
+import math
+import time
+import urllib.parse
+from typing import NamedTuple
+
+from starlette.concurrency import run_in_threadpool
+
+import shared_state
+
+
+class Budget(NamedTuple):
+    """Up to `burst` requests at once, then `per_minute` requests per minute."""
+
+    burst: int
+    per_minute: float
+
+
+# Generous enough for a participant going through the survey in several tabs
+PAGE_BUDGET_PER_IP = Budget(burst=60, per_minute=60)
+UPLOAD_BUDGET_PER_IP = Budget(burst=30, per_minute=30)
+# Several participants can share an IP address (e.g. a household or a clinic), but not an access key
+PAGE_BUDGET_PER_KEY = Budget(burst=30, per_minute=20)
+UPLOAD_BUDGET_PER_KEY = Budget(burst=15, per_minute=10)
+
+PAGES = "pages"
+UPLOADS = "uploads"
+
+# Buckets unused for this long are deleted (they'd have refilled anyway)
+PURGE_INTERVAL_SECONDS = 10 * 60
+PURGE_IDLE_SECONDS = 60 * 60
+
+# Failed guesses at access keys (see check_bad_key_budget()): enough for a few typos, far too few to
+# find a valid key by trying them. Once it's used up, every key from that address is refused.
+BAD_KEY_BUDGET_PER_IP = Budget(burst=10, per_minute=10 / 60)
+
+# Tiny responses, so refusing a request costs about as little as possible
+TOO_MANY_REQUESTS_BODY = b"Too many requests. Please wait a moment and try again."
+
+
+def take(
+    state: shared_state.SharedState, bucket_name: str, budget: Budget, cost: float = 1
+) -> float:
+    """Takes `cost` tokens from a bucket. Returns 0 if allowed, otherwise the seconds to wait."""
+    return state.take_token(bucket_name, budget.burst, budget.per_minute / 60, cost)
+
+
+def time_until_available(
+    state: shared_state.SharedState, bucket_name: str, budget: Budget, cost: float = 1
+) -> float:
+    """Returns the seconds until `cost` tokens could be taken from a bucket, without taking any."""
+    return state.token_wait(bucket_name, budget.burst, budget.per_minute / 60, cost)
+
+
+def check_bad_key_budget(state: shared_state.SharedState, client: str, valid_key: bool) -> float:
+    """Charges an access key lookup from `client` against its bad key budget. An invalid key takes a
+    token; while the budget is empty, every key (valid or not) is refused, so the answers can't tell
+    valid keys apart. Returns 0 if the lookup is allowed, otherwise the seconds to wait.
+    """
+    bucket_name = f"bad_keys:ip:{client}"
+    if valid_key:
+        return time_until_available(state, bucket_name, BAD_KEY_BUDGET_PER_IP)
+    return take(state, bucket_name, BAD_KEY_BUDGET_PER_IP)
+
+
+class RateLimitMiddleware:
+    def __init__(
+        self,
+        app,
+        upload_paths: list[str],
+        exempt_path_prefixes: list[str],
+        state: shared_state.SharedState,
+        sanitize_key=lambda key: key,
+        enabled: bool = True,
+    ):
+        self.app = app
+        self.upload_paths = set(upload_paths)
+        self.exempt_path_prefixes = tuple(exempt_path_prefixes)
+        self.state = state
+        self.sanitize_key = sanitize_key
+        self.enabled = enabled
+        self.budgets = {
+            (PAGES, "ip"): PAGE_BUDGET_PER_IP,
+            (UPLOADS, "ip"): UPLOAD_BUDGET_PER_IP,
+            (PAGES, "key"): PAGE_BUDGET_PER_KEY,
+            (UPLOADS, "key"): UPLOAD_BUDGET_PER_KEY,
+        }
+        # bucket name -> time.monotonic() until which this worker refuses its requests
+        self._blocked_until: dict[str, float] = {}
+        self._purged_at = 0.0
+        self.refused = 0
+
+    def _bucket_names(self, scope) -> list[tuple[str, Budget]]:
+        kind = UPLOADS if scope["path"] in self.upload_paths else PAGES
+        client = scope.get("client")
+        buckets = [(f"{kind}:ip:{client[0] if client else 'unknown'}", self.budgets[kind, "ip"])]
+        query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        key = self.sanitize_key(query.get("key", [""])[0])
+        if key:
+            buckets.append((f"{kind}:key:{key}", self.budgets[kind, "key"]))
+        return buckets
+
+    def _blocked_for(self, buckets: list[tuple[str, Budget]]) -> float:
+        """Returns the seconds until this worker stops refusing requests for one of these buckets, or 0."""
+        now = time.monotonic()
+        for bucket_name, _ in buckets:
+            blocked_until = self._blocked_until.get(bucket_name, 0)
+            if blocked_until > now:
+                return blocked_until - now
+            if blocked_until:
+                self._blocked_until.pop(bucket_name, None)
+        return 0
+
+    def _take_tokens(self, buckets: list[tuple[str, Budget]]) -> float:
+        """Takes a token from every bucket. Returns 0 if allowed, otherwise the seconds to wait."""
+        now = time.monotonic()
+        for bucket_name, budget in buckets:
+            try:
+                wait_time = take(self.state, bucket_name, budget)
+            except Exception as e:
+                # Don't turn participants away because the limiter itself is having problems
+                print(f"***** Rate limiter unavailable: {repr(e)}")
+                return 0
+            if wait_time > 0:
+                self._blocked_until[bucket_name] = now + wait_time
+                return wait_time
+        if now - self._purged_at > PURGE_INTERVAL_SECONDS:
+            self._purged_at = now
+            self._blocked_until = {
+                name: until for name, until in self._blocked_until.items() if until > now
+            }
+            try:
+                self.state.purge_full_buckets(PURGE_IDLE_SECONDS)
+            except Exception:
+                pass
+        return 0
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not self.enabled
+            or scope["type"] != "http"
+            or scope["path"].startswith(self.exempt_path_prefixes)
+        ):
+            return await self.app(scope, receive, send)
+        buckets = self._bucket_names(scope)
+        wait_time = self._blocked_for(buckets)
+        if wait_time <= 0:
+            # SQLite may have to wait for another worker's write, so keep it off the event loop
+            wait_time = await run_in_threadpool(self._take_tokens, buckets)
+        if wait_time <= 0:
+            return await self.app(scope, receive, send)
+        self.refused += 1
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(TOO_MANY_REQUESTS_BODY)).encode()),
+                    (b"retry-after", str(max(1, math.ceil(wait_time))).encode()),
+                    (b"cache-control", b"no-store"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": TOO_MANY_REQUESTS_BODY})
@@ -1,15 +1,120 @@
-import json
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import json_codec
+import logs
+
+# Max number of kept-alive connections to the REDCap server per worker process
+# Flask's WSGI threads share these instead of opening a new TLS connection for every API call
+REDCAP_CONNECTION_POOL_SIZE = 10
+
+# Bytes read at a time from streamed (bulk) exports
+STREAM_CHUNK_SIZE = 64 * 1024
+
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REDCAP_CONNECTION_POOL_SIZE)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 
 class REDCapError(Exception):
     pass
 
 
-def export_redcap_report(token: str, url: str, report_id: str | int) -> list[dict]:
+# Optional local mirror of the experiment's REDCap project (see redcap_replica.py); set by use_replica()
+_replica = None
+
+
+def use_replica(replica) -> None:
+    """Lets the record-exporting helpers below read from a `redcap_replica.REDCapReplica`
+    instead of REDCap whenever the replica is fresh enough and has the requested fields.
+    Pass None to always read from REDCap.
+    """
+    global _replica
+    _replica = replica
+
+
+def _export_records(url: str, request_params: dict) -> list[dict] | dict:
+    """Sends a record export to REDCap, or answers it from the replica if possible."""
+    if _replica is not None and _replica.can_serve(request_params):
+        return _replica.export(request_params)
+    r = SESSION.post(url, data=request_params)
+    return json_codec.loads(r.content)
+
+
+def iter_export(url: str, request_params: dict, description: str) -> Iterator[dict]:
+    """Streams a REDCap export, yielding one record at a time as the response body arrives,
+    so bulk exports are processed in constant memory. `description` is used in error messages.
+    """
+    with SESSION.post(url, data=request_params, stream=True) as r:
+        for element in json_codec.iter_json_array(r.iter_content(chunk_size=STREAM_CHUNK_SIZE)):
+            if type(element) == dict and "error" in element and len(element) == 1:
+                raise REDCapError(
+                    f"REDCap API returned an error while {description}:\n{element['error']}"
+                )
+            yield element
+
+
+def iter_records(
+    token: str,
+    url: str,
+    fields: list[str] = [],
+    events: list[str] = [],
+    records: list[str] = [],
+    date_range_begin: str = "",
+) -> Iterator[dict]:
+    """Makes a REDCap API call to export records in bulk, always straight from REDCap, and yields
+    them one at a time as they're downloaded.
+    Empty `fields`/`events`/`records` mean "all of them".
+    `date_range_begin` ("YYYY-MM-DD hh:mm:ss" in the REDCap server's time zone) only exports records
+    created or modified after that time.
+    """
+    request_params = {
+        "token": token,
+        "content": "record",
+        "action": "export",
+        "format": "json",
+        "type": "flat",
+        "csvDelimiter": "",
+        "rawOrLabel": "raw",
+        "rawOrLabelHeaders": "raw",
+        "exportCheckboxLabel": "false",
+        "exportSurveyFields": "false",
+        "exportDataAccessGroups": "false",
+        "returnFormat": "json",
+    }
+    for i, field in enumerate(fields):
+        request_params[f"fields[{i}]"] = field
+    for i, event in enumerate(events):
+        request_params[f"events[{i}]"] = event
+    for i, record in enumerate(records):
+        request_params[f"records[{i}]"] = record
+    if date_range_begin:
+        request_params["dateRangeBegin"] = date_range_begin
+
+    yield from iter_export(url, request_params, "exporting records")
+
+
+def export_records(
+    token: str,
+    url: str,
+    fields: list[str] = [],
+    events: list[str] = [],
+    records: list[str] = [],
+    date_range_begin: str = "",
+) -> list[dict]:
+    """Same as `iter_records()`, but returns every record at once in a list."""
+    return list(iter_records(token, url, fields, events, records, date_range_begin))
+
+
+def iter_redcap_report(token: str, url: str, report_id: str | int) -> Iterator[dict]:
     """Makes a REDCap API call for exporting a single report from a project.
-    Returns a list of dicts, each containing a single record's fields as specified in the report.
+    Yields dicts one at a time as they're downloaded, each containing a single record's fields as
+    specified in the report.
     """
     request_params = {
         "token": token,
@@ -22,14 +127,44 @@ def export_redcap_report(token: str, url: str, report_id: str | int) -> list[dic
         "exportCheckboxLabel": "false",
         "returnFormat": "json",
     }
-    r = requests.post(url, data=request_params)
-    # print('>>> HTTP Status: ' + str(r.status_code))
-    result = json.loads(r.text)
-    if type(result) == dict and "error" in result:
-        raise REDCapError(
-            f"REDCap API returned an error while exporting report '{report_id}':\n{result['error']}"
-        )
-    return result
+    yield from iter_export(url, request_params, f"exporting report '{report_id}'")
+
+
+def export_redcap_report(token: str, url: str, report_id: str | int) -> list[dict]:
+    """Makes a REDCap API call for exporting a single report from a project.
+    Returns a list of dicts, each containing a single record's fields as specified in the report.
+    """
+    return list(iter_redcap_report(token, url, report_id))
+
+
+def export_redcap_version(token: str, url: str) -> str:
+    """Makes a REDCap API call for the REDCap server's version number (e.g. "13.7.3").
+    This is about the cheapest API call there is, so it's used to open connections ahead of time.
+    """
+    request_params = {
+        "token": token,
+        "content": "version",
+        "format": "json",
+    }
+    r = SESSION.post(url, data=request_params)
+    if r.text.startswith("{"):
+        result = json_codec.loads(r.content)
+        if "error" in result:
+            raise REDCapError(
+                f"REDCap API returned an error while exporting the REDCap version:\n{result['error']}"
+            )
+    return r.text
+
+
+def warm_up_connections(
+    token: str, url: str, connections: int = REDCAP_CONNECTION_POOL_SIZE
+) -> None:
+    """Opens `connections` connections to REDCap at the same time so they're kept alive in `SESSION`'s
+    pool, ready for the first participants after a restart.
+    """
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for _ in executor.map(lambda _: export_redcap_version(token, url), range(connections)):
+            pass
 
 
 def import_record(token: str, url: str, records: list[dict]) -> int:
@@ -42,20 +177,26 @@ def import_record(token: str, url: str, records: list[dict]) -> int:
         "type": "flat",
         "overwriteBehavior": "normal",
         "forceAutoNumber": "false",
-        "data": json.dumps(records),
+        "data": json_codec.dumps(records),
         "returnContent": "count",
         "returnFormat": "json",
     }
-    r = requests.post(url, data=request_params)
+    r = SESSION.post(url, data=request_params)
     # print(">>> HTTP Status: " + str(r.status_code))
-    result = json.loads(r.text)
+    result = json_codec.loads(r.content)
     if type(result) == dict:
         if "error" in result:
             raise REDCapError(
                 f"REDCap API returned an error while importing record(s) '{records}':\n{result['error']}"
             )
-        if "count" in result:
-            return int(result["count"])
+    if _replica is not None and _replica.token == token:
+        try:
+            _replica.apply_import(records)
+        except Exception as e:
+            # REDCap has the data; the replica catches up at its next sync
+            logs.write_log(f"couldn't write import through to the replica: {repr(e)}", src="api")
+    if type(result) == dict and "count" in result:
+        return int(result["count"])
     return 1
 
 
@@ -84,8 +225,7 @@ def export_video_ids(token: str, url: str, recordid: str, maxScreens: int) -> li
     for screen in range(maxScreens):
         request_params[f"events[{screen}]"] = f"screen{screen+1}_arm_1"
 
-    r = requests.post(url, data=request_params)
-    result = json.loads(r.text)
+    result = _export_records(url, request_params)
     if type(result) == dict:
         if "error" in result:
             raise REDCapError(
@@ -95,37 +235,6 @@ def export_video_ids(token: str, url: str, recordid: str, maxScreens: int) -> li
     return result
 
 
-def export_dcv_video_data(token: str, url: str, recordid: str, maxScreens: int) -> list[dict]:
-    """Makes a REDCap API call to retrieve information about all of a survey participant's videos."""
-    request_params = {
-        "token": token,
-        "content": "record",
-        "action": "export",
-        "format": "json",
-        "type": "flat",
-        "csvDelimiter": "",
-        "records[0]": recordid,
-        "rawOrLabel": "raw",
-        "rawOrLabelHeaders": "raw",
-        "exportCheckboxLabel": "false",
-        "exportSurveyFields": "false",
-        "exportDataAccessGroups": "false",
-        "returnFormat": "json",
-    }
-    for screen in range(maxScreens):
-        request_params[f"events[{screen}]"] = f"screen{screen+1}_arm_1"
-
-    r = requests.post(url, data=request_params)
-    result = json.loads(r.text)
-    if type(result) == dict:
-        if "error" in result:
-            raise REDCapError(
-                f"REDCap API returned an error while exporting video data for the record: '{recordid}':\n{result['error']}"
-            )
-
-    return result
-
-
 # def get_first_two_selected_videos(token: str, url: str, recordid: str) -> list[str]:
 #     request_params = {
 #         "token": token,
@@ -146,7 +255,7 @@ def export_dcv_video_data(token: str, url: str, recordid: str, maxScreens: int)
 #         "exportDataAccessGroups": "false",
 #         "returnFormat": "json",
 #     }
-#     r = requests.post(url, data=request_params)
+#     r = SESSION.post(url, data=request_params)
 #     result = json.loads(r.text)
 #     if type(result) == dict:
 #         if "error" in result:
@@ -209,13 +318,21 @@ def get_most_recent_screen(
         # Modify request params to only fetch screen events
         request_params[f"events[{screen}]"] = f"screen{screen+1}_arm_1"
 
-    r = requests.post(url, data=request_params)
-    result = json.loads(r.text)
+    result = _export_records(url, request_params)
     if type(result) == dict:
         if "error" in result:
             raise REDCapError(
                 f"REDCap API returned an error while exporting most recent completed screen for the record: '{recordid}':\n{result['error']}"
             )
+    return parse_most_recent_screen(result, max_screens, include_video_ids)
+
+
+def parse_most_recent_screen(
+    result: list[dict], max_screens: int, include_video_ids: bool = False
+) -> int | tuple[int, list[str]]:
+    """Parses the screen events exported by `get_most_recent_screen()`.
+    Kept separate from the API call so it can be benchmarked without a REDCap server.
+    """
     # print(result)
     most_recent_completed_screen = 0
     if type(result) == list and len(result) == max_screens:
@@ -264,9 +381,7 @@ def captured_user_agent(token: str, url: str, recordid: str) -> bool:
         "exportDataAccessGroups": "false",
         "returnFormat": "json",
     }
-    r = requests.post(url, data=request_params)
-    # print('>>> HTTP Status: ' + str(r.status_code))
-    result = json.loads(r.text)
+    result = _export_records(url, request_params)
     if type(result) == dict and "error" in result:
         raise REDCapError(
             f"REDCap API returned an error while checking if '{recordid}' has a user-agent string:\n{result['error']}"
@@ -275,8 +390,16 @@ def captured_user_agent(token: str, url: str, recordid: str) -> bool:
     return len(result) > 0 and "user_agent" in result[0] and len(result[0]["user_agent"]) > 0
 
 
-def user_completed_survey(token: str, url: str, recordid: str) -> bool:
-    """Returns True if the user completed the survey and False if the survey is incomplete.
+class SurveyStatus(NamedTuple):
+    # True if they completed the final "outro" questionnaire or elected to skip the survey
+    completed: bool
+    # Empty if the participant hasn't started the survey, or their record was pre-provisioned
+    # (see provision_records.py) and they haven't visited yet
+    survey_tm_start: str
+
+
+def get_survey_status(token: str, url: str, recordid: str) -> SurveyStatus:
+    """Returns whether the user completed the survey and when they started it, from one export.
     The survey is completed if any of the following are true:
       * They completed the final "outro" questionnaire
       * They elected to skip the survey
@@ -302,9 +425,7 @@ def user_completed_survey(token: str, url: str, recordid: str) -> bool:
         "exportDataAccessGroups": "false",
         "returnFormat": "json",
     }
-    r = requests.post(url, data=request_params)
-    # print('>>> HTTP Status: ' + str(r.status_code))
-    result = json.loads(r.text)
+    result = _export_records(url, request_params)
     if type(result) == dict and "error" in result:
         raise REDCapError(
             f"REDCap API returned an error while checking if '{recordid}' finished or skipped the survey:\n{result['error']}"
@@ -319,8 +440,17 @@ def user_completed_survey(token: str, url: str, recordid: str) -> bool:
             f"[{recordid}] skipped survey? {skipped_survey} / completed survey? {completed_questionnaire}"
         )
 
-        return skipped_survey or completed_questionnaire
-    return False
+        return SurveyStatus(
+            skipped_survey or completed_questionnaire, result[0].get("survey_tm_start", "")
+        )
+    return SurveyStatus(False, "")
+
+
+def user_completed_survey(token: str, url: str, recordid: str) -> bool:
+    """Returns True if the user completed the survey and False if the survey is incomplete.
+    See get_survey_status().
+    """
+    return get_survey_status(token, url, recordid).completed
 
 
 def check_event_for_prefilled_data(
@@ -357,8 +487,7 @@ def check_event_for_prefilled_data(
     for i, field in enumerate(extra_fields, start=2):
         request_params[f"fields[{i}]"] = field
 
-    r = requests.post(url, data=request_params)
-    result = json.loads(r.text)
+    result = _export_records(url, request_params)
     if type(result) == dict:
         if "error" in result:
             raise REDCapError(
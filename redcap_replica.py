@@ -0,0 +1,288 @@
+"""A local, read-only mirror of the experiment's REDCap project, stored in SQLite.
+
+The replica holds only the fields needed to work out where a participant is in the survey
+(`REPLICA_FIELDS`), for every record and event. It's seeded with one bulk export, kept fresh with
+incremental exports (REDCap's `dateRangeBegin`) on a background thread, and updated immediately
+whenever this app imports data (see `redcap_helpers.import_record`).
+
+While the last successful sync is no older than `max_staleness_seconds`, the helpers in
+`redcap_helpers` read participant state from here instead of calling REDCap.
+Records deleted in REDCap are not removed from the replica until it is re-seeded.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import logs
+import redcap_helpers
+
+REPLICA_DB_PATH = Path(Path(__file__).resolve().parent, "state", "redcap_replica.sqlite3")
+
+# Record ID field of the experiment's REDCap project
+RECORD_ID_FIELD = "access_key"
+
+# Everything the state-reading helpers in redcap_helpers ask for; video logs are deliberately left out
+REPLICA_FIELDS = [
+    RECORD_ID_FIELD,
+    "c2c_id",
+    "survey_tm_start",
+    "survey_tm_end",
+    "user_agent",
+    "skipped",
+    "basic_information_complete",
+    "page_served",
+    "single_video_complete",
+    "video_a",
+    "video_b",
+    "video_selection",
+    "video_complete",
+    "outro_complete",
+]
+
+# Incremental exports start this many seconds before the previous sync started,
+# in case of clock differences between this server and REDCap
+SYNC_OVERLAP_SECONDS = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+    record TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (record, event)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class REDCapReplica:
+    def __init__(
+        self,
+        token: str,
+        url: str,
+        db_path: Path | str = REPLICA_DB_PATH,
+        max_staleness_seconds: float = 60,
+        sync_interval_seconds: float = 20,
+    ):
+        self.token = token
+        self.url = url
+        self.db_path = Path(db_path)
+        self.max_staleness_seconds = max_staleness_seconds
+        self.sync_interval_seconds = sync_interval_seconds
+        self._fields = set(REPLICA_FIELDS)
+        self._local = threading.local()
+        self._stop = threading.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _get_state(self, key: str, default=None):
+        row = (
+            self._connect()
+            .execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return default if row is None else json.loads(row[0])
+
+    def _set_state(self, conn: sqlite3.Connection, key: str, value) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)),
+        )
+
+    ######## Syncing ########
+
+    def _upsert(self, conn: sqlite3.Connection, rows: Iterable[dict], replace: bool) -> None:
+        """Stores exported (or imported) rows. If `replace` is False, fields are merged into existing rows."""
+        for row in rows:
+            record = row.get(RECORD_ID_FIELD, "")
+            event = row.get("redcap_event_name", "")
+            if not record or not event:
+                continue
+            data = {k: str(v) for k, v in row.items() if k in self._fields}
+            if not replace:
+                existing = conn.execute(
+                    "SELECT data FROM rows WHERE record = ? AND event = ?", (record, event)
+                ).fetchone()
+                if existing is not None:
+                    data = json.loads(existing[0]) | data
+            conn.execute(
+                "INSERT OR REPLACE INTO rows (record, event, data) VALUES (?, ?, ?)",
+                (record, event, json.dumps(data)),
+            )
+
+    def _sync(self, full: bool) -> int:
+        started_at = time.time()
+        date_range_begin = ""
+        if not full:
+            last_sync_started_at = self._get_state("last_sync_started_at", 0)
+            date_range_begin = (
+                datetime.fromtimestamp(last_sync_started_at)
+                - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+            ).strftime("%Y-%m-%d %H:%M:%S")
+        # Downloaded before the transaction starts, so the write lock isn't held (and write-through
+        # imports aren't kept waiting) for as long as REDCap takes to export
+        rows = list(
+            redcap_helpers.iter_records(
+                self.token, self.url, fields=REPLICA_FIELDS, date_range_begin=date_range_begin
+            )
+        )
+        event_order = {}
+        for row in rows:
+            event_order.setdefault(row.get("redcap_event_name", ""), len(event_order))
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if full:
+                conn.execute("DELETE FROM rows")
+            self._upsert(conn, rows, replace=True)
+            if full:
+                # REDCap exports rows in the project's event order; remember it for export()
+                self._set_state(conn, "event_order", list(event_order))
+            self._set_state(conn, "last_sync_started_at", started_at)
+            conn.execute("COMMIT")
+        except Exception as e:
+            conn.execute("ROLLBACK")
+            raise e
+        return len(rows)
+
+    def seed(self) -> int:
+        """Replaces the replica's contents with one bulk export. Returns the number of rows exported."""
+        return self._sync(full=True)
+
+    def sync(self) -> int:
+        """Exports only the records changed since the last sync. Returns the number of rows exported."""
+        if self._get_state("last_sync_started_at") is None:
+            return self.seed()
+        return self._sync(full=False)
+
+    def apply_import(self, records: list[dict]) -> None:
+        """Write-through for data this app imports into REDCap."""
+        rows = []
+        for record in records:
+            # Imports without an event name go to the first event, like REDCap does
+            if "redcap_event_name" not in record:
+                record = record | {"redcap_event_name": "start_arm_1"}
+            rows.append(record)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._upsert(conn, rows, replace=False)
+            conn.execute("COMMIT")
+        except Exception as e:
+            conn.execute("ROLLBACK")
+            raise e
+
+    def run_sync_loop(self, claim=None) -> None:
+        """Syncs every `sync_interval_seconds` until stop() is called.
+        `claim`, if provided, is called as `claim(name, ttl_seconds) -> bool` before each sync so only one
+        worker process syncs the shared replica file per interval (e.g. `SharedState.claim`).
+        """
+        while not self._stop.is_set():
+            try:
+                if claim is None or claim("redcap_replica_sync", self.sync_interval_seconds * 0.9):
+                    row_count = self.sync()
+                    if row_count > 0:
+                        logs.write_log(f"synced {row_count} row(s)", src="redcap_replica")
+            except Exception as e:
+                logs.write_log(f"sync failed: {repr(e)}", src="redcap_replica")
+            self._stop.wait(self.sync_interval_seconds)
+
+    def start_background_sync(self, claim=None) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.run_sync_loop, args=(claim,), name="redcap-replica-sync", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    ######## Reading ########
+
+    def staleness_seconds(self) -> float:
+        last_sync_started_at = self._get_state("last_sync_started_at")
+        if last_sync_started_at is None:
+            return float("inf")
+        return time.time() - last_sync_started_at
+
+    def can_serve(self, request_params: dict) -> bool:
+        """True if `request_params` is a record export for this project that the replica can answer
+        from fresh enough data.
+        """
+        if (
+            request_params.get("token") != self.token
+            or request_params.get("content") != "record"
+            or request_params.get("action") != "export"
+            or "dateRangeBegin" in request_params
+        ):
+            return False
+        requested_fields = _indexed_params(request_params, "fields")
+        if not requested_fields or not set(requested_fields) <= self._fields:
+            return False
+        return self.staleness_seconds() <= self.max_staleness_seconds
+
+    def export(self, request_params: dict) -> list[dict]:
+        """Answers a flat JSON record export the way REDCap would:
+        one row per (record, event) with data, in event order, with every requested field present.
+        """
+        records = _indexed_params(request_params, "records")
+        events = _indexed_params(request_params, "events")
+        fields = _indexed_params(request_params, "fields")
+        forms_requested = len(_indexed_params(request_params, "forms")) > 0
+
+        query = "SELECT record, event, data FROM rows"
+        conditions = []
+        args = []
+        if records:
+            conditions.append(f"record IN ({','.join('?' * len(records))})")
+            args += records
+        if events:
+            conditions.append(f"event IN ({','.join('?' * len(events))})")
+            args += events
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        rows = self._connect().execute(query, args).fetchall()
+
+        event_order = {event: i for i, event in enumerate(self._get_state("event_order", []))}
+        for i, event in enumerate(events):
+            event_order.setdefault(event, len(event_order) + i)
+        rows.sort(key=lambda row: (row[0], event_order.get(row[1], len(event_order))))
+
+        result = []
+        for record, event, data in rows:
+            data = json.loads(data)
+            row = {RECORD_ID_FIELD: record, "redcap_event_name": event}
+            if forms_requested:
+                # Requested forms may contain more fields than were asked for by name
+                row |= data
+            for field in fields:
+                row[field] = data.get(field, "")
+            result.append(row)
+        return result
+
+
+def _indexed_params(request_params: dict, name: str) -> list[str]:
+    """Collects REDCap-style array parameters ("fields[0]", "fields[1]", ...) in index order."""
+    prefix = f"{name}["
+    indexed = []
+    for key, value in request_params.items():
+        if key.startswith(prefix) and key.endswith("]"):
+            indexed.append((int(key[len(prefix) : -1]), value))
+    return [value for _, value in sorted(indexed)]
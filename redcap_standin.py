@@ -0,0 +1,231 @@
+"""A small local stand-in for the experiment's REDCap project, for replaying traffic
+(`traffic_replay.py`) and trying the app out without a REDCap server.
+
+Usage:
+    python redcap_standin.py                        # http://127.0.0.1:8765/api/
+    python redcap_standin.py --latency-ms 150       # answer as slowly as the real server
+
+Point "REDCAP_API_URL" at it; any API token is accepted. Records are kept in memory and start out
+empty. Only the parts of the API that the app uses are here: exporting and importing records (flat
+JSON, with the `records`/`fields`/`forms`/`events`/`dateRangeBegin` filters), the version and (empty)
+reports.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECORD_ID_FIELD = "access_key"
+
+REDCAP_VERSION = "13.7.3"
+
+# Screens in the project (flask_site.MAX_SCREENS)
+DEFAULT_SCREENS = 7
+
+# Fields of each form, as the app uploads them (REDCap adds a "<form>_complete" field to each)
+FORMS = {
+    "basic_information": [
+        RECORD_ID_FIELD,
+        "c2c_id",
+        "survey_tm_start",
+        "user_agent",
+        "skipped",
+        "survey_tm_end",
+    ],
+    "single_video": [
+        "page_served",
+        "single_video_id",
+        "single_video_playcount",
+        "single_video_tm_start",
+        "single_video_tm_end",
+        "single_video_logs",
+    ],
+    "video": [
+        "video_a",
+        "video_b",
+        "screen_tm_start",
+        "video_a_tm_start",
+        "video_a_tm_end",
+        "video_a_playcount",
+        "video_a_logs",
+        "video_b_tm_start",
+        "video_b_tm_end",
+        "video_b_playcount",
+        "video_b_logs",
+        "video_selection",
+        "screen_tm_end",
+    ],
+    "outro": [f"outro_q{i}" for i in range(1, 11)],
+}
+
+
+def form_events(screens: int = DEFAULT_SCREENS) -> dict[str, list[str]]:
+    """Returns the events each form is used in."""
+    return {
+        "basic_information": ["start_arm_1"],
+        "single_video": ["introscreen_arm_1"],
+        "video": [f"screen{i}_arm_1" for i in range(1, screens + 1)],
+        "outro": ["outroscreen_arm_1"],
+    }
+
+
+class REDCapStandIn:
+    """The project's records, in memory."""
+
+    def __init__(self, screens: int = DEFAULT_SCREENS):
+        self.form_events = form_events(screens)
+        self.events = [event for events in self.form_events.values() for event in events]
+        self.event_forms = {
+            event: form for form, events in self.form_events.items() for event in events
+        }
+        # record ID -> event -> (row, time it was last modified)
+        self._records: dict[str, dict[str, tuple[dict, str]]] = {}
+        self._lock = threading.Lock()
+
+    def import_records(self, records: list[dict]) -> int:
+        """Imports records like REDCap's "normal" overwrite behavior: blank values don't overwrite."""
+        modified_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            for record in records:
+                record_id = str(record[RECORD_ID_FIELD])
+                event = record.get("redcap_event_name", self.events[0])
+                if event not in self.event_forms:
+                    raise ValueError(f'The event "{event}" doesn\'t exist')
+                events = self._records.setdefault(record_id, {})
+                row = events[event][0] if event in events else self._blank_row(record_id, event)
+                for field, value in record.items():
+                    if value != "" or field not in row:
+                        row[field] = str(value)
+                events[event] = (row, modified_at)
+        return len({str(record[RECORD_ID_FIELD]) for record in records})
+
+    def _blank_row(self, record_id: str, event: str) -> dict:
+        row = {RECORD_ID_FIELD: record_id, "redcap_event_name": event}
+        for form, fields in FORMS.items():
+            row.update({field: "" for field in fields if field != RECORD_ID_FIELD})
+            row[f"{form}_complete"] = ""
+        return row
+
+    def export_records(
+        self,
+        records: list[str] = [],
+        fields: list[str] = [],
+        forms: list[str] = [],
+        events: list[str] = [],
+        date_range_begin: str = "",
+    ) -> list[dict]:
+        """Exports one row per record per event that has data, in REDCap's order."""
+        wanted_fields = None
+        if fields or forms:
+            wanted_fields = [RECORD_ID_FIELD, "redcap_event_name"] + list(fields)
+            for form in forms:
+                wanted_fields += FORMS.get(form, []) + [f"{form}_complete"]
+            wanted_fields = list(dict.fromkeys(wanted_fields))
+        result = []
+        with self._lock:
+            record_ids = records if records else list(self._records)
+            for record_id in record_ids:
+                record_events = self._records.get(record_id, {})
+                for event in self.events:
+                    if event not in record_events or (events and event not in events):
+                        continue
+                    row, modified_at = record_events[event]
+                    if date_range_begin and modified_at < date_range_begin:
+                        continue
+                    if wanted_fields is None:
+                        result.append(dict(row))
+                    else:
+                        result.append({field: row.get(field, "") for field in wanted_fields})
+        return result
+
+    def handle(self, params: dict[str, str]) -> object:
+        """Answers one API request. Raises ValueError for requests REDCap would refuse."""
+
+        def listed(name: str) -> list[str]:
+            return [value for param, value in params.items() if param.startswith(f"{name}[")]
+
+        content = params.get("content", "")
+        if content == "version":
+            return REDCAP_VERSION
+        if content == "report":
+            return []
+        if content == "record" and params.get("action") == "import":
+            return {"count": self.import_records(json.loads(params.get("data", "[]")))}
+        if content == "record" and params.get("action", "export") == "export":
+            return self.export_records(
+                listed("records"),
+                listed("fields"),
+                listed("forms"),
+                listed("events"),
+                params.get("dateRangeBegin", ""),
+            )
+        raise ValueError(f'The stand-in doesn\'t support content "{content}"')
+
+
+def make_server(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    latency_ms: float = 0,
+    screens: int = DEFAULT_SCREENS,
+) -> ThreadingHTTPServer:
+    """Returns an HTTP server for a new, empty stand-in. Call `serve_forever()` to start it."""
+    standin = REDCapStandIn(screens)
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            params = {
+                name: values[0]
+                for name, values in urllib.parse.parse_qs(body, keep_blank_values=True).items()
+            }
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            try:
+                status, result = 200, standin.handle(params)
+            except (ValueError, KeyError) as e:
+                status, result = 400, {"error": str(e)}
+            content = (result if isinstance(result, str) else json.dumps(result)).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.standin = standin
+    return server
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="wait this long before every answer"
+    )
+    parser.add_argument("--screens", type=int, default=DEFAULT_SCREENS)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency_ms, args.screens)
+    print(
+        f"* REDCap stand-in listening on http://{args.host}:{server.server_port}/api/", flush=True
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
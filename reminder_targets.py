@@ -0,0 +1,193 @@
+"""Lists the participants who should get a reminder email: those who started the survey but haven't
+finished it.
+
+Usage:
+    python reminder_targets.py                           # writes state/reminder_targets.csv
+    python reminder_targets.py --include-not-started     # also remind people who never started
+    python reminder_targets.py --with-emails             # add an "email" column (for bulk_mailer.py)
+
+Needs the same `secrets.json` and access key CSV as the app. Makes one bulk export of the completion
+fields of every event in the experiment's REDCap project (instead of checking each participant's
+progress separately), works out how far every participant got, and joins that against the access
+key CSV. Prints how many participants are at each stage.
+`--with-emails` also exports the C2Cv3 email report ("C2CV3_API_TOKEN" and "C2CV3_EMAILS_REPORT_ID" in
+`secrets.json`); targets without an email address are left out.
+"""
+
+import argparse
+import csv
+import sys
+import time
+from collections import Counter
+from collections.abc import Iterable
+from pathlib import Path
+from typing import NamedTuple
+
+import flask_site
+import redcap_helpers
+
+TARGETS_FILE_PATH = Path(flask_site.PATH_TO_THIS_FOLDER, "state", "reminder_targets.csv")
+
+# Funnel stages, in the order participants go through them
+NOT_STARTED = "not_started"  # no record, or a pre-provisioned record that was never visited
+SKIPPED = "skipped"
+INTRO = "intro"  # started, but hasn't watched the intro video
+SCREENS = "screens"  # watched the intro, but hasn't completed every screen
+OUTRO = "outro"  # completed every screen, but not the final questionnaire
+COMPLETED = "completed"
+STAGES = [NOT_STARTED, SKIPPED, INTRO, SCREENS, OUTRO, COMPLETED]
+
+# Started but didn't finish
+REMINDER_STAGES = {INTRO, SCREENS, OUTRO}
+
+# Every field that says how far a participant got, across all events
+PROGRESS_FIELDS = [
+    flask_site.HASHED_ID_EXPERIMENT_REDCAP_VAR,
+    "survey_tm_start",
+    "skipped",
+    "single_video_complete",
+    "video_complete",
+    "outro_complete",
+]
+
+
+class ParticipantProgress(NamedTuple):
+    stage: str
+    completed_screens: int
+
+
+def funnel_stages(rows: Iterable[dict], max_screens: int) -> dict[str, ParticipantProgress]:
+    """Works out the funnel stage of every participant in an export of `PROGRESS_FIELDS`, in one pass.
+    Participants without any progress (no record, or a pre-provisioned one) aren't included.
+    """
+    started = set()
+    skipped = set()
+    watched_intro = set()
+    completed = set()
+    completed_screens = Counter()
+    for row in rows:
+        access_key = row[flask_site.HASHED_ID_EXPERIMENT_REDCAP_VAR]
+        event = row.get("redcap_event_name", "")
+        if event == "start_arm_1":
+            if row.get("skipped") == "1":
+                skipped.add(access_key)
+            elif row.get("survey_tm_start"):
+                # Pre-provisioned records don't have a start time until their first visit
+                started.add(access_key)
+        elif event == flask_site.INTRO_REDCAP_EVENT:
+            if row.get("single_video_complete") == "2":
+                watched_intro.add(access_key)
+        elif event == "outroscreen_arm_1":
+            if row.get("outro_complete") == "2":
+                completed.add(access_key)
+        elif row.get("video_complete") == "2" and redcap_helpers._get_screen_number(event) > 0:
+            completed_screens[access_key] += 1
+
+    stages = {}
+    for access_key in started | skipped | watched_intro | completed | set(completed_screens):
+        screens = completed_screens[access_key]
+        if access_key in completed:
+            stage = COMPLETED
+        elif access_key in skipped:
+            stage = SKIPPED
+        elif screens >= max_screens:
+            stage = OUTRO
+        elif access_key in watched_intro or screens > 0:
+            stage = SCREENS
+        else:
+            stage = INTRO
+        stages[access_key] = ParticipantProgress(stage, screens)
+    return stages
+
+
+def export_emails(token: str, url: str, report_id: str) -> dict[str, str]:
+    """Returns C2C IDs -> email addresses, from the C2Cv3 project's email report."""
+    return {
+        record["record_id"]: record["start_email"].strip()
+        for record in redcap_helpers.iter_redcap_report(token, url, report_id)
+        if record.get("record_id") and record.get("start_email", "").strip()
+    }
+
+
+def find_targets(
+    include_not_started: bool = False, with_emails: bool = False
+) -> tuple[list[dict], Counter]:
+    """Returns the reminder targets (rows for the output CSV) and the number of participants at each stage."""
+    config = flask_site.flask_app.config
+    start_time = time.perf_counter()
+    stages = funnel_stages(
+        redcap_helpers.iter_records(
+            config["C2C_DCV_API_TOKEN"], config["REDCAP_API_URL"], fields=PROGRESS_FIELDS
+        ),
+        flask_site.MAX_SCREENS,
+    )
+    print(
+        f"* {len(stages)} participant(s) have made progress ({time.perf_counter() - start_time:.1f}s)"
+    )
+    emails = {}
+    if with_emails:
+        emails = export_emails(
+            config["C2CV3_API_TOKEN"], config["REDCAP_API_URL"], config["C2CV3_EMAILS_REPORT_ID"]
+        )
+        print(f"* Exported {len(emails)} email address(es)")
+
+    target_stages = REMINDER_STAGES | ({NOT_STARTED} if include_not_started else set())
+    not_started = ParticipantProgress(NOT_STARTED, 0)
+    stage_counts = Counter()
+    targets = []
+    for access_key, c2c_id in flask_site.access_keys_to_c2c_ids().items():
+        progress = stages.get(access_key, not_started)
+        stage_counts[progress.stage] += 1
+        if progress.stage not in target_stages:
+            continue
+        target = {
+            "c2c_id": c2c_id,
+            "access_key": access_key,
+            "stage": progress.stage,
+            "completed_screens": progress.completed_screens,
+        }
+        if with_emails:
+            if c2c_id not in emails:
+                continue
+            target["email"] = emails[c2c_id]
+        targets.append(target)
+    return (targets, stage_counts)
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--output", type=Path, default=TARGETS_FILE_PATH)
+    parser.add_argument(
+        "--include-not-started",
+        action="store_true",
+        help="also target participants who never started",
+    )
+    parser.add_argument(
+        "--with-emails", action="store_true", help="add email addresses from the C2Cv3 project"
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    targets, stage_counts = find_targets(args.include_not_started, args.with_emails)
+    for stage in STAGES:
+        print(f"{stage:15} {stage_counts[stage]:8}")
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    fieldnames = ["c2c_id", "access_key", "stage", "completed_screens"]
+    if args.with_emails:
+        fieldnames.append("email")
+    with open(args.output, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(targets)
+    print(
+        f"* Wrote {len(targets)} reminder target(s) to {args.output} "
+        f"in {time.perf_counter() - start_time:.1f}s"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,99 @@
+"""A small in-memory cache of fully rendered pages.
+
+Some pages only ever have a handful of distinct renders (e.g. `videos.html` depends on nothing but the
+screen number and its pair of videos), so there's no need to run Jinja for every participant.
+Each entry holds the page's UTF-8 bytes and a gzipped copy made once when it's stored.
+Every entry is dropped when any of the watched files (templates, content) is modified.
+"""
+
+import gzip
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterable
+from pathlib import Path
+from typing import NamedTuple
+
+# Watched files are checked for changes at most this often
+MTIME_CHECK_INTERVAL_SECONDS = 1.0
+
+# gzip level for stored copies; pages are compressed once, so the slowest/smallest level is fine
+GZIP_COMPRESSION_LEVEL = 9
+
+
+class RenderedPage(NamedTuple):
+    body: bytes
+    gzipped_body: bytes
+
+
+class RenderCache:
+    """Least-recently-used cache of rendered pages, holding at most `max_entries` of them."""
+
+    def __init__(self, max_entries: int, watched_paths: Iterable[Path] = ()):
+        self.max_entries = max_entries
+        self.watched_paths = list(watched_paths)
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, RenderedPage] = OrderedDict()
+        # Incremented whenever the cache is emptied, so renders that started before then aren't stored
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._mtimes = self._read_mtimes()
+        self._mtimes_checked_at = time.monotonic()
+
+    def _read_mtimes(self) -> dict[Path, float]:
+        mtimes = {}
+        for path in self.watched_paths:
+            files = sorted(path.rglob("*")) if path.is_dir() else [path]
+            for file in files:
+                try:
+                    mtimes[file] = file.stat().st_mtime
+                except FileNotFoundError:
+                    pass
+        return mtimes
+
+    def _check_watched_paths(self) -> None:
+        """Empties the cache if a watched file was added, removed or modified. Call with the lock held."""
+        now = time.monotonic()
+        if now - self._mtimes_checked_at < MTIME_CHECK_INTERVAL_SECONDS:
+            return
+        self._mtimes_checked_at = now
+        mtimes = self._read_mtimes()
+        if mtimes != self._mtimes:
+            self._mtimes = mtimes
+            self._clear()
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._generation += 1
+
+    def get_or_render(self, key: Hashable, render: Callable[[], str]) -> RenderedPage:
+        """Returns the page stored under `key`, calling `render()` to make it if it isn't cached."""
+        with self._lock:
+            self._check_watched_paths()
+            page = self._entries.get(key)
+            if page is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return page
+            self.misses += 1
+            generation = self._generation
+
+        # Rendered outside the lock; two threads may render the same page once, which is harmless
+        body = render().encode()
+        page = RenderedPage(body, gzip.compress(body, compresslevel=GZIP_COMPRESSION_LEVEL))
+        with self._lock:
+            if generation != self._generation:
+                return page
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return page
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,90 @@
+"""Compact, HMAC-signed tokens that carry a participant's survey progress in a cookie.
+
+A token records which videos a participant was assigned and the last screen they're known to have
+completed, so the survey pages can tell which screen to serve without asking REDCap. Tokens are
+signed with a server-side secret and verified in constant time; a missing, stale or tampered token
+is simply ignored and REDCap is consulted instead.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import time
+from typing import NamedTuple
+
+TOKEN_VERSION = "1"
+
+# Bytes of the HMAC-SHA256 digest kept in each token (128 bits)
+SIGNATURE_LENGTH = 16
+
+
+class SurveyProgress(NamedTuple):
+    access_key: str
+    # 2 per screen: [screen 1 video A, screen 1 video B, screen 2 video A, ...]
+    video_ids: list[str]
+    last_completed_screen: int
+    issued_at: int
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _signature(secret: bytes, body: str) -> str:
+    return _b64encode(hmac.new(secret, body.encode(), hashlib.sha256).digest()[:SIGNATURE_LENGTH])
+
+
+def _fingerprint(all_video_ids: list[str]) -> str:
+    """Short hash of the video list, so tokens stop working if videos.json changes."""
+    return hashlib.sha256("\n".join(all_video_ids).encode()).hexdigest()[:8]
+
+
+def issue_progress_token(secret: bytes, progress: SurveyProgress, all_video_ids: list[str]) -> str:
+    """Returns a signed token for `progress`. Videos are stored as their positions in `all_video_ids`."""
+    video_indices = ".".join(str(all_video_ids.index(video_id)) for video_id in progress.video_ids)
+    payload = "|".join(
+        [
+            TOKEN_VERSION,
+            progress.access_key,
+            _fingerprint(all_video_ids),
+            video_indices,
+            str(progress.last_completed_screen),
+            str(progress.issued_at),
+        ]
+    )
+    body = _b64encode(payload.encode())
+    return f"{body}.{_signature(secret, body)}"
+
+
+def read_progress_token(
+    secret: bytes, token: str, all_video_ids: list[str], max_age_seconds: float
+) -> SurveyProgress | None:
+    """Returns the `SurveyProgress` in `token`, or None if it's malformed, tampered with, older than
+    `max_age_seconds`, or was issued for a different list of videos.
+    """
+    if not token or token.count(".") != 1:
+        return None
+    body, signature = token.split(".")
+    if not hmac.compare_digest(signature.encode(), _signature(secret, body).encode()):
+        return None
+    try:
+        parts = _b64decode(body).decode().split("|")
+        version, access_key, fingerprint, video_indices, last_completed_screen, issued_at = parts
+        if version != TOKEN_VERSION or fingerprint != _fingerprint(all_video_ids):
+            return None
+        video_ids = (
+            [all_video_ids[int(i)] for i in video_indices.split(".")] if video_indices else []
+        )
+        progress = SurveyProgress(
+            access_key, video_ids, int(last_completed_screen), int(issued_at)
+        )
+    except (ValueError, IndexError, UnicodeDecodeError, binascii.Error):
+        return None
+    if time.time() - progress.issued_at > max_age_seconds:
+        return None
+    return progress
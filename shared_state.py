@@ -0,0 +1,201 @@
+"""State shared between every worker process on this host.
+
+Each uvicorn worker is a separate process with its own memory, so anything the workers need to
+agree on (participant claims, rate limits, choice totals) is kept in a local
+SQLite file instead. SQLite's WAL mode lets many readers and a single writer work at the same time, which is
+plenty for the handful of small writes a participant makes per page.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SHARED_STATE_DB_PATH = Path(
+    os.environ.get(
+        "C2C_SHARED_STATE_DB",
+        Path(Path(__file__).resolve().parent, "state", "shared_state.sqlite3"),
+    )
+)
+
+# Seconds to wait for another worker's write to finish before giving up
+BUSY_TIMEOUT = 10
+
+# Expired claims (e.g. left behind by a worker that died holding them) are deleted at most this often
+PURGE_INTERVAL_SECONDS = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """Claims, counters and token buckets stored in a SQLite file shared by all workers.
+    Connections are opened lazily, one per thread, so it's safe to create this before uvicorn
+    forks its workers and to use it from Flask's WSGI threads.
+    """
+
+    def __init__(self, db_path: Path | str = SHARED_STATE_DB_PATH):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._schema_ready = False
+        self._purged_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            # isolation_level=None: autocommit unless a transaction is opened explicitly
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def transaction(self) -> "_Transaction":
+        """Returns a context manager holding SQLite's write lock, for read-modify-write updates."""
+        return _Transaction(self._connect())
+
+    ######## Claims ########
+
+    def delete(self, key: str) -> None:
+        self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def claim(self, key: str, ttl_seconds: float) -> bool:
+        """Atomically claims `key` for `ttl_seconds`.
+        Returns True for exactly one caller across all workers until the claim expires or is released.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(os.getpid()), now + ttl_seconds),
+            )
+            claimed = cursor.rowcount == 1
+        self._maybe_purge()
+        return claimed
+
+    def release(self, key: str) -> None:
+        self.delete(key)
+
+    def purge_expired(self) -> int:
+        """Deletes expired claims. Returns the number of rows removed."""
+        self._purged_at = time.time()
+        cursor = self._connect().execute(
+            "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+    def _maybe_purge(self) -> None:
+        if time.time() - self._purged_at >= PURGE_INTERVAL_SECONDS:
+            self.purge_expired()
+
+    ######## Counters ########
+
+    def incr_many(self, amounts: dict[str, int]) -> None:
+        """Atomically adds to several counters at once (in a single transaction)."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                amounts.items(),
+            )
+
+    def counters(self, prefix: str = "") -> dict[str, int]:
+        """Returns every counter whose name starts with `prefix`."""
+        rows = self._connect().execute(
+            "SELECT name, value FROM counters WHERE substr(name, 1, ?) = ?", (len(prefix), prefix)
+        )
+        return {name: value for name, value in rows}
+
+    ######## Token buckets ########
+
+    def take_token(
+        self, name: str, capacity: float, refill_per_second: float, cost: float = 1
+    ) -> float:
+        """Takes `cost` tokens from a token bucket that holds up to `capacity` tokens (new buckets start
+        full) and refills at `refill_per_second`.
+        Returns 0 if they were taken, otherwise the seconds until there will be enough.
+        """
+        now = time.time()
+        # One statement, so it's atomic without holding a transaction open
+        cursor = self._connect().execute(
+            "INSERT INTO rate_buckets (name, tokens, updated_at) VALUES (:name, :capacity - :cost, :now) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "tokens = min(:capacity, tokens + (:now - updated_at) * :rate) - :cost, updated_at = :now "
+            "WHERE min(:capacity, tokens + (:now - updated_at) * :rate) >= :cost",
+            {
+                "name": name,
+                "capacity": capacity,
+                "cost": cost,
+                "now": now,
+                "rate": refill_per_second,
+            },
+        )
+        if cursor.rowcount == 1:
+            return 0
+        return self.token_wait(name, capacity, refill_per_second, cost)
+
+    def token_wait(
+        self, name: str, capacity: float, refill_per_second: float, cost: float = 1
+    ) -> float:
+        """Returns the seconds until `cost` tokens could be taken from a token bucket (0 if they could
+        be now), without taking any.
+        """
+        row = (
+            self._connect()
+            .execute("SELECT tokens, updated_at FROM rate_buckets WHERE name = ?", (name,))
+            .fetchone()
+        )
+        if row is None:
+            return 0
+        tokens = min(capacity, row[0] + (time.time() - row[1]) * refill_per_second)
+        if tokens >= cost:
+            return 0
+        if refill_per_second <= 0:
+            return float("inf")
+        return (cost - tokens) / refill_per_second
+
+    def purge_full_buckets(self, idle_seconds: float) -> int:
+        """Deletes token buckets that haven't been used for `idle_seconds` (they'd be full again by
+        then, which is what a missing bucket means). Returns the number of rows removed.
+        """
+        cursor = self._connect().execute(
+            "DELETE FROM rate_buckets WHERE updated_at <= ?", (time.time() - idle_seconds,)
+        )
+        return cursor.rowcount
+
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        # IMMEDIATE takes the write lock up front so concurrent read-modify-writes can't interleave
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
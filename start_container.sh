@@ -1,6 +1,11 @@
 #!/bin/bash
 app="c2c-retention"
 port=8080
+# One uvicorn worker per CPU core by default; override with `WORKERS=2 ./start_container.sh`
+workers=${WORKERS:-$(nproc)}
+# Addresses of the reverse proxy, whose X-Forwarded-For header is trusted for client addresses.
+# A proxy on this host reaches the published port from the Docker bridge's gateway.
+proxy_ips=${PROXY_IPS:-172.17.0.1}
 
 echo "Stopping ${app}"
 docker stop ${app}
@@ -15,5 +20,7 @@ echo "Running ${app}"
 docker run -d \
   --restart unless-stopped \
   -p ${port}:${port} \
+  -e WEB_CONCURRENCY=${workers} \
+  -e FORWARDED_ALLOW_IPS=${proxy_ips} \
   --name=${app} \
   -v $PWD:/app ${app}
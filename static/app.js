@@ -15,9 +15,18 @@ const VIDEO_B_HTML_ID = "videoB";
 const VIDEO_B_SELECT_BUTTON_HTML_ID = "videoBSelect";
 const VIDEO_B_MESSAGE_BOX_HTML_ID = "videoBMessage";
 
+// Hidden element holding the next screen's player URLs (only present if there's a next screen)
+const NEXT_VIDEOS_HTML_ID = "nextVideos";
+
 const VIDEO_SUBMIT_BUTTON_HTML_ID = "submitVideoSelection";
 const VIDEO_SUBMIT_LOADING_BUTTON_HTML_ID = "loading_button";
 
+// How often to ask the service worker to retry a queued upload while waiting for it
+const QUEUED_UPLOAD_RETRY_INTERVAL_MS = 10 * 1000;
+
+// Loaded on demand when the videos on a page are shown as poster facades
+const VIMEO_PLAYER_API_URL = "https://player.vimeo.com/api/player.js";
+
 // Number of seconds from the beginning of a video that a user can seek to
 // that counts as "from the beginning" (in case they skipped ahead and need to restart the video)
 const SEEK_BEGINNING_THRESHOLD = 2;
@@ -29,6 +38,8 @@ let videoPageEndTime = "";
 
 let videoA;
 let videoB;
+// Made once per page, so every retry of this screen's upload sends the same key
+const idempotencyKey = newIdempotencyKey();
 
 const _params = new Proxy(new URLSearchParams(window.location.search), {
     get: (searchParams, prop) => searchParams.get(prop),
@@ -81,6 +92,72 @@ function getDefaultVideoStringFromHTML(videoDivID) {
     return "";
 }
 
+let vimeoAPIPromise;
+
+function loadVimeoAPI() {
+    // Resolves once Vimeo's player API is available, loading it if the page didn't include it
+    if (window.Vimeo) {
+        return Promise.resolve();
+    }
+    if (!vimeoAPIPromise) {
+        vimeoAPIPromise = new Promise(function (resolve, reject) {
+            let script = document.createElement("script");
+            script.src = VIMEO_PLAYER_API_URL;
+            script.onload = resolve;
+            script.onerror = function () {
+                vimeoAPIPromise = undefined;
+                reject();
+            };
+            document.head.appendChild(script);
+        });
+    }
+    return vimeoAPIPromise;
+}
+
+function formatDuration(totalSeconds) {
+    let minutes = Math.floor(totalSeconds / 60);
+    let seconds = String(Math.round(totalSeconds % 60)).padStart(2, "0");
+    return `${minutes}:${seconds}`;
+}
+
+function showVideoFacade(videoDivID, posterURL, durationSeconds, onActivate) {
+    // Shows a poster frame with a play button in place of a Vimeo player, which is only loaded
+    // (by onActivate) when the participant clicks it
+    let videoElement = document.getElementById(videoDivID);
+    let facade = document.createElement("button");
+    facade.type = "button";
+    facade.className = "video-facade";
+    facade.setAttribute("aria-label", "Play video");
+    let poster = document.createElement("img");
+    poster.src = posterURL;
+    poster.alt = "";
+    facade.appendChild(poster);
+    let playIcon = document.createElement("span");
+    playIcon.className = "video-facade-play";
+    facade.appendChild(playIcon);
+    if (durationSeconds > 0) {
+        let duration = document.createElement("span");
+        duration.className = "video-facade-duration";
+        duration.innerText = formatDuration(durationSeconds);
+        facade.appendChild(duration);
+    }
+    // Start fetching the player API as soon as the participant looks like they'll click
+    facade.addEventListener("pointerenter", function () { loadVimeoAPI().catch(function () { }); }, { once: true });
+    facade.addEventListener("click", function () {
+        facade.disabled = true;
+        onActivate(facade);
+    }, { once: true });
+    videoElement.appendChild(facade);
+}
+
+function newIdempotencyKey() {
+    // Identifies one submission of this page, so the server can recognize the same upload sent again
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
 function getUTCTimestampNow(includeMilliseconds = true) {
     // YYYY-MM-DD hh:mm:ss.mis
     const d = new Date();
@@ -200,8 +277,33 @@ async function init() {
     }
 
     // Initialize Vimeo player inside their respective VideoChoice objects
-    videoA.player = new Vimeo.Player(VIDEO_A_HTML_ID, { url: videoA.url });
-    videoB.player = new Vimeo.Player(VIDEO_B_HTML_ID, { url: videoB.url });
+    // Videos with a poster get a facade instead, and their player is created when it's clicked
+    function startPlayer(videoObj, videoDivID, otherVideoObj, playNow) {
+        videoObj.player = new Vimeo.Player(videoDivID, { url: videoObj.url });
+        setupPlayerEvents(videoObj, otherVideoObj);
+        if (playNow) {
+            // Browsers may block this; the participant can still press play in the player
+            videoObj.player.play().catch(function () { });
+        }
+    }
+    for (const [videoObj, videoDivID, otherVideoObj] of [[videoA, VIDEO_A_HTML_ID, videoB], [videoB, VIDEO_B_HTML_ID, videoA]]) {
+        let posterURL = document.getElementById(videoDivID).dataset.poster;
+        if (posterURL) {
+            let durationSeconds = parseFloat(document.getElementById(videoDivID).dataset.duration);
+            showVideoFacade(videoDivID, posterURL, durationSeconds, function (facade) {
+                loadVimeoAPI().then(function () {
+                    facade.remove();
+                    startPlayer(videoObj, videoDivID, otherVideoObj, true);
+                }, function () {
+                    // Couldn't load the player API; let the participant try again
+                    facade.disabled = false;
+                    facade.addEventListener("click", function () { window.location.reload(); }, { once: true });
+                });
+            });
+        } else {
+            startPlayer(videoObj, videoDivID, otherVideoObj, false);
+        }
+    }
     // console.log(`Loaded Video A: ${videoA.getLog()}`);
     // console.log(`Loaded Video B: ${videoB.getLog()}`);
 
@@ -217,7 +319,8 @@ async function init() {
         // console.log(_videoMessageBoxElement.innerText);
         videoObj.player.on('play', function (data) {
             // Automatically pause when the other video is already playing:
-            otherVideoObj.player.getPaused().then(function (paused) {
+            // (the other video may still be a facade without a player)
+            if (otherVideoObj.player) otherVideoObj.player.getPaused().then(function (paused) {
                 if (paused == false) {
                     otherVideoObj.player.pause().then(function () {
                         // console.log("Paused the other Vimeo player.");
@@ -330,8 +433,6 @@ async function init() {
         //     }
         // })
     }
-    setupPlayerEvents(videoA, otherVideoObj = videoB);
-    setupPlayerEvents(videoB, otherVideoObj = videoA);
 }
 
 async function uploadVideoSelection() {
@@ -374,23 +475,87 @@ async function uploadVideoSelection() {
                 vidB_playback_time_end: videoB.endTimestamp,
                 vidB_watch_count: videoB.watchCount,
                 vidB_logs: videoB.logs,
+                vidA_id: videoA.vid_id,
+                vidB_id: videoB.vid_id,
                 selected_vid_id: selectedVideo.vid_id,
                 selected_vid_position: selectedVideo.position,
-                screen_time_end: videoPageEndTime
+                screen_time_end: videoPageEndTime,
+                idempotency_key: idempotencyKey
             })
         }
         const url = `${server}/video_selected?key=${access_key}`;
-        await fetch(url, requestOptions);
+        let response;
+        try {
+            response = await fetch(url, requestOptions);
+        } catch (e) {
+            // No service worker to queue the upload, and it couldn't be sent
+            alert("Your selection couldn't be sent. Please check your internet connection and try again.");
+            finalSelectionLoadingButton.setAttribute('hidden', '');
+            finalSelectionButton.removeAttribute('hidden');
+            return;
+        }
+        if (response.status === 202) {
+            // The service worker queued the upload; the next screen depends on it, so wait until it's sent
+            await waitForQueuedUpload(url);
+        }
         window.location.href = `${server}/survey/videos?key=${access_key}&screen=${actualScreen + 1}`;
     } else {
         alert("Please finish watching all videos before making a selection.");
     }
 }
 
+function waitForQueuedUpload(url) {
+    // Resolves when the service worker reports that the queued upload to `url` was sent
+    finalSelectionLoadingButton.lastChild.textContent = " Waiting for an internet connection....";
+    return new Promise(function (resolve) {
+        function askForRetry() {
+            if (navigator.serviceWorker.controller) {
+                navigator.serviceWorker.controller.postMessage({ type: "retry-queued-uploads" });
+            }
+        }
+        const retryInterval = setInterval(askForRetry, QUEUED_UPLOAD_RETRY_INTERVAL_MS);
+        window.addEventListener("online", askForRetry);
+        navigator.serviceWorker.addEventListener("message", function onMessage(event) {
+            if (event.data && event.data.type === "queued-upload-sent" && event.data.url === new URL(url, window.location.href).href) {
+                clearInterval(retryInterval);
+                window.removeEventListener("online", askForRetry);
+                navigator.serviceWorker.removeEventListener("message", onMessage);
+                resolve();
+            }
+        });
+    });
+}
+
 function activateSelectionButton() {
     if (finalSelectionButton.hasAttribute("disabled")) {
         finalSelectionButton.disabled = false;
     }
+    warmNextScreen();
+}
+
+let warmedNextScreen = false;
+
+function warmNextScreen() {
+    // Once a video is picked, the participant is about to move on: fetch the next screen's players
+    // in the background so they load from cache. Waiting until now keeps bandwidth free for the
+    // videos being watched.
+    let nextVideosElement = document.getElementById(NEXT_VIDEOS_HTML_ID);
+    if (warmedNextScreen || !nextVideosElement) {
+        return;
+    }
+    warmedNextScreen = true;
+    let nextURLs = [nextVideosElement.dataset.vidAUrl, nextVideosElement.dataset.vidBUrl];
+    for (const posterURL of [nextVideosElement.dataset.vidAPoster, nextVideosElement.dataset.vidBPoster]) {
+        if (posterURL) {
+            nextURLs.push(posterURL);
+        }
+    }
+    for (const url of nextURLs) {
+        let link = document.createElement("link");
+        link.rel = "prefetch";
+        link.href = url;
+        document.head.appendChild(link);
+    }
 }
 
 function setVideoBoxClasses() {
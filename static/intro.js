@@ -14,6 +14,8 @@ const SEEK_BEGINNING_THRESHOLD = 2;
 let videoPageStartTime = "";
 let videoPageEndTime = "";
 let introVid;
+// Made once per page, so every retry of this page's upload sends the same key
+const idempotencyKey = newIdempotencyKey();
 
 const _params = new Proxy(new URLSearchParams(window.location.search), {
     get: (searchParams, prop) => searchParams.get(prop),
@@ -48,6 +50,14 @@ function parseVimeoResponse(data, attr) {
     }
 };
 
+function newIdempotencyKey() {
+    // Identifies one submission of this page, so the server can recognize the same upload sent again
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
 function getUTCTimestampNow(includeMilliseconds = true) {
     // YYYY-MM-DD hh:mm:ss.mis
     const d = new Date();
@@ -232,6 +242,7 @@ async function uploadVideoSelection() {
             vid_watch_count: introVid.watchCount,
             vid_logs: introVid.logs,
             vid_id: introVid.vid_id,
+            idempotency_key: idempotencyKey,
         })
     }
     // console.log(introVid.logs);
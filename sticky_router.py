@@ -0,0 +1,362 @@
+"""A small reverse proxy that sends every participant to the same node, for deployments with several
+containers (nodes).
+
+Usage:
+    python sticky_router.py --nodes nodes.json                 # listens on 0.0.0.0:8080
+    python sticky_router.py --nodes nodes.json --port 9000
+
+`nodes.json` names the nodes and their URLs:
+    {"nodes": {"node-a": "http://10.0.0.11:8080", "node-b": "http://10.0.0.12:8080"}}
+
+Each access key is hashed onto a ring of `VNODES_PER_NODE` points per node (consistent hashing), and
+its requests go to the node that owns it. Per-process caches (the upload ledger, the render cache, the
+ID index) then stay warm, and the per-node guarantees in `shared_state.py` (e.g. that only one request
+creates a participant's REDCap record) hold for the whole deployment.
+
+The file is reloaded when it changes, and every node's `/retention/readyz` is checked every
+`HEALTH_CHECK_INTERVAL_SECONDS`. A node that's added, removed or failing only moves the keys it
+gains or loses (about 1/N of them); every other participant stays where they were.
+
+The contract with the nodes and the browser (see README "Sticky routing"):
+  * The key comes from the `key` query parameter, or from the `key` field of a form post (`/check`).
+  * Requests without a key go to the node in the `c2c_node` cookie, which is set whenever a keyed
+    request is routed, so pages like `/thankyou` land on the same node. Otherwise they're spread
+    round-robin.
+  * Requests sent to a node carry `X-C2C-Node` (the node it was routed to) and the usual
+    `X-Forwarded-For`/`-Proto`/`-Host` headers. `X-Forwarded-For` is only the address the router was
+    connected from, never what the client sent. Responses carry `X-C2C-Node` too.
+"""
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import sys
+import urllib.parse
+from pathlib import Path
+
+import httpx
+import uvicorn
+
+VNODES_PER_NODE = 160
+
+NODE_COOKIE_NAME = "c2c_node"
+NODE_HEADER = "x-c2c-node"
+
+READY_PATH = "/retention/readyz"
+HEALTH_CHECK_INTERVAL_SECONDS = 5
+HEALTH_CHECK_TIMEOUT_SECONDS = 2
+# Form posts bigger than this aren't searched for a key (the access key form is tiny)
+MAX_FORM_BYTES_FOR_KEY = 4096
+
+PROXY_TIMEOUT = httpx.Timeout(60, connect=3)
+
+# Not forwarded in either direction (RFC 9110, section 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+def ring_hash(value: str) -> int:
+    """The same on every machine and in every process (unlike `hash()`)."""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def normalize_key(raw_key: str) -> str:
+    """Decodes and strips a key the same way `flask_site.sanitize_key()` does, so every spelling of
+    a key is routed to the same node. Keys aren't validated here; the node does that.
+    """
+    if "%" in raw_key or "+" in raw_key:
+        raw_key = urllib.parse.unquote_plus(raw_key)
+    return raw_key.strip()
+
+
+class HashRing:
+    def __init__(self, nodes: list[str], vnodes_per_node: int = VNODES_PER_NODE):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes_per_node)
+        )
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
+
+    def owners(self, key: str, count: int = 1) -> list[str]:
+        """Returns the node that owns `key`, followed by the next `count` - 1 distinct nodes on the ring
+        (where the key goes if the nodes before them are down).
+        """
+        if not self._hashes:
+            return []
+        owners = []
+        start = bisect.bisect(self._hashes, ring_hash(key))
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == count:
+                    break
+        return owners
+
+    def owner(self, key: str) -> str | None:
+        owners = self.owners(key)
+        return owners[0] if owners else None
+
+
+def moved_fraction(old_ring: HashRing, new_ring: HashRing, samples: int = 10000) -> float:
+    """Estimates the fraction of keys that have a different owner in `new_ring`."""
+    moved = sum(
+        1 for i in range(samples) if old_ring.owner(f"sample{i}") != new_ring.owner(f"sample{i}")
+    )
+    return moved / samples
+
+
+def read_nodes_file(nodes_file: Path) -> dict[str, str]:
+    """Returns node name -> base URL."""
+    with open(nodes_file) as infile:
+        nodes = json.load(infile)["nodes"]
+    return {name: url.rstrip("/") for name, url in nodes.items()}
+
+
+class StickyRouter:
+    """ASGI app that proxies each request to the node that owns its access key."""
+
+    def __init__(self, nodes_file: Path, vnodes_per_node: int = VNODES_PER_NODE):
+        self.nodes_file = Path(nodes_file)
+        self.vnodes_per_node = vnodes_per_node
+        self.node_urls: dict[str, str] = {}
+        self.healthy: set[str] = set()
+        self.ring = HashRing([], vnodes_per_node)
+        self._nodes_file_mtime = None
+        self._round_robin = itertools.count()
+        self._client: httpx.AsyncClient | None = None
+        self._health_task: asyncio.Task | None = None
+        self.load_nodes()
+
+    def _rebuild_ring(self, reason: str) -> None:
+        # If every node is failing its health checks, trying them anyway beats refusing everyone
+        nodes = [node for node in self.node_urls if node in self.healthy] or list(self.node_urls)
+        new_ring = HashRing(nodes, self.vnodes_per_node)
+        if new_ring.nodes == self.ring.nodes:
+            return
+        moved = ""
+        if self.ring.nodes:
+            moved = f"; about {moved_fraction(self.ring, new_ring):.0%} of participants moved"
+        print(f"* Routing to {new_ring.nodes} ({reason}){moved}", flush=True)
+        # Replaced in one assignment, so requests see either the old ring or the new one
+        self.ring = new_ring
+
+    def load_nodes(self) -> None:
+        """(Re)loads the nodes file if it changed. New nodes count as healthy until checked."""
+        try:
+            mtime = self.nodes_file.stat().st_mtime
+            if mtime == self._nodes_file_mtime:
+                return
+            node_urls = read_nodes_file(self.nodes_file)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"***** Couldn't load nodes from {self.nodes_file}: {repr(e)}", flush=True)
+            return
+        self._nodes_file_mtime = mtime
+        self.healthy = {node for node in self.healthy if node in node_urls} | (
+            set(node_urls) - set(self.node_urls)
+        )
+        self.node_urls = node_urls
+        self._rebuild_ring(f"loaded {self.nodes_file}")
+
+    async def _check_health(self) -> None:
+        async def is_ready(url: str) -> bool:
+            try:
+                response = await self._client.get(
+                    url + READY_PATH, timeout=HEALTH_CHECK_TIMEOUT_SECONDS
+                )
+                return response.status_code == 200
+            except httpx.HTTPError:
+                return False
+
+        while True:
+            try:
+                self.load_nodes()
+                names = list(self.node_urls)
+                results = await asyncio.gather(*(is_ready(self.node_urls[name]) for name in names))
+                healthy = {name for name, ready in zip(names, results) if ready}
+                if healthy != self.healthy:
+                    changes = [f"{name} up" for name in healthy - self.healthy]
+                    changes += [f"{name} down" for name in self.healthy - healthy]
+                    self.healthy = healthy
+                    self._rebuild_ring(", ".join(sorted(changes)))
+            except Exception as e:
+                print(f"***** Health check failed: {repr(e)}", flush=True)
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
+
+    def route(self, key: str, cookie_node: str) -> list[str]:
+        """Returns the nodes to try for a request, best first."""
+        ring = self.ring
+        if key:
+            return ring.owners(key, 2)
+        if cookie_node in ring.nodes:
+            return [cookie_node]
+        if not ring.nodes:
+            return []
+        return [ring.nodes[next(self._round_robin) % len(ring.nodes)]]
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._client = httpx.AsyncClient(
+                    timeout=PROXY_TIMEOUT,
+                    follow_redirects=False,
+                    limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+                )
+                self._health_task = asyncio.create_task(self._check_health())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._health_task.cancel()
+                await self._client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        headers = [
+            (name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]
+        ]
+        header_values = {}
+        for name, value in headers:
+            header_values.setdefault(name.lower(), value)
+
+        query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        key = query.get("key", [""])[0]
+        if (
+            not key
+            and header_values.get("content-type", "").startswith(
+                "application/x-www-form-urlencoded"
+            )
+            and len(body) <= MAX_FORM_BYTES_FOR_KEY
+        ):
+            key = urllib.parse.parse_qs(body.decode("latin-1")).get("key", [""])[0]
+        key = normalize_key(key)
+        cookies = {}
+        for cookie in header_values.get("cookie", "").split(";"):
+            name, _, value = cookie.strip().partition("=")
+            cookies[name] = value
+
+        # Replaced rather than appended to: the nodes trust it, and the client controls what it sent
+        client = scope.get("client")
+        forwarded_for = client[0] if client else ""
+        upstream_headers = [
+            (name, value)
+            for name, value in headers
+            if name.lower() not in HOP_BY_HOP_HEADERS
+            and name.lower() not in ("x-forwarded-for", NODE_HEADER)
+        ]
+        upstream_headers += [
+            ("x-forwarded-for", forwarded_for),
+            (
+                "x-forwarded-proto",
+                header_values.get("x-forwarded-proto", scope.get("scheme", "http")),
+            ),
+            ("x-forwarded-host", header_values.get("host", "")),
+        ]
+        url_path = urllib.parse.quote(scope["path"])
+        if scope.get("query_string"):
+            url_path += "?" + scope["query_string"].decode("latin-1")
+
+        for node in self.route(key, cookies.get(NODE_COOKIE_NAME, "")):
+            request = self._client.build_request(
+                scope["method"],
+                self.node_urls[node] + url_path,
+                headers=upstream_headers + [(NODE_HEADER, node)],
+                content=body,
+            )
+            try:
+                response = await self._client.send(request, stream=True)
+            except httpx.ConnectError as e:
+                # Nothing was sent, so the next node on the ring can safely take it
+                print(f"***** Couldn't reach {node}: {repr(e)}", flush=True)
+                continue
+            except httpx.HTTPError as e:
+                print(f"***** Request to {node} failed: {repr(e)}", flush=True)
+                return await self._respond(send, 502, b"Bad gateway")
+            try:
+                response_headers = [
+                    (name.encode("latin-1"), value.encode("latin-1"))
+                    for name, value in response.headers.multi_items()
+                    if name.lower() not in HOP_BY_HOP_HEADERS
+                ]
+                response_headers.append((NODE_HEADER.encode(), node.encode()))
+                if key and cookies.get(NODE_COOKIE_NAME) != node:
+                    response_headers.append(
+                        (
+                            b"set-cookie",
+                            f"{NODE_COOKIE_NAME}={node}; Path=/; HttpOnly; SameSite=Lax".encode(),
+                        )
+                    )
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": response.status_code,
+                        "headers": response_headers,
+                    }
+                )
+                # Passed along as it arrives, so server-sent events (the dashboard) keep working
+                async for chunk in response.aiter_raw():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                await response.aclose()
+            return
+        await self._respond(send, 503, b"No node is available. Please try again in a moment.")
+
+    async def _respond(self, send, status: int, body: bytes) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"5"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--nodes", type=Path, required=True, help="JSON file of node names and URLs"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--vnodes", type=int, default=VNODES_PER_NODE, help="ring points per node")
+    args = parser.parse_args()
+
+    router = StickyRouter(args.nodes, args.vnodes)
+    uvicorn.run(router, host=args.host, port=args.port, log_level="warning", proxy_headers=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
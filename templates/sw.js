@@ -0,0 +1,232 @@
+//////// Survey service worker ////////
+// Served by flask_site.service_worker() (rendered with Jinja), scoped to the survey pages.
+// 1. Serves the versioned static files cache-first, so pages don't re-download them.
+// 2. Queues uploads (video selections, intro video data) in IndexedDB when they can't reach the
+//    server, and sends them again with backoff. The upload endpoints ignore duplicate submissions,
+//    so an upload that's sent more than once is only recorded once.
+
+const STATIC_CACHE_NAME = "c2c-static-{{ static_version }}";
+const STATIC_URL_PREFIX = {{ static_url_prefix|tojson }};
+const PRECACHE_URLS = {{ precache_urls|tojson }};
+const QUEUED_UPLOAD_PATHS = {{ queued_upload_paths|tojson }};
+
+const QUEUE_DB_NAME = "c2c-upload-queue";
+const QUEUE_STORE_NAME = "uploads";
+
+// Retry delays double from MIN to MAX
+const MIN_RETRY_DELAY_MS = 2 * 1000;
+const MAX_RETRY_DELAY_MS = 5 * 60 * 1000;
+// Uploads that still haven't been sent after this long are dropped
+const MAX_QUEUED_AGE_MS = 7 * 24 * 60 * 60 * 1000;
+
+//// Static files ////
+
+self.addEventListener("install", function (event) {
+    event.waitUntil(
+        caches.open(STATIC_CACHE_NAME)
+            .then(function (cache) { return cache.addAll(PRECACHE_URLS); })
+            .then(function () { return self.skipWaiting(); })
+    );
+});
+
+self.addEventListener("activate", function (event) {
+    event.waitUntil(
+        caches.keys()
+            .then(function (names) {
+                // Remove caches of older versions of the static files
+                return Promise.all(names
+                    .filter(function (name) { return name.startsWith("c2c-static-") && name !== STATIC_CACHE_NAME; })
+                    .map(function (name) { return caches.delete(name); }));
+            })
+            .then(function () { return self.clients.claim(); })
+            .then(function () { return replayQueuedUploads(true); })
+    );
+});
+
+async function cacheFirst(request) {
+    const cached = await caches.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.ok) {
+        const cache = await caches.open(STATIC_CACHE_NAME);
+        cache.put(request, response.clone());
+    }
+    return response;
+}
+
+//// Upload queue (IndexedDB) ////
+
+function openQueue() {
+    return new Promise(function (resolve, reject) {
+        const open = indexedDB.open(QUEUE_DB_NAME, 1);
+        open.onupgradeneeded = function () {
+            open.result.createObjectStore(QUEUE_STORE_NAME, { keyPath: "id", autoIncrement: true });
+        };
+        open.onsuccess = function () { resolve(open.result); };
+        open.onerror = function () { reject(open.error); };
+    });
+}
+
+async function withQueueStore(mode, action) {
+    const db = await openQueue();
+    return new Promise(function (resolve, reject) {
+        const transaction = db.transaction(QUEUE_STORE_NAME, mode);
+        const result = action(transaction.objectStore(QUEUE_STORE_NAME));
+        transaction.oncomplete = function () { db.close(); resolve(result.result); };
+        transaction.onerror = function () { db.close(); reject(transaction.error); };
+    });
+}
+
+function addQueuedUpload(upload) {
+    return withQueueStore("readwrite", function (store) { return store.add(upload); });
+}
+
+function getQueuedUploads() {
+    return withQueueStore("readonly", function (store) { return store.getAll(); });
+}
+
+function putQueuedUpload(upload) {
+    return withQueueStore("readwrite", function (store) { return store.put(upload); });
+}
+
+function deleteQueuedUpload(id) {
+    return withQueueStore("readwrite", function (store) { return store.delete(id); });
+}
+
+function retryDelay(attempts) {
+    return Math.min(MIN_RETRY_DELAY_MS * Math.pow(2, attempts), MAX_RETRY_DELAY_MS);
+}
+
+function isDelivered(response) {
+    // Other 4xx responses mean the server got the upload and won't accept it if it's sent again either
+    return response.status < 500 && response.status !== 429;
+}
+
+async function notifyClients(message) {
+    const clients = await self.clients.matchAll({ includeUncontrolled: true });
+    for (const client of clients) {
+        client.postMessage(message);
+    }
+}
+
+let replayTimer;
+let replaying = false;
+
+function scheduleReplay(delayMs) {
+    // Only keeps running while the browser keeps this worker alive; pages waiting for an upload
+    // also ask for a retry (see app.js), and so does every new page load
+    clearTimeout(replayTimer);
+    replayTimer = setTimeout(function () { replayQueuedUploads(false); }, delayMs);
+}
+
+async function replayQueuedUploads(force) {
+    // Sends every queued upload that's due for another attempt (or all of them, if `force`)
+    if (replaying) {
+        return;
+    }
+    replaying = true;
+    try {
+        const uploads = await getQueuedUploads();
+        const now = Date.now();
+        let nextAttemptAt = Infinity;
+        for (const upload of uploads) {
+            if (now - upload.queuedAt > MAX_QUEUED_AGE_MS) {
+                await deleteQueuedUpload(upload.id);
+                continue;
+            }
+            if (!force && upload.nextAttemptAt > now) {
+                nextAttemptAt = Math.min(nextAttemptAt, upload.nextAttemptAt);
+                continue;
+            }
+            let response;
+            try {
+                response = await fetch(upload.url, {
+                    method: "POST",
+                    headers: { "Content-Type": upload.contentType },
+                    body: upload.body,
+                    credentials: "same-origin",
+                });
+            } catch (e) {
+                response = undefined;
+            }
+            if (response && isDelivered(response)) {
+                await deleteQueuedUpload(upload.id);
+                await notifyClients({ type: "queued-upload-sent", url: upload.url });
+            } else {
+                upload.attempts += 1;
+                upload.nextAttemptAt = Date.now() + retryDelay(upload.attempts);
+                await putQueuedUpload(upload);
+                nextAttemptAt = Math.min(nextAttemptAt, upload.nextAttemptAt);
+            }
+        }
+        if (nextAttemptAt !== Infinity) {
+            scheduleReplay(Math.max(nextAttemptAt - Date.now(), 0));
+        }
+    } finally {
+        replaying = false;
+    }
+}
+
+async function sendOrQueueUpload(request) {
+    const body = await request.clone().text();
+    try {
+        const response = await fetch(request);
+        if (isDelivered(response)) {
+            return response;
+        }
+    } catch (e) {
+        // Offline or the connection dropped; queue it below
+    }
+    await addQueuedUpload({
+        url: request.url,
+        contentType: request.headers.get("Content-Type") || "application/json",
+        body: body,
+        queuedAt: Date.now(),
+        attempts: 0,
+        nextAttemptAt: Date.now() + MIN_RETRY_DELAY_MS,
+    });
+    scheduleReplay(MIN_RETRY_DELAY_MS);
+    if (self.registration.sync) {
+        // Background Sync (where supported) retries even after the participant closes the page
+        self.registration.sync.register("c2c-upload-queue").catch(function () { });
+    }
+    return new Response(JSON.stringify({ queued: true }), {
+        status: 202,
+        headers: { "Content-Type": "application/json" },
+    });
+}
+
+//// Events ////
+
+self.addEventListener("fetch", function (event) {
+    const url = new URL(event.request.url);
+    if (url.origin !== self.location.origin) {
+        return;
+    }
+    if (event.request.mode === "navigate") {
+        // Every page load is a chance to send uploads that are still waiting
+        event.waitUntil(replayQueuedUploads(false));
+        return;
+    }
+    if (event.request.method === "POST" && QUEUED_UPLOAD_PATHS.includes(url.pathname)) {
+        event.respondWith(sendOrQueueUpload(event.request));
+        return;
+    }
+    if (event.request.method === "GET" && url.pathname.startsWith(STATIC_URL_PREFIX)) {
+        event.respondWith(cacheFirst(event.request));
+    }
+});
+
+self.addEventListener("sync", function (event) {
+    if (event.tag === "c2c-upload-queue") {
+        event.waitUntil(replayQueuedUploads(true));
+    }
+});
+
+self.addEventListener("message", function (event) {
+    if (event.data && event.data.type === "retry-queued-uploads") {
+        event.waitUntil(replayQueuedUploads(true));
+    }
+});
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+import json_codec
+
+SAMPLE = (
+    '[{"access_key": "abc", "n": 1.5, "e": 2e10, "neg": -0.25E-3}, 12, 3.25, 1e5, -7, true, null,'
+    ' "caf\\u00e9 é", [1.0, [2e-2]], {}, []]'
+)
+
+
+@pytest.mark.parametrize("offset", range(len(SAMPLE.encode()) + 1))
+def test_iter_json_array_any_split(offset):
+    data = SAMPLE.encode()
+    chunks = [data[:offset], data[offset:]]
+    assert list(json_codec.iter_json_array(chunks)) == json.loads(SAMPLE)
+
+
+def test_iter_json_array_byte_at_a_time():
+    data = SAMPLE.encode()
+    chunks = [data[i : i + 1] for i in range(len(data))]
+    assert list(json_codec.iter_json_array(chunks)) == json.loads(SAMPLE)
+
+
+def test_iter_json_array_not_an_array():
+    assert list(json_codec.iter_json_array([b'{"error": ', b'"bad token"}'])) == [
+        {"error": "bad token"}
+    ]
+
+
+@pytest.mark.parametrize("chunks", [[b"[1, 2"], [b"[1 2]"], [b"[1,]"], [b""]])
+def test_iter_json_array_malformed(chunks):
+    with pytest.raises(json.JSONDecodeError):
+        list(json_codec.iter_json_array(chunks))
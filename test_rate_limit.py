@@ -0,0 +1,159 @@
+import asyncio
+
+import pytest
+
+import rate_limit
+import shared_state
+
+BUDGET = rate_limit.BAD_KEY_BUDGET_PER_IP
+
+
+class Clock:
+    """Stands in for the `time` module in shared_state, so buckets can be refilled on demand."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(shared_state, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def state(tmp_path):
+    return shared_state.SharedState(tmp_path / "shared_state.sqlite3")
+
+
+def test_take_burst_then_refill(state, clock):
+    budget = rate_limit.Budget(burst=3, per_minute=60)
+    assert [rate_limit.take(state, "b", budget) for _ in range(3)] == [0, 0, 0]
+    assert rate_limit.take(state, "b", budget) == pytest.approx(1)
+    clock.now += 1
+    assert rate_limit.take(state, "b", budget) == 0
+    assert rate_limit.take(state, "b", budget) > 0
+
+
+def test_refused_take_doesnt_spend_tokens(state, clock):
+    budget = rate_limit.Budget(burst=1, per_minute=60)
+    assert rate_limit.take(state, "b", budget) == 0
+    for _ in range(5):
+        assert rate_limit.take(state, "b", budget) > 0
+    clock.now += 1
+    assert rate_limit.take(state, "b", budget) == 0
+
+
+def test_time_until_available_doesnt_take(state, clock):
+    budget = rate_limit.Budget(burst=1, per_minute=60)
+    assert rate_limit.time_until_available(state, "b", budget) == 0
+    assert rate_limit.time_until_available(state, "b", budget) == 0
+    assert rate_limit.take(state, "b", budget) == 0
+    assert rate_limit.time_until_available(state, "b", budget) == pytest.approx(1)
+
+
+def test_bad_key_budget(state, clock):
+    for _ in range(BUDGET.burst):
+        assert rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=False) == 0
+    assert rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=False) > 0
+
+
+def test_bad_key_budget_refuses_valid_keys_once_used_up(state, clock):
+    for _ in range(BUDGET.burst):
+        rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=False)
+    # Otherwise a guess that isn't refused would give a valid key away
+    assert rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=True) > 0
+    # Other clients are unaffected
+    assert rate_limit.check_bad_key_budget(state, "5.6.7.8", valid_key=True) == 0
+    assert rate_limit.check_bad_key_budget(state, "5.6.7.8", valid_key=False) == 0
+
+    clock.now += 60 / BUDGET.per_minute + 1
+    assert rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=True) == 0
+
+
+def test_valid_keys_dont_spend_bad_key_budget(state, clock):
+    for _ in range(BUDGET.burst * 3):
+        assert rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=True) == 0
+    assert rate_limit.check_bad_key_budget(state, "1.2.3.4", valid_key=False) == 0
+
+
+################################
+########## MIDDLEWARE ##########
+
+
+def _request(middleware, path: str, query: str = "", client: str = "1.2.3.4") -> int:
+    """Sends a GET request through `middleware` and returns the response status."""
+    statuses = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [],
+        "client": (client, 1234),
+    }
+    asyncio.run(middleware(scope, receive, send))
+    return statuses[0]
+
+
+async def _ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def _middleware(state, **kwargs) -> rate_limit.RateLimitMiddleware:
+    return rate_limit.RateLimitMiddleware(
+        _ok_app,
+        upload_paths=["/upload"],
+        exempt_path_prefixes=["/healthz"],
+        state=state,
+        **kwargs,
+    )
+
+
+def test_middleware_limits_each_key(state, clock):
+    middleware = _middleware(state)
+    burst = rate_limit.PAGE_BUDGET_PER_KEY.burst
+    # Different addresses, so only the key's bucket runs out
+    statuses = [
+        _request(middleware, "/videos", "key=abcdefghijkl", client=f"10.0.0.{i}")
+        for i in range(burst + 1)
+    ]
+    assert statuses == [200] * burst + [429]
+    assert _request(middleware, "/videos", "key=otherkey0000", client="10.0.1.1") == 200
+
+
+def test_middleware_uploads_have_their_own_budget(state, clock):
+    middleware = _middleware(state)
+    for _ in range(rate_limit.PAGE_BUDGET_PER_IP.burst):
+        _request(middleware, "/videos")
+    assert _request(middleware, "/videos") == 429
+    assert _request(middleware, "/upload") == 200
+
+
+def test_middleware_exempt_paths(state, clock):
+    middleware = _middleware(state)
+    for _ in range(rate_limit.PAGE_BUDGET_PER_IP.burst + 5):
+        assert _request(middleware, "/healthz") == 200
+
+
+def test_middleware_fails_open(state, clock):
+    def broken(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    state.take_token = broken
+    middleware = _middleware(state)
+    for _ in range(rate_limit.PAGE_BUDGET_PER_IP.burst + 5):
+        assert _request(middleware, "/videos") == 200
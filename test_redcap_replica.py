@@ -0,0 +1,226 @@
+import threading
+
+import pytest
+
+import redcap_helpers
+import redcap_replica
+import redcap_standin
+
+TOKEN = "test token"
+MAX_SCREENS = redcap_standin.DEFAULT_SCREENS
+
+
+def _participant(access_key: str, completed_screens: int, started: bool = True) -> list[dict]:
+    """REDCap rows for a participant who has completed `completed_screens` screens."""
+    start = {"access_key": access_key, "c2c_id": f"c2c-{access_key}"}
+    if started:
+        start |= {"survey_tm_start": "2026-10-01 10:00:00", "user_agent": "Mozilla/5.0"}
+    rows = [start]
+    for screen in range(1, MAX_SCREENS + 1):
+        row = {
+            "access_key": access_key,
+            "redcap_event_name": f"screen{screen}_arm_1",
+            "video_a": f"{access_key}-{screen}a",
+            "video_b": f"{access_key}-{screen}b",
+        }
+        if screen <= completed_screens:
+            row |= {
+                "video_selection": "A",
+                "video_a_logs": "[" + '{"t": 1}, ' * 50 + "]",
+                "video_complete": "2",
+            }
+        rows.append(row)
+    return rows
+
+
+PARTICIPANTS = {
+    "newparticipa": _participant("newparticipa", 0),
+    "provisioned0": _participant("provisioned0", 0, started=False),
+    "halfwaythere": _participant("halfwaythere", 3),
+    "allscreens00": _participant("allscreens00", MAX_SCREENS),
+    "finishedouto": _participant("finishedouto", MAX_SCREENS)
+    + [
+        {
+            "access_key": "finishedouto",
+            "redcap_event_name": "outroscreen_arm_1",
+            "outro_q1": "3",
+            "outro_complete": "2",
+        }
+    ],
+    "skippedsurve": [
+        {"access_key": "skippedsurve", "c2c_id": "c2c-skipped", "skipped": "1"},
+    ],
+}
+# Not in REDCap at all
+UNKNOWN = "notarecord00"
+
+
+# Shared by every test: those that import data compare the replica against REDCap afterwards anyway
+@pytest.fixture(scope="module")
+def redcap_url():
+    server = redcap_standin.make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/api/"
+    for rows in PARTICIPANTS.values():
+        redcap_helpers.import_record(TOKEN, url, rows)
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def replica(tmp_path, redcap_url):
+    replica = redcap_replica.REDCapReplica(
+        TOKEN, redcap_url, tmp_path / "replica.sqlite3", max_staleness_seconds=60
+    )
+    replica.seed()
+    yield replica
+    redcap_helpers.use_replica(None)
+
+
+def _from_both(replica, helper, *args):
+    """Returns `helper(*args)` answered by REDCap, then by the replica."""
+    redcap_helpers.use_replica(None)
+    from_redcap = helper(*args)
+    exports = []
+    export = replica.export
+
+    def counted_export(request_params):
+        exports.append(request_params)
+        return export(request_params)
+
+    replica.export = counted_export
+    redcap_helpers.use_replica(replica)
+    try:
+        from_replica = helper(*args)
+    finally:
+        redcap_helpers.use_replica(None)
+        del replica.export
+    # Otherwise REDCap answered both times
+    assert exports, f"{helper.__name__} wasn't answered by the replica"
+    return (from_redcap, from_replica)
+
+
+@pytest.mark.parametrize("access_key", [*PARTICIPANTS, UNKNOWN])
+def test_export_video_ids_matches_redcap(replica, redcap_url, access_key):
+    from_redcap, from_replica = _from_both(
+        replica, redcap_helpers.export_video_ids, TOKEN, redcap_url, access_key, MAX_SCREENS
+    )
+    assert from_replica == from_redcap
+
+
+@pytest.mark.parametrize("access_key", [*PARTICIPANTS, UNKNOWN])
+def test_survey_state_helpers_match_redcap(replica, redcap_url, access_key):
+    for helper, args in [
+        (redcap_helpers.get_survey_status, ()),
+        (redcap_helpers.user_completed_survey, ()),
+        (redcap_helpers.captured_user_agent, ()),
+        (redcap_helpers.get_most_recent_screen, (MAX_SCREENS, True)),
+        (
+            redcap_helpers.check_event_for_prefilled_data,
+            ("screen2_arm_1", "video_complete"),
+        ),
+        (
+            redcap_helpers.check_event_for_prefilled_data,
+            ("introscreen_arm_1", "single_video_complete"),
+        ),
+    ]:
+        from_redcap, from_replica = _from_both(
+            replica, helper, TOKEN, redcap_url, access_key, *args
+        )
+        assert from_replica == from_redcap, helper.__name__
+
+
+def test_export_leaves_out_unrequested_fields(replica):
+    rows = replica.export(
+        {
+            "token": TOKEN,
+            "content": "record",
+            "action": "export",
+            "records[0]": "halfwaythere",
+            "fields[0]": "video_a",
+            "events[0]": "screen1_arm_1",
+        }
+    )
+    assert rows == [
+        {
+            "access_key": "halfwaythere",
+            "redcap_event_name": "screen1_arm_1",
+            "video_a": "halfwaythere-1a",
+        }
+    ]
+
+
+def test_write_through(replica, redcap_url):
+    redcap_helpers.use_replica(replica)
+    upload = {
+        "access_key": "newparticipa",
+        "redcap_event_name": "screen1_arm_1",
+        "video_selection": "B",
+        "video_complete": "2",
+    }
+    redcap_helpers.import_record(TOKEN, redcap_url, [upload])
+    # Seen straight away, without a sync, and the rest of the row is kept
+    from_redcap, from_replica = _from_both(
+        replica, redcap_helpers.export_video_ids, TOKEN, redcap_url, "newparticipa", MAX_SCREENS
+    )
+    assert from_replica == from_redcap
+    assert from_replica[0]["video_complete"] == "2"
+    assert from_replica[0]["video_a"] == "newparticipa-1a"
+
+
+def test_sync_picks_up_changes_made_elsewhere(replica, redcap_url):
+    # Imported by someone else, so not written through
+    redcap_helpers.import_record(
+        TOKEN,
+        redcap_url,
+        [{"access_key": "brandnewone0", "c2c_id": "c2c-new", "survey_tm_start": "2026-10-02"}],
+    )
+    replica.sync()
+    from_redcap, from_replica = _from_both(
+        replica, redcap_helpers.get_survey_status, TOKEN, redcap_url, "brandnewone0"
+    )
+    assert from_replica == from_redcap == redcap_helpers.SurveyStatus(False, "2026-10-02")
+
+
+def _params(**extra) -> dict:
+    params = {
+        "token": TOKEN,
+        "content": "record",
+        "action": "export",
+        "records[0]": "halfwaythere",
+        "fields[0]": "video_a",
+    }
+    return params | extra
+
+
+def test_can_serve(replica):
+    assert replica.can_serve(_params())
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        _params(token="another project's token"),
+        _params(action="import"),
+        _params(content="metadata"),
+        _params(dateRangeBegin="2026-10-01 00:00:00"),
+        # Video logs aren't kept in the replica
+        _params(**{"fields[1]": "video_a_logs"}),
+        # Every field
+        {k: v for k, v in _params().items() if k != "fields[0]"},
+    ],
+)
+def test_cant_serve(replica, params):
+    assert not replica.can_serve(params)
+
+
+def test_cant_serve_when_stale(tmp_path, redcap_url):
+    replica = redcap_replica.REDCapReplica(TOKEN, redcap_url, tmp_path / "replica.sqlite3")
+    # Never synced
+    assert not replica.can_serve(_params())
+    replica.seed()
+    assert replica.can_serve(_params())
+    replica.max_staleness_seconds = -1
+    assert not replica.can_serve(_params())
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import session_tokens
+
+SECRET = b"test secret"
+VIDEO_IDS = [f"video{i}" for i in range(20)]
+MAX_AGE = 60 * 60
+
+
+def _progress(issued_at: int | None = None) -> session_tokens.SurveyProgress:
+    return session_tokens.SurveyProgress(
+        "abcdefghijkl",
+        ["video3", "video7", "video0", "video19"],
+        1,
+        int(time.time()) if issued_at is None else issued_at,
+    )
+
+
+def _token(issued_at: int | None = None) -> str:
+    return session_tokens.issue_progress_token(SECRET, _progress(issued_at), VIDEO_IDS)
+
+
+def test_round_trip():
+    progress = _progress()
+    token = session_tokens.issue_progress_token(SECRET, progress, VIDEO_IDS)
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS, MAX_AGE) == progress
+
+
+def test_wrong_secret():
+    assert session_tokens.read_progress_token(b"other secret", _token(), VIDEO_IDS, MAX_AGE) is None
+
+
+def test_tampered_body():
+    body, signature = _token().split(".")
+    # Same signature on a body claiming more completed screens
+    forged = session_tokens._b64decode(body).decode().split("|")
+    forged[4] = "5"
+    forged_body = session_tokens._b64encode("|".join(forged).encode())
+    token = f"{forged_body}.{signature}"
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS, MAX_AGE) is None
+
+
+@pytest.mark.parametrize("signature", ["", "AAAAAAAAAAAAAAAAAAAAAA", "é" * 22, "\x00"])
+def test_tampered_signature(signature):
+    body = _token().split(".")[0]
+    token = f"{body}.{signature}"
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS, MAX_AGE) is None
+
+
+def test_expired():
+    token = _token(issued_at=int(time.time()) - MAX_AGE - 1)
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS, MAX_AGE) is None
+
+
+def test_video_list_changed():
+    token = _token()
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS[::-1], MAX_AGE) is None
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS[:10], MAX_AGE) is None
+
+
+@pytest.mark.parametrize("token", ["", "no-dot", "a.b.c", ".", "!!!.!!!", "é.é"])
+def test_malformed(token):
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS, MAX_AGE) is None
+
+
+def test_signed_garbage_body():
+    # Correctly signed, but not a token's payload: still rejected rather than raising
+    body = session_tokens._b64encode(b"1|abcdefghijkl|nope")
+    token = f"{body}.{session_tokens._signature(SECRET, body)}"
+    assert session_tokens.read_progress_token(SECRET, token, VIDEO_IDS, MAX_AGE) is None
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+import shared_state
+
+
+class Clock:
+    """Stands in for the `time` module in shared_state."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(shared_state, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def state(tmp_path):
+    return shared_state.SharedState(tmp_path / "shared_state.sqlite3")
+
+
+def test_claim_is_exclusive_until_released(state, clock):
+    assert state.claim("new_record:abcdefghijkl", 60)
+    assert not state.claim("new_record:abcdefghijkl", 60)
+    assert state.claim("new_record:mnopqrstuvwx", 60)
+    state.release("new_record:abcdefghijkl")
+    assert state.claim("new_record:abcdefghijkl", 60)
+
+
+def test_claim_expires(state, clock):
+    assert state.claim("upload:abcdefghijkl:screen1_arm_1", 30)
+    clock.now += 29
+    assert not state.claim("upload:abcdefghijkl:screen1_arm_1", 30)
+    clock.now += 2
+    assert state.claim("upload:abcdefghijkl:screen1_arm_1", 30)
+
+
+def test_claim_across_instances_and_threads(tmp_path):
+    # Like several workers (each with its own SharedState) and their threads racing for one claim
+    path = tmp_path / "shared_state.sqlite3"
+    states = [shared_state.SharedState(path) for _ in range(4)]
+    results = []
+    barrier = threading.Barrier(16)
+
+    def try_claim(state):
+        barrier.wait()
+        results.append(state.claim("new_record:abcdefghijkl", 60))
+
+    threads = [threading.Thread(target=try_claim, args=(states[i % 4],)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 15 + [True]
+
+
+def test_expired_claims_are_purged(state, clock):
+    state.claim("new_record:abcdefghijkl", 30)
+    state.claim("new_record:mnopqrstuvwx", 3 * shared_state.PURGE_INTERVAL_SECONDS)
+    clock.now += shared_state.PURGE_INTERVAL_SECONDS
+    # Any claim purges every expired one, at most once per interval
+    state.claim("upload:abcdefghijkl:screen1_arm_1", 30)
+    keys = [row[0] for row in state._connect().execute("SELECT key FROM kv ORDER BY key")]
+    assert keys == ["new_record:mnopqrstuvwx", "upload:abcdefghijkl:screen1_arm_1"]
+
+
+def test_counters(state, clock):
+    state.incr_many({"choices:a": 2, "choices:b": 1})
+    state.incr_many({"choices:a": 3, "other": 7})
+    assert state.counters("choices:") == {"choices:a": 5, "choices:b": 1}
+    assert state.counters() == {"choices:a": 5, "choices:b": 1, "other": 7}
+
+
+def test_purge_full_buckets(state, clock):
+    state.take_token("pages:ip:1.2.3.4", 10, 1)
+    clock.now += 100
+    state.take_token("pages:ip:5.6.7.8", 10, 1)
+    assert state.purge_full_buckets(idle_seconds=50) == 1
+    assert state.token_wait("pages:ip:5.6.7.8", 10, 1, cost=10) == pytest.approx(1)
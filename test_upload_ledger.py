@@ -0,0 +1,89 @@
+import pytest
+
+import upload_ledger
+
+
+class Clock:
+    """Stands in for the `time` module in upload_ledger."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upload_ledger, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return upload_ledger.UploadLedger(tmp_path / "shared_state.sqlite3", ttl_seconds=100)
+
+
+def test_unknown_event(ledger, clock):
+    assert ledger.lookup("abcdefghijkl", "screen1_arm_1") is None
+
+
+def test_record_and_lookup(ledger, clock):
+    ledger.record("abcdefghijkl", "screen1_arm_1", "idem-1", "hash-1", "1")
+    entry = ledger.lookup("abcdefghijkl", "screen1_arm_1")
+    assert entry.recorded
+    assert (entry.idempotency_key, entry.payload_hash, entry.result) == ("idem-1", "hash-1", "1")
+    # Other events and participants are separate
+    assert ledger.lookup("abcdefghijkl", "screen2_arm_1") is None
+    assert ledger.lookup("mnopqrstuvwx", "screen1_arm_1") is None
+
+
+def test_mark_empty_then_record(ledger, clock):
+    events = ["screen1_arm_1", "screen2_arm_1"]
+    ledger.mark("abcdefghijkl", events, upload_ledger.EMPTY)
+    assert not ledger.lookup("abcdefghijkl", "screen1_arm_1").recorded
+    ledger.record("abcdefghijkl", "screen1_arm_1", "idem-1", "hash-1", "1")
+    assert ledger.lookup("abcdefghijkl", "screen1_arm_1").recorded
+    assert not ledger.lookup("abcdefghijkl", "screen2_arm_1").recorded
+
+
+def test_mark_never_overwrites_recorded(ledger, clock):
+    ledger.record("abcdefghijkl", "screen1_arm_1", "idem-1", "hash-1", "1")
+    # e.g. start_survey() read REDCap before the upload landed there
+    ledger.mark("abcdefghijkl", ["screen1_arm_1"], upload_ledger.EMPTY)
+    entry = ledger.lookup("abcdefghijkl", "screen1_arm_1")
+    assert entry.recorded
+    assert entry.idempotency_key == "idem-1"
+
+
+def test_mark_recorded_over_empty(ledger, clock):
+    ledger.mark("abcdefghijkl", ["screen1_arm_1"], upload_ledger.EMPTY)
+    ledger.mark("abcdefghijkl", ["screen1_arm_1"], upload_ledger.RECORDED)
+    assert ledger.lookup("abcdefghijkl", "screen1_arm_1").recorded
+
+
+def test_entries_expire(ledger, clock):
+    ledger.record("abcdefghijkl", "screen1_arm_1")
+    clock.now += 99
+    assert ledger.lookup("abcdefghijkl", "screen1_arm_1") is not None
+    clock.now += 2
+    # Unknown again, so REDCap gets asked
+    assert ledger.lookup("abcdefghijkl", "screen1_arm_1") is None
+
+
+def test_compact_deletes_only_expired_entries(ledger, clock):
+    ledger.record("abcdefghijkl", "screen1_arm_1")
+    clock.now += 50
+    ledger.record("abcdefghijkl", "screen2_arm_1")
+    clock.now += 51
+    assert ledger.compact() == 1
+    assert ledger.lookup("abcdefghijkl", "screen2_arm_1") is not None
+
+
+def test_shared_between_instances(tmp_path, clock):
+    # Each worker process has its own UploadLedger on the same file
+    path = tmp_path / "shared_state.sqlite3"
+    upload_ledger.UploadLedger(path).record("abcdefghijkl", "introscreen_arm_1", "idem-1")
+    entry = upload_ledger.UploadLedger(path).lookup("abcdefghijkl", "introscreen_arm_1")
+    assert entry.recorded and entry.idempotency_key == "idem-1"
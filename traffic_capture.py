@@ -0,0 +1,249 @@
+"""ASGI middleware that records the app's traffic to rotating JSON Lines files, so it can be played
+back later with `traffic_replay.py`.
+
+Each request becomes one line: when it arrived, its method, path and query, its response status, how
+long it took, and the sizes of the request and response bodies. The bodies of JSON and form uploads
+(e.g. `VideoPageIn` and `IntroPageIn`, video logs and all) are kept too, up to `MAX_BODY_BYTES`.
+
+Access keys are never written down: `key` query parameters and form fields are replaced by a keyed
+hash (`hash_key()`), which is still 12 characters long and the same for every request from the same
+participant. No cookies, headers (other than the content type) or IP addresses are recorded.
+
+Lines are handed to a background thread, so writing them never holds up a response. Every worker
+writes its own files in `CAPTURE_DIR`, starting a new file after `MAX_FILE_BYTES`; only the newest
+`MAX_FILES` files are kept.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from collections.abc import Callable
+from pathlib import Path
+
+CAPTURE_DIR = Path(Path(__file__).resolve().parent, "state", "captures")
+
+MAX_FILE_BYTES = 50 * 1024 * 1024
+MAX_FILES = 40
+# Bodies bigger than this are left out (their size is still recorded)
+MAX_BODY_BYTES = 2 * 1024 * 1024
+
+# Query parameters and form fields that hold access keys
+KEY_FIELDS = {"key"}
+
+CAPTURED_CONTENT_TYPES = ("application/json", "application/x-www-form-urlencoded")
+
+
+def hash_key(secret: bytes, key: str, length: int = 12) -> str:
+    """Returns a stand-in for an access key that can't be turned back into it without `secret`."""
+    return hmac.new(secret, key.encode(), hashlib.sha256).hexdigest()[:length]
+
+
+class CaptureWriter:
+    """Writes captured requests to rotating JSON Lines files, from a background thread."""
+
+    def __init__(
+        self,
+        capture_dir: Path = CAPTURE_DIR,
+        max_file_bytes: int = MAX_FILE_BYTES,
+        max_files: int = MAX_FILES,
+    ):
+        self.capture_dir = Path(capture_dir)
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.dropped = 0
+        self._queue: queue.SimpleQueue[dict | None] = queue.SimpleQueue()
+        self._file = None
+        self._file_bytes = 0
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def write(self, entry: dict) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._write_entries, name="traffic-capture", daemon=True
+                    )
+                    self._thread.start()
+        self._queue.put(entry)
+
+    def close(self) -> None:
+        """Writes everything that's been queued, then closes the current file."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _open_new_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self.capture_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        self._file = open(Path(self.capture_dir, f"capture-{timestamp}-{os.getpid()}.jsonl"), "a")
+        self._file_bytes = 0
+        captures = sorted(self.capture_dir.glob("capture-*.jsonl"))
+        for old_capture in captures[: max(0, len(captures) - self.max_files)]:
+            old_capture.unlink(missing_ok=True)
+
+    def _write_entries(self) -> None:
+        while True:
+            entry = self._queue.get()
+            try:
+                while entry is not None:
+                    line = json.dumps(entry, separators=(",", ":")) + "\n"
+                    if self._file is None or self._file_bytes + len(line) > self.max_file_bytes:
+                        self._open_new_file()
+                    self._file.write(line)
+                    self._file_bytes += len(line)
+                    if self._queue.empty():
+                        break
+                    entry = self._queue.get()
+                self._file.flush()
+            except Exception as e:
+                self.dropped += 1
+                print(f"***** Couldn't write traffic capture: {repr(e)}")
+            if entry is None:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+
+class TrafficCaptureMiddleware:
+    def __init__(
+        self,
+        app,
+        writer: CaptureWriter,
+        key_secret: Callable[[], bytes],
+        exempt_path_prefixes: list[str],
+        sanitize_key: Callable[[str], str] = lambda key: key,
+        is_valid_key: Callable[[str], bool] = lambda key: False,
+        max_body_bytes: int = MAX_BODY_BYTES,
+        enabled: bool = True,
+    ):
+        self.app = app
+        self.writer = writer
+        # Called on first use, so the secret doesn't have to be ready when the app is built
+        self.key_secret = key_secret
+        self.exempt_path_prefixes = tuple(exempt_path_prefixes)
+        self.sanitize_key = sanitize_key
+        self.is_valid_key = is_valid_key
+        self.max_body_bytes = max_body_bytes
+        self.enabled = enabled
+        self._secret: bytes | None = None
+
+    def _hash(self, key: str) -> str:
+        """Hashes the key the app would see, so every spelling of the same key gets the same hash."""
+        if not key:
+            return ""
+        if self._secret is None:
+            self._secret = self.key_secret()
+        return hash_key(self._secret, self.sanitize_key(key) or key)
+
+    def _sanitize_fields(self, fields: dict[str, list[str]]) -> dict[str, list[str]]:
+        return {
+            name: [self._hash(value) for value in values] if name in KEY_FIELDS else values
+            for name, values in fields.items()
+        }
+
+    def _entry(self, scope, started_at: float, duration: float, status: int) -> dict:
+        query = urllib.parse.parse_qs(
+            scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True
+        )
+        entry = {
+            "t": round(started_at, 4),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": self._sanitize_fields(query),
+            "status": status,
+            "duration_ms": round(duration * 1000, 2),
+        }
+        self._set_key(entry, query.get("key", [""])[0])
+        return entry
+
+    def _set_key(self, entry: dict, key: str) -> None:
+        """Notes whose request this is, so the replay can keep each participant's requests together."""
+        sanitized_key = self.sanitize_key(key)
+        entry["key"] = self._hash(key)
+        # Whether the key was in the access key CSV, so the replay knows which ones to accept
+        entry["valid_key"] = bool(sanitized_key) and self.is_valid_key(sanitized_key)
+
+    def _add_body(self, entry: dict, content_type: str, body: bytes, body_size: int) -> None:
+        entry["request_bytes"] = body_size
+        if not body_size:
+            return
+        media_type = content_type.split(";")[0].strip().lower()
+        entry["content_type"] = media_type
+        if media_type not in CAPTURED_CONTENT_TYPES:
+            return
+        if body_size > self.max_body_bytes:
+            entry["body_omitted"] = True
+            return
+        try:
+            if media_type == "application/json":
+                entry["body"] = json.loads(body)
+            else:
+                form = urllib.parse.parse_qs(body.decode(), keep_blank_values=True)
+                entry["form"] = self._sanitize_fields(form)
+                # The access key form on "/" posts the key to /check in its body
+                if not entry["key"] and form.get("key", [""])[0]:
+                    self._set_key(entry, form["key"][0])
+        except ValueError:
+            entry["body_omitted"] = True
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not self.enabled
+            or scope["type"] != "http"
+            or scope["path"].startswith(self.exempt_path_prefixes)
+        ):
+            return await self.app(scope, receive, send)
+
+        started_at = time.time()
+        start_time = time.perf_counter()
+        # Mounted apps (e.g. Flask) change the scope's path as they route it
+        request_scope = dict(scope)
+        body_chunks = []
+        body_size = 0
+        status = 0
+        response_size = 0
+
+        async def receive_and_keep():
+            nonlocal body_size
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                body_size += len(chunk)
+                if body_size <= self.max_body_bytes:
+                    body_chunks.append(chunk)
+            return message
+
+        async def send_and_measure(message):
+            nonlocal status, response_size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_keep, send_and_measure)
+        finally:
+            try:
+                entry = self._entry(
+                    request_scope, started_at, time.perf_counter() - start_time, status
+                )
+                content_type = (
+                    dict(request_scope["headers"]).get(b"content-type", b"").decode("latin-1")
+                )
+                self._add_body(entry, content_type, b"".join(body_chunks), body_size)
+                entry["response_bytes"] = response_size
+                self.writer.write(entry)
+            except Exception as e:
+                # Never let capturing break the app
+                print(f"***** Couldn't capture request: {repr(e)}")
@@ -0,0 +1,349 @@
+"""Plays traffic recorded by `traffic_capture.py` back against the app, to benchmark changes against
+real participant behavior.
+
+Usage:
+    python traffic_replay.py state/captures                 # as fast as it was recorded (1x)
+    python traffic_replay.py state/captures --speed 10      # 10 times as fast
+    python traffic_replay.py state/captures --speed max     # every participant as fast as possible
+    python traffic_replay.py capture.jsonl --target http://127.0.0.1:8000 --speed max
+
+By default, a fresh copy of the app is started on a free port, talking to a fresh local REDCap
+stand-in (`redcap_standin.py`) and its own shared state database, with rate limits off. The captured
+access keys (already hashed) are the only valid keys in its access key CSV, so every request gets
+the same treatment as it did in production. With `--target`, the requests go to an app that's
+already running instead; it has to accept the captured keys (see the `ids.csv` left in `--work-dir`).
+
+Requests are sent in the order they were captured, with the same gaps between them (divided by
+`--speed`). Every participant's requests are sent one at a time, each one after the previous one
+got its response, with a cookie jar of their own. Prints the latency of every route; `--report`
+also saves it as JSON.
+"""
+
+import argparse
+import csv
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+PATH_TO_THIS_FOLDER = Path(__file__).resolve().parent
+
+# Prefix of the app's static files, which are reported together as one route
+STATIC_PATH_PREFIX = "/retention/survey/static/"
+
+READY_PATH = "/retention/readyz"
+READY_TIMEOUT_SECONDS = 60
+
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+def parse_speed(speed: str) -> float | None:
+    """Returns how many times faster than captured to replay, or None for "max"."""
+    if speed == "max":
+        return None
+    value = float(speed)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("the speed has to be positive, or max")
+    return value
+
+
+def read_capture(paths: list[Path]) -> list[dict]:
+    """Returns every captured request in the files (or directories of capture files), oldest first."""
+    files = []
+    for path in paths:
+        files += sorted(Path(path).glob("capture-*.jsonl")) if Path(path).is_dir() else [path]
+    entries = []
+    for file in files:
+        with open(file) as infile:
+            entries += [json.loads(line) for line in infile if line.strip()]
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def write_id_file(entries: list[dict], id_file: Path) -> int:
+    """Writes an access key CSV that accepts exactly the (hashed) keys that were accepted when captured."""
+    keys = sorted({entry["key"] for entry in entries if entry.get("valid_key")})
+    with open(id_file, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(["record_id", "access_key"])
+        writer.writerows([(f"replay{i}", key) for i, key in enumerate(keys, start=1)])
+    return len(keys)
+
+
+def route_name(entry: dict) -> str:
+    if entry["path"].startswith(STATIC_PATH_PREFIX):
+        return f"{entry['method']} {STATIC_PATH_PREFIX}*"
+    return f"{entry['method']} {entry['path']}"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_app(port: int, redcap_url: str, id_file: Path, state_dir: Path) -> None:
+    """Runs the app for a replay (in its own process)."""
+    # Before flask_site opens the shared state database
+    os.environ["C2C_SHARED_STATE_DB"] = str(Path(state_dir, "shared_state.sqlite3"))
+    import uvicorn
+
+    import flask_site
+
+    flask_site.flask_app.config.update(
+        {
+            "REDCAP_API_URL": redcap_url,
+            "REDCAP_REPLICA_ENABLED": False,
+            "RATE_LIMITS_ENABLED": False,
+            "TRAFFIC_CAPTURE_ENABLED": False,
+        }
+    )
+    flask_site.load_id_mappings(id_file)
+
+    import main
+
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_replay_servers(work_dir: Path, redcap_latency_ms: float) -> tuple[str, list]:
+    """Starts a REDCap stand-in and a copy of the app. Returns the app's URL and the processes."""
+    redcap_port = free_port()
+    app_port = free_port()
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                str(Path(PATH_TO_THIS_FOLDER, "redcap_standin.py")),
+                "--port",
+                str(redcap_port),
+                "--latency-ms",
+                str(redcap_latency_ms),
+            ],
+            stdout=open(Path(work_dir, "redcap_standin.log"), "w"),
+            stderr=subprocess.STDOUT,
+        ),
+        subprocess.Popen(
+            [
+                sys.executable,
+                str(Path(PATH_TO_THIS_FOLDER, "traffic_replay.py")),
+                "--serve-app",
+                str(app_port),
+                "--redcap-url",
+                f"http://127.0.0.1:{redcap_port}/api/",
+                "--work-dir",
+                str(work_dir),
+            ],
+            cwd=PATH_TO_THIS_FOLDER,
+            stdout=open(Path(work_dir, "app.log"), "w"),
+            stderr=subprocess.STDOUT,
+        ),
+    ]
+    base_url = f"http://127.0.0.1:{app_port}"
+    deadline = time.monotonic() + READY_TIMEOUT_SECONDS
+    while True:
+        try:
+            if requests.get(base_url + READY_PATH, timeout=1).status_code == 200:
+                return (base_url, processes)
+        except requests.RequestException:
+            pass
+        if time.monotonic() > deadline or any(p.poll() is not None for p in processes):
+            for process in processes:
+                process.terminate()
+            raise RuntimeError(f"The app didn't start; see {Path(work_dir, 'app.log')}")
+        time.sleep(0.2)
+
+
+class Replayer:
+    def __init__(self, base_url: str, speed: float | None, concurrency: int):
+        self.base_url = base_url.rstrip("/")
+        self.speed = speed
+        self.concurrency = concurrency
+        # (route, captured status, replayed status, captured ms, replayed ms, ms late)
+        self.results: list[tuple[str, int, int, float, float, float]] = []
+        self._lock = threading.Lock()
+
+    def _replay_participant(self, entries: list[dict], t0: float, start_time: float) -> None:
+        session = requests.Session()
+        for entry in entries:
+            lateness = 0.0
+            if self.speed is not None:
+                send_at = start_time + (entry["t"] - t0) / self.speed
+                lateness = time.perf_counter() - send_at
+                if lateness < 0:
+                    time.sleep(-lateness)
+                    lateness = 0.0
+            request_start = time.perf_counter()
+            try:
+                response = session.request(
+                    entry["method"],
+                    self.base_url + entry["path"],
+                    params=entry.get("query"),
+                    json=entry.get("body"),
+                    data=entry.get("form"),
+                    allow_redirects=False,
+                    timeout=REQUEST_TIMEOUT_SECONDS,
+                )
+                status = response.status_code
+            except requests.RequestException:
+                status = 0
+            with self._lock:
+                self.results.append(
+                    (
+                        route_name(entry),
+                        entry["status"],
+                        status,
+                        entry["duration_ms"],
+                        (time.perf_counter() - request_start) * 1000,
+                        lateness * 1000,
+                    )
+                )
+
+    def replay(self, entries: list[dict]) -> float:
+        """Replays the requests. Returns how many seconds it took."""
+        participants = defaultdict(list)
+        for i, entry in enumerate(entries):
+            # Requests without a key don't belong to anyone in particular
+            participants[entry["key"] or f"no key {i}"].append(entry)
+        t0 = entries[0]["t"]
+        start_time = time.perf_counter()
+        # Participants are in the order of their first request
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(self._replay_participant, participant_entries, t0, start_time)
+                for participant_entries in participants.values()
+            ]
+        for future in futures:
+            future.result()
+        return time.perf_counter() - start_time
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(results: list[tuple[str, int, int, float, float, float]]) -> dict[str, dict]:
+    """Returns latency percentiles and status mismatches of every route."""
+    by_route = defaultdict(list)
+    for result in results:
+        by_route[result[0]].append(result)
+    summary = {}
+    for route, route_results in sorted(by_route.items()):
+        captured = sorted(result[3] for result in route_results)
+        replayed = sorted(result[4] for result in route_results)
+        summary[route] = {
+            "requests": len(route_results),
+            "status_mismatches": sum(1 for result in route_results if result[1] != result[2]),
+            "statuses": dict(Counter(result[2] for result in route_results)),
+            "captured_p50_ms": round(percentile(captured, 0.5), 2),
+            "p50_ms": round(percentile(replayed, 0.5), 2),
+            "p95_ms": round(percentile(replayed, 0.95), 2),
+            "p99_ms": round(percentile(replayed, 0.99), 2),
+            "max_ms": round(replayed[-1], 2),
+            "late_p95_ms": round(
+                percentile(sorted(result[5] for result in route_results), 0.95), 2
+            ),
+        }
+    return summary
+
+
+def main_cli() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("capture", type=Path, nargs="*", help="capture files or directories")
+    parser.add_argument(
+        "--speed", type=parse_speed, default=1.0, help="times faster than captured, or max"
+    )
+    parser.add_argument("--target", help="URL of a running app to replay against")
+    parser.add_argument(
+        "--concurrency", type=int, default=200, help="participants replayed at the same time"
+    )
+    parser.add_argument("--skip-static", action="store_true", help="don't request static files")
+    parser.add_argument(
+        "--redcap-latency-ms",
+        type=float,
+        default=0,
+        help="how slowly the REDCap stand-in answers",
+    )
+    parser.add_argument(
+        "--work-dir", type=Path, help="keep the replay's access key CSV, state and logs here"
+    )
+    parser.add_argument("--report", type=Path, help="also save the results here as JSON")
+    parser.add_argument("--serve-app", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--redcap-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_app:
+        serve_app(args.serve_app, args.redcap_url, Path(args.work_dir, "ids.csv"), args.work_dir)
+        return 0
+
+    entries = read_capture(args.capture)
+    # Bodies too big to capture can't be sent again
+    replayable = [entry for entry in entries if not entry.get("body_omitted")]
+    if args.skip_static:
+        replayable = [
+            entry for entry in replayable if not entry["path"].startswith(STATIC_PATH_PREFIX)
+        ]
+    if not replayable:
+        print("***** Nothing to replay")
+        return 1
+    print(
+        f"* Replaying {len(replayable)} of {len(entries)} captured request(s) "
+        f"({replayable[-1]['t'] - replayable[0]['t']:.0f}s captured) "
+        f"at {'max' if args.speed is None else f'{args.speed:g}x'} speed"
+    )
+
+    temporary_dir = None
+    if args.work_dir is None:
+        temporary_dir = tempfile.TemporaryDirectory(prefix="c2c-replay-")
+        args.work_dir = Path(temporary_dir.name)
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    key_count = write_id_file(replayable, Path(args.work_dir, "ids.csv"))
+    print(f"* {key_count} participant access key(s) in {Path(args.work_dir, 'ids.csv')}")
+
+    processes = []
+    try:
+        base_url = args.target
+        if base_url is None:
+            base_url, processes = start_replay_servers(args.work_dir, args.redcap_latency_ms)
+            print(f"* Started the app at {base_url}")
+        replayer = Replayer(base_url, args.speed, args.concurrency)
+        duration = replayer.replay(replayable)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if temporary_dir is not None:
+            temporary_dir.cleanup()
+
+    summary = summarize(replayer.results)
+    print(f"* Replayed {len(replayer.results)} request(s) in {duration:.1f}s")
+    print(
+        f"{'route':45} {'requests':>8} {'mismatch':>8} {'captured p50':>12} "
+        f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'late p95':>9}"
+    )
+    for route, stats in summary.items():
+        print(
+            f"{route[:45]:45} {stats['requests']:8} {stats['status_mismatches']:8} "
+            f"{stats['captured_p50_ms']:12.1f} {stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} "
+            f"{stats['p99_ms']:8.1f} {stats['max_ms']:8.1f} {stats['late_p95_ms']:9.1f}"
+        )
+    if args.report:
+        with open(args.report, "w") as outfile:
+            json.dump(
+                {"duration_seconds": round(duration, 3), "routes": summary}, outfile, indent=2
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,4 +1,5 @@
 # UNUSED IN THIS APP - but kept for reference!
+# For reminding many participants at once, see bulk_mailer.py (which reuses the pieces below)
 
 import smtplib
 from email.headerregistry import Address
@@ -37,9 +38,7 @@ def construct_message_contents(user_email_addr: str, subject: str, key: str) ->
         return (plaintext_message, html_message)
 
 
-def construct_message(
-    from_addr: str, from_addr_display_name: str, to_addr: str, subject: str, key: str
-) -> EmailMessage:
+def construct_sender_address(from_addr: str, from_addr_display_name: str) -> Address:
     if "@" not in from_addr:
         raise ValueError(f"Malformed 'from' email (missing '@'): {from_addr}")
     from_addr_parts = from_addr.split("@")
@@ -47,11 +46,16 @@ def construct_message(
         raise ValueError(f"Malformed 'from' email (incomplete address): {from_addr}")
     if "." not in from_addr_parts[1]:
         raise ValueError(f"Malformed 'from' email (bad domain): {from_addr}")
-
-    message_html = EmailMessage()
-    message_html["From"] = Address(
+    return Address(
         display_name=from_addr_display_name, username=from_addr_parts[0], domain=from_addr_parts[1]
     )
+
+
+def construct_message(
+    from_addr: str, from_addr_display_name: str, to_addr: str, subject: str, key: str
+) -> EmailMessage:
+    message_html = EmailMessage()
+    message_html["From"] = construct_sender_address(from_addr, from_addr_display_name)
     message_html["To"] = to_addr
     message_html["Subject"] = subject
 
@@ -0,0 +1,135 @@
+"""A local record of which survey uploads have already been imported into REDCap.
+
+The upload endpoints in main.py used to export from REDCap before every import, just to notice
+duplicate submissions (the Back button, or the service worker replaying a queued upload). The ledger
+answers that question from a SQLite table shared by every worker instead:
+* "recorded": data for this participant's event has been imported (by us, or found in REDCap)
+* "empty": we know there's no data for the event yet, so the upload can be imported right away
+* no entry: unknown (e.g. the entry expired or the state folder was wiped), so REDCap has to be asked
+
+Entries for every screen are written when a participant's state is read from REDCap in
+`flask_site.start_survey`.
+Entries expire after `UPLOAD_LEDGER_TTL_SECONDS`; expired rows are deleted every so often as uploads
+are recorded.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+import shared_state
+
+# Long enough to cover a participant's whole survey, including coming back to it days later
+UPLOAD_LEDGER_TTL_SECONDS = 14 * 24 * 60 * 60
+
+# Expired rows are deleted at most this often
+COMPACTION_INTERVAL_SECONDS = 60 * 60
+
+RECORDED = "recorded"
+EMPTY = "empty"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_ledger (
+    access_key TEXT NOT NULL,
+    event TEXT NOT NULL,
+    status TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    payload_hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (access_key, event)
+);
+CREATE INDEX IF NOT EXISTS upload_ledger_updated_at ON upload_ledger (updated_at);
+"""
+
+
+class LedgerEntry(NamedTuple):
+    status: str
+    idempotency_key: str
+    payload_hash: str
+    result: str
+    updated_at: float
+
+    @property
+    def recorded(self) -> bool:
+        return self.status == RECORDED
+
+
+class UploadLedger:
+    def __init__(
+        self,
+        db_path: Path | str = shared_state.SHARED_STATE_DB_PATH,
+        ttl_seconds: float = UPLOAD_LEDGER_TTL_SECONDS,
+    ):
+        self.db_path = Path(db_path)
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._compacted_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self.db_path, timeout=shared_state.BUSY_TIMEOUT, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, access_key: str, event: str) -> LedgerEntry | None:
+        """Returns what's known about uploads to this participant's event, or None if nothing is."""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT status, idempotency_key, payload_hash, result, updated_at "
+                "FROM upload_ledger WHERE access_key = ? AND event = ? AND updated_at > ?",
+                (access_key, event, time.time() - self.ttl_seconds),
+            )
+            .fetchone()
+        )
+        return None if row is None else LedgerEntry(*row)
+
+    def record(
+        self,
+        access_key: str,
+        event: str,
+        idempotency_key: str = "",
+        payload_hash: str = "",
+        result: str = "",
+    ) -> None:
+        """Notes that data for this participant's event is in REDCap."""
+        self._connect().execute(
+            "INSERT OR REPLACE INTO upload_ledger VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (access_key, event, RECORDED, idempotency_key, payload_hash, result, time.time()),
+        )
+        self._maybe_compact()
+
+    def mark(self, access_key: str, events: list[str], status: str) -> None:
+        """Notes what REDCap has for these events of this participant: RECORDED (has data) or EMPTY.
+        Never overwrites a RECORDED entry, which may hold the details of our own upload.
+        """
+        now = time.time()
+        self._connect().executemany(
+            "INSERT INTO upload_ledger VALUES (?, ?, ?, '', '', '', ?) "
+            "ON CONFLICT (access_key, event) DO UPDATE "
+            "SET status = excluded.status, updated_at = excluded.updated_at "
+            "WHERE status = ?",
+            [(access_key, event, status, now, EMPTY) for event in events],
+        )
+
+    def compact(self) -> int:
+        """Deletes expired entries. Returns the number of rows removed."""
+        self._compacted_at = time.time()
+        cursor = self._connect().execute(
+            "DELETE FROM upload_ledger WHERE updated_at <= ?", (time.time() - self.ttl_seconds,)
+        )
+        return cursor.rowcount
+
+    def _maybe_compact(self) -> None:
+        if time.time() - self._compacted_at >= COMPACTION_INTERVAL_SECONDS:
+            self.compact()